@@ -1,5 +1,4 @@
 import { useEffect, useRef, useState } from 'react';
-import { supabase } from './lib/supabase';
 import { motion, AnimatePresence } from 'framer-motion';
 import { Plus, Eye, CheckCircle, XCircle, AlertCircle, Loader2, Search, Edit, Trash2, X } from 'lucide-react';
 import ThemeToggle from './components/ThemeToggle';
@@ -26,6 +25,22 @@ const sentimentColor = (sentiment?: string | null) => {
 
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8001';
 
+type TicketDelta = Partial<Ticket> & { op: 'upsert' | 'delete'; id: string };
+
+type TicketPage = { items: Ticket[]; next_cursor: string | null };
+
+// Respuesta de GET /tickets/stats (agregado incremental en la base)
+type TicketStats = {
+  total: number;
+  processed: number;
+  pending: number;
+  by_category: Record<string, number>;
+  by_sentiment: Record<string, number>;
+};
+
+// Tickets por petición a GET /tickets; la grilla pagina sobre lo ya cargado
+const PAGE_SIZE = 90;
+
 type Notification = {
   id: string;
   type: 'success' | 'error' | 'info';
@@ -40,7 +55,10 @@ type TourStep = {
 
 export default function App() {
   const [tickets, setTickets] = useState<Ticket[]>([]);
+  const [stats, setStats] = useState<TicketStats | null>(null);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [newTicket, setNewTicket] = useState('');
   const [submitting, setSubmitting] = useState(false);
   const [realtimeStatus, setRealtimeStatus] = useState('connecting');
@@ -59,6 +77,11 @@ export default function App() {
   const [isMobile, setIsMobile] = useState(false);
   const itemsPerPage = 9; // 3x3 grid
   const currentPageRef = useRef(currentPage);
+  // Tickets ya vistos: un alta se anuncia una sola vez aunque llegue más de un delta completo
+  const knownIdsRef = useRef(new Set<string>());
+  // Ticket más antiguo cargado mientras queden páginas: lo anterior no se agrega por deltas
+  const oldestLoadedRef = useRef<string | null>(null);
+  const statsTimerRef = useRef<ReturnType<typeof setTimeout> | null>(null);
   const headerRef = useRef<HTMLElement>(null);
   const formRef = useRef<HTMLFormElement>(null);
   const searchRef = useRef<HTMLInputElement>(null);
@@ -98,6 +121,61 @@ export default function App() {
     }
   };
 
+  const fetchPage = async (cursor: string | null): Promise<TicketPage | null> => {
+    const params = new URLSearchParams({ limit: String(PAGE_SIZE) });
+    if (cursor) params.set('cursor', cursor);
+    try {
+      const response = await fetch(`${API_URL}/tickets?${params}`);
+      if (!response.ok) return null;
+      return (await response.json()) as TicketPage;
+    } catch (error) {
+      console.error('Error fetching tickets:', error);
+      return null;
+    }
+  };
+
+  const fetchStats = async () => {
+    try {
+      const response = await fetch(`${API_URL}/tickets/stats`);
+      if (response.ok) setStats((await response.json()) as TicketStats);
+    } catch (error) {
+      console.error('Error fetching stats:', error);
+    }
+  };
+
+  // Los deltas llegan en ráfagas: un solo GET /tickets/stats por segundo
+  const scheduleStats = () => {
+    if (statsTimerRef.current) return;
+    statsTimerRef.current = setTimeout(() => {
+      statsTimerRef.current = null;
+      fetchStats();
+    }, 1000);
+  };
+
+  const trackPage = (page: TicketPage) => {
+    page.items.forEach((ticket) => knownIdsRef.current.add(ticket.id));
+    const oldest = page.items[page.items.length - 1];
+    oldestLoadedRef.current = page.next_cursor && oldest ? oldest.created_at : null;
+    setNextCursor(page.next_cursor);
+  };
+
+  const loadMore = async () => {
+    if (!nextCursor || loadingMore) return false;
+    setLoadingMore(true);
+    const page = await fetchPage(nextCursor);
+    setLoadingMore(false);
+    if (!page) {
+      addNotification('error', 'Error al cargar más tickets');
+      return false;
+    }
+    trackPage(page);
+    setTickets((prev) => {
+      const loaded = new Set(prev.map((ticket) => ticket.id));
+      return [...prev, ...page.items.filter((ticket) => !loaded.has(ticket.id))];
+    });
+    return true;
+  };
+
   const finishTour = () => {
     setShowTour(false);
     setTourStepIndex(0);
@@ -147,59 +225,68 @@ export default function App() {
   }, [showTour, tourStepIndex, tourSteps]);
 
   useEffect(() => {
+    // Snapshot: primera página keyset de GET /tickets y conteos de GET /tickets/stats
     const fetchTickets = async () => {
       setLoading(true);
-      const { data, error } = await supabase
-        .from('tickets')
-        .select('*')
-        .order('created_at', { ascending: false });
-      if (!error && data) setTickets(data as Ticket[]);
+      const [page] = await Promise.all([fetchPage(null), fetchStats()]);
+      if (page) {
+        knownIdsRef.current = new Set();
+        trackPage(page);
+        setTickets(page.items);
+      }
       setLoading(false);
     };
 
     fetchTickets();
 
-    const upsertTicket = (incoming: Ticket) => {
+    // Deltas del API (/tickets/events): solo llegan los campos que cambiaron
+    const applyDelta = (delta: TicketDelta) => {
+      scheduleStats();
+      if (delta.op === 'delete') {
+        setTickets((prev) => prev.filter((ticket) => ticket.id !== delta.id));
+        return;
+      }
+      const { op, ...fields } = delta;
+      const createdAt = fields.created_at ? Date.parse(fields.created_at) : NaN;
+      // Más antiguo que lo cargado: aparecerá al pedir esa página
+      const beyondLoaded = oldestLoadedRef.current !== null && createdAt < Date.parse(oldestLoadedRef.current);
       setTickets((prev) => {
-        const index = prev.findIndex((t) => t.id === incoming.id);
+        const index = prev.findIndex((t) => t.id === delta.id);
         if (index >= 0) {
           const next = [...prev];
-          next[index] = incoming;
+          next[index] = { ...prev[index], ...fields };
           return next;
         }
-        return [incoming, ...prev];
+        // Un ticket desconocido solo se agrega si el delta trae la fila completa
+        if (Number.isNaN(createdAt) || fields.description === undefined || beyondLoaded) return prev;
+        const ticket = { category: null, sentiment: null, processed: false, ...fields } as Ticket;
+        const position = prev.findIndex((t) => Date.parse(t.created_at) < createdAt);
+        return position < 0 ? [...prev, ticket] : [...prev.slice(0, position), ticket, ...prev.slice(position)];
       });
+      // Un ticket desconocido con la fila completa es un alta
+      if (op === 'upsert' && !Number.isNaN(createdAt) && fields.description !== undefined && !beyondLoaded && !knownIdsRef.current.has(delta.id)) {
+        knownIdsRef.current.add(delta.id);
+        addNotification('success', 'Nuevo ticket recibido');
+        jumpToFirstPage();
+      }
     };
 
-    const channel = supabase
-      .channel('tickets-realtime')
-      .on(
-        'postgres_changes',
-        { event: '*', schema: 'public', table: 'tickets' },
-        (payload) => {
-          if (payload.eventType === 'INSERT' && payload.new) {
-            upsertTicket(payload.new as Ticket);
-            addNotification('success', 'Nuevo ticket recibido');
-            jumpToFirstPage();
-            return;
-          }
-          if (payload.eventType === 'UPDATE' && payload.new) {
-            upsertTicket(payload.new as Ticket);
-            return;
-          }
-          if (payload.eventType === 'DELETE' && payload.old) {
-            setTickets((prev) =>
-              prev.filter((ticket) => ticket.id !== (payload.old as Ticket).id)
-            );
-            return;
-          }
-          fetchTickets();
-        }
-      )
-      .subscribe((status) => setRealtimeStatus(status));
+    // EventSource reconecta solo y envía Last-Event-ID para reanudar sin perder cambios
+    const events = new EventSource(`${API_URL}/tickets/events`);
+    events.onopen = () => setRealtimeStatus('SUBSCRIBED');
+    events.onerror = () => setRealtimeStatus('CONNECTING');
+    events.addEventListener('tickets', (message) => {
+      const frame = JSON.parse((message as MessageEvent).data) as { events: TicketDelta[] };
+      frame.events.forEach(applyDelta);
+    });
+    // El servidor ya no tiene el hueco (o se reinició): volver a cargar el snapshot
+    events.addEventListener('reset', () => {
+      fetchTickets();
+    });
 
     return () => {
-      supabase.removeChannel(channel);
+      events.close();
+      if (statsTimerRef.current) clearTimeout(statsTimerRef.current);
     };
   }, []);
 
@@ -307,7 +394,18 @@ export default function App() {
     ticket.category?.toLowerCase().includes(searchTerm.toLowerCase())
   );
 
-  const totalPages = Math.ceil(filteredTickets.length / itemsPerPage);
+  const totalPages = Math.max(1, Math.ceil(filteredTickets.length / itemsPerPage));
+  // Siguiente en la última página cargada pide la próxima al API
+  const hasNextPage = currentPage < totalPages || nextCursor !== null;
+
+  const goToNextPage = async () => {
+    if (currentPage < totalPages) {
+      setCurrentPage(currentPage + 1);
+      return;
+    }
+    if (await loadMore()) setCurrentPage(currentPage + 1);
+  };
+
   const startIndex = (currentPage - 1) * itemsPerPage;
   const paginatedTickets = filteredTickets.slice(startIndex, startIndex + itemsPerPage);
 
@@ -380,7 +478,15 @@ export default function App() {
           className="card"
         >
           <div className="flex items-center justify-between px-1 py-3 border-b border-slate-800">
-            <h2 className="font-semibold">Tickets ({filteredTickets.length})</h2>
+            <div>
+              <h2 className="font-semibold">Tickets ({searchTerm ? filteredTickets.length : stats?.total ?? tickets.length})</h2>
+              {stats && (
+                <div className="text-xs text-gray-500 dark:text-gray-400">
+                  {stats.processed} procesados · {stats.pending} pendientes
+                  {Object.entries(stats.by_sentiment).map(([sentiment, total]) => ` · ${total} ${sentiment.toLowerCase()}`).join('')}
+                </div>
+              )}
+            </div>
             <div className="flex items-center gap-2">
               <div className="relative">
                 <Search className="absolute left-3 top-1/2 transform -translate-y-1/2 w-4 h-4 text-slate-500" />
@@ -454,7 +560,7 @@ export default function App() {
                 ))}
               </AnimatePresence>
             </div>
-            {totalPages > 1 && (
+            {(totalPages > 1 || nextCursor !== null) && (
               <div className="flex items-center justify-center gap-2 mt-6">
                 <button
                   onClick={() => setCurrentPage(prev => Math.max(prev - 1, 1))}
@@ -464,14 +570,14 @@ export default function App() {
                   Anterior
                 </button>
                 <span className="text-gray-600 dark:text-gray-400 text-sm">
-                  Página {currentPage} de {totalPages}
+                  Página {currentPage} de {totalPages}{nextCursor !== null ? '+' : ''}
                 </span>
                 <button
-                  onClick={() => setCurrentPage(prev => Math.min(prev + 1, totalPages))}
-                  disabled={currentPage === totalPages}
+                  onClick={goToNextPage}
+                  disabled={!hasNextPage || loadingMore}
                   className="btn-primary disabled:opacity-50 px-3 py-1 text-sm"
                 >
-                  Siguiente
+                  {loadingMore ? 'Cargando...' : 'Siguiente'}
                 </button>
               </div>
             )}
@@ -0,0 +1,435 @@
+"""
+Benchmark offline del pipeline de clasificación.
+
+Levanta un servidor OpenAI-compatible falso (latencia, tasa de error y tasa de
+JSON malformado configurables) y un Supabase en memoria, y mide:
+
+- carga sobre classify_ticket, /process-ticket y /create-ticket a distintos
+  niveles de concurrencia: throughput, p50/p95/p99, tasa de fallback y
+  llamadas al LLM por ticket;
+- micro-benchmarks de classify_with_rules, normalize_text y
+  parse_json_from_text sobre un corpus sintético en español; las reglas se
+  comparan con la implementación original (filas ``legacy_*`` y
+  ``speedup_vs_legacy``).
+
+Uso:
+    python benchmark.py --concurrency 1,16,64 --requests 500
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --max-regression 0.2   # falla si hay regresión
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import timeit
+import uuid
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+TEMPLATES = [
+    "No puedo iniciar sesión, la contraseña no funciona desde ayer",
+    "Me cobraron dos veces la factura de este mes, necesito un reembolso",
+    "La app está muy lenta cuando abro el dashboard de reportes",
+    "¿Tienen descuentos para empresas? Queremos cotizar el plan anual",
+    "El webhook de Slack dejó de enviar notificaciones",
+    "Gracias, el equipo de soporte resolvió todo perfecto",
+    "Quiero que agreguen exportación a Excel en la pantalla de ventas",
+    "Recibí un correo de phishing haciéndose pasar por ustedes",
+    "En Android la aplicación se cae al subir una foto",
+    "El botón de guardar no se ve bien en modo oscuro",
+    "Necesito cambiar el correo de mi cuenta de usuario",
+    "Error 500 al generar el reporte mensual, es un bug grave",
+]
+
+FILLER = (
+    "el sistema muestra datos del mes anterior cuando selecciono el filtro por fecha "
+    "y luego vuelve a la vista principal sin guardar los cambios de configuración "
+).split()
+
+
+def build_corpus(size: int, length: int, seed: int = 42) -> list:
+    """Tickets sintéticos: plantilla + relleno hasta ``length`` caracteres."""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        text = rng.choice(TEMPLATES)
+        while len(text) < length:
+            text += " " + rng.choice(FILLER)
+        corpus.append(f"{text[:length]} #{i}")
+    return corpus
+
+
+# ===== LLM FALSO =====
+
+def build_fake_llm(latency_ms: float, error_rate: float, malformed_rate: float, seed: int = 7) -> FastAPI:
+    import main
+
+    rng = random.Random(seed)
+    fake = FastAPI()
+    fake.state.calls = 0
+
+    def label(text: str) -> dict:
+        return main.classify_with_rules(text)
+
+    @fake.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        fake.state.calls += 1
+        await asyncio.sleep(latency_ms / 1000.0)
+        if rng.random() < error_rate:
+            return JSONResponse(status_code=503, content={"error": {"message": "overloaded"}})
+        prompt = "\n".join(
+            m["content"] for m in body.get("messages", []) if isinstance(m.get("content"), str)
+        )
+        if rng.random() < malformed_rate:
+            content = "Claro, el ticket parece ser de la categoría Técnico."
+        else:
+            numbered = re.findall(r"^\[(\d+)\] (.*)$", prompt, re.MULTILINE)
+            if numbered:
+                content = json.dumps(
+                    [{"id": int(n), **label(text)} for n, text in numbered], ensure_ascii=False
+                )
+            else:
+                ticket = re.split(r"Ticket(?: a clasificar)?:", prompt)[-1]
+                content = json.dumps(label(ticket), ensure_ascii=False)
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    return fake
+
+
+def start_server(app: FastAPI) -> tuple:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, port
+
+
+# ===== SUPABASE EN MEMORIA =====
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+        self.count = len(data)
+
+
+class _Query:
+    def __init__(self, store: "MemorySupabase"):
+        self.store = store
+        self.op = "select"
+        self.http_method = "GET"
+        self.payload = None
+        self.filters = []
+        self.params = httpx.QueryParams()
+        self.headers = {}
+
+    def insert(self, payload, **kwargs):
+        self.op, self.http_method, self.payload = "insert", "POST", payload
+        return self
+
+    def upsert(self, payload, **kwargs):
+        self.op, self.http_method, self.payload = "upsert", "POST", payload
+        self.headers = {"Prefer": "resolution=merge-duplicates"}
+        return self
+
+    def update(self, payload, **kwargs):
+        self.op, self.http_method, self.payload = "update", "PATCH", payload
+        return self
+
+    def delete(self, **kwargs):
+        self.op, self.http_method = "delete", "DELETE"
+        return self
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def __getattr__(self, name):
+        # order/limit/lt/or_ y demás modificadores no afectan al benchmark
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(self.store.latency)
+        rows = self.store.rows
+        if self.op in ("insert", "upsert"):
+            items = self.payload if isinstance(self.payload, list) else [self.payload]
+            out = []
+            for item in items:
+                row = dict(item)
+                row.setdefault("id", str(uuid.uuid4()))
+                rows.setdefault(row["id"], {}).update(row)
+                out.append(dict(rows[row["id"]]))
+            return _Result(out)
+        matched = [row for row in rows.values() if all(f(row) for f in self.filters)]
+        if self.op == "update":
+            for row in matched:
+                row.update(self.payload)
+        elif self.op == "delete":
+            for row in matched:
+                rows.pop(row["id"], None)
+        return _Result([dict(row) for row in matched])
+
+
+class MemorySupabase:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000.0
+        self.rows = {}
+
+    def table(self, name: str) -> _Query:
+        return _Query(self)
+
+
+# ===== CARGA =====
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_load(target: str, corpus: list, concurrency: int, requests_total: int, fake: FastAPI) -> dict:
+    import main
+
+    sources = []
+    original_classify = main.classify_ticket
+
+    async def recording_classify(description: str) -> dict:
+        result = await original_classify(description)
+        sources.append(result.get("source"))
+        return result
+
+    main.classify_ticket = recording_classify
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=main.app)
+    calls_before = fake.state.calls
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i: int):
+            nonlocal errors
+            description = corpus[i % len(corpus)]
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    if target == "classify":
+                        await main.classify_ticket(description)
+                    else:
+                        response = await client.post(f"/{target}", json={"description": description})
+                        response.raise_for_status()
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests_total)))
+        elapsed = time.perf_counter() - started
+
+    main.classify_ticket = original_classify
+    llm_calls = fake.state.calls - calls_before
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": requests_total,
+        "errors": errors,
+        "throughput_rps": round(requests_total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "fallback_rate": round(sources.count("rules") / len(sources), 4) if sources else 0.0,
+        "llm_calls_per_ticket": round(llm_calls / requests_total, 3),
+    }
+
+
+# ===== MICRO-BENCHMARKS =====
+
+# Implementación original de las reglas (antes del matcher precompilado), solo
+# como referencia para medir la mejora en la misma máquina
+_LEGACY_SLANG = {
+    r"\brey\b": "",
+    r"\bbro\b": "",
+    r"\bmalísimo\b": "muy malo",
+    r"\bmalisimo\b": "muy malo",
+    r"\bno sirve\b": "no funciona",
+    r"\bapp\b": "aplicacion",
+}
+
+
+def legacy_normalize_text(text: str) -> str:
+    normalized = text.lower()
+    for pattern, replacement in _LEGACY_SLANG.items():
+        normalized = re.sub(pattern, replacement, normalized, flags=re.IGNORECASE)
+    return re.sub(r"\s+", " ", normalized).strip()
+
+
+def legacy_classify_with_rules(text: str) -> dict:
+    import main
+
+    text_lower = text.lower()
+    category = "Técnico"
+    for name, keywords in main.CATEGORY_RULES:
+        if any(k in text_lower for k in keywords):
+            category = name
+            break
+    sentiment = "Neutral"
+    if any(k in text_lower for k in main.NEGATIVE_KEYWORDS):
+        sentiment = "Negativo"
+    if any(k in text_lower for k in main.POSITIVE_KEYWORDS):
+        sentiment = "Positivo"
+    return {"category": category, "sentiment": sentiment}
+
+
+def micro_benchmarks(sizes: list) -> list:
+    import main
+
+    results = []
+    json_samples = {
+        "clean": '{"category": "Técnico", "sentiment": "Negativo"}',
+        "prose": 'Claro, aquí está: {"category": "Técnico", "sentiment": "Negativo"} espero que sirva',
+        "fenced": 'Respuesta:\n```json\n{"category": "Técnico", "sentiment": "Negativo"}\n```',
+    }
+    for size in sizes:
+        corpus = build_corpus(200, size)
+        normalized = [main.normalize_text(text) for text in corpus]
+        timings = {}
+        for name, func, inputs in (
+            ("legacy_normalize_text", legacy_normalize_text, corpus),
+            ("legacy_classify_with_rules", legacy_classify_with_rules, normalized),
+            ("legacy_rules_pipeline", lambda t: legacy_classify_with_rules(legacy_normalize_text(t)), corpus),
+            ("normalize_text", main.normalize_text, corpus),
+            ("classify_with_rules", main.classify_with_rules, normalized),
+            ("rules_pipeline", lambda t: main.classify_with_rules(main.normalize_text(t), normalized=True), corpus),
+        ):
+            timer = timeit.Timer(lambda: [func(text) for text in inputs])
+            loops, _ = timer.autorange()
+            best = min(timer.repeat(repeat=3, number=loops)) / (loops * len(inputs))
+            timings[name] = best
+            row = {"name": name, "size": size, "us_per_call": round(best * 1e6, 2)}
+            legacy = timings.get(f"legacy_{name}")
+            if legacy:
+                row["speedup_vs_legacy"] = round(legacy / best, 2)
+            results.append(row)
+    for name, sample in json_samples.items():
+        timer = timeit.Timer(lambda: main.parse_json_from_text(sample))
+        loops, _ = timer.autorange()
+        best = min(timer.repeat(repeat=3, number=loops)) / loops
+        results.append({"name": f"parse_json_from_text[{name}]", "size": len(sample), "us_per_call": round(best * 1e6, 2)})
+    return results
+
+
+# ===== REGRESIONES =====
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """Lista de regresiones respecto al baseline (latencias y throughput)."""
+    regressions = []
+    base_load = {(r["target"], r["concurrency"]): r for r in baseline.get("load", [])}
+    for row in results.get("load", []):
+        base = base_load.get((row["target"], row["concurrency"]))
+        if not base:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if base[key] and row[key] > base[key] * (1 + max_regression):
+                regressions.append(f"{row['target']}@{row['concurrency']} {key}: {base[key]} -> {row[key]}")
+        if base["throughput_rps"] and row["throughput_rps"] < base["throughput_rps"] * (1 - max_regression):
+            regressions.append(
+                f"{row['target']}@{row['concurrency']} throughput_rps: {base['throughput_rps']} -> {row['throughput_rps']}"
+            )
+    base_micro = {(r["name"], r["size"]): r for r in baseline.get("micro", [])}
+    for row in results.get("micro", []):
+        base = base_micro.get((row["name"], row["size"]))
+        if base and row["us_per_call"] > base["us_per_call"] * (1 + max_regression):
+            regressions.append(f"{row['name']}[{row['size']}]: {base['us_per_call']}us -> {row['us_per_call']}us")
+    return regressions
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de clasificación")
+    parser.add_argument("--targets", default="classify,process-ticket,create-ticket")
+    parser.add_argument("--concurrency", default="1,16,64")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--ticket-length", type=int, default=300)
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-malformed-rate", type=float, default=0.0)
+    parser.add_argument("--supabase-latency-ms", type=float, default=5)
+    parser.add_argument("--micro-sizes", default="200,2048")
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--cache", action="store_true", help="Mantener la caché de clasificaciones activa")
+    parser.add_argument("--output", help="Guardar resultados en JSON")
+    parser.add_argument("--baseline", help="JSON de una corrida anterior para detectar regresiones")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Configurar el entorno antes de que main construya sus clientes
+    os.environ["N8N_WEBHOOK_URL"] = ""
+    os.environ.setdefault("CLASSIFY_CACHE_ENABLED", "true" if args.cache else "false")
+    os.environ.setdefault("JOB_QUEUE_ENABLED", "false")
+    fake = build_fake_llm(args.llm_latency_ms, args.llm_error_rate, args.llm_malformed_rate)
+    server, port = start_server(fake)
+    os.environ["LLM_API_BASE_URL"] = f"http://127.0.0.1:{port}/v1/chat/completions"
+
+    import logging
+    import main
+
+    logging.getLogger("main").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    main.clients._supabase = MemorySupabase(args.supabase_latency_ms)
+    main.clients._llm = main._build_llm_client()
+    main.clients._loaded = True
+
+    results = {"config": vars(args), "load": [], "micro": []}
+    if not args.skip_load:
+        corpus = build_corpus(max(args.requests, 1), args.ticket_length)
+
+        async def load_all():
+            for target in args.targets.split(","):
+                for concurrency in (int(c) for c in args.concurrency.split(",")):
+                    row = await run_load(target.strip(), corpus, concurrency, args.requests, fake)
+                    results["load"].append(row)
+                    print(json.dumps(row, ensure_ascii=False))
+            await main.close_async_http_client()
+
+        asyncio.run(load_all())
+    if not args.skip_micro:
+        for row in micro_benchmarks([int(s) for s in args.micro_sizes.split(",")]):
+            results["micro"].append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    server.should_exit = True
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print("\nRegresiones detectadas:")
+            for line in regressions:
+                print(f"  - {line}")
+            return 1
+        print("\nSin regresiones respecto al baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,5 @@
+# Permite importar main.py desde tests/ al ejecutar pytest en python-api/
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
@@ -1,44 +1,375 @@
+import asyncio
+import base64
+import codecs
+import concurrent.futures
+import contextvars
+import hashlib
+import importlib.util
+import itertools
 import json
 import logging
 import os
+import random
 import re
+import sqlite3
+import tempfile
+import threading
 import time
+import zlib
+from collections import Counter as TallyCounter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from typing import Optional
 
+import httpx
 import requests
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from supabase import create_client, Client
+from postgrest.types import ReturnMethod
+from supabase import acreate_client, create_client, Client
 from urllib.parse import urlparse
 
+try:
+    import ahocorasick
+except ImportError:  # Opcional: acelera KeywordMatcher
+    ahocorasick = None
+
+try:
+    import numpy as np
+except ImportError:  # Opcional: tier de vecinos más cercanos
+    np = None
+
+
+def _env_flag(name: str, default: str = "false") -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+_DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f"{name}={json.dumps(str(value))}" for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """Suma de las series que coinciden con las etiquetas dadas."""
+        with self._lock:
+            return sum(
+                value for key, value in self._values.items()
+                if all(key[self.label_names.index(k)] == str(v) for k, v in labels.items())
+            )
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = _DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: dict = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self, **labels) -> dict:
+        """count, media y cuantiles estimados (interpolación por bucket) de las series que coinciden."""
+        counts = [0] * len(self.buckets)
+        total = 0
+        value_sum = 0.0
+        with self._lock:
+            for key, (bucket_counts, count, series_sum) in self._series.items():
+                if all(key[self.label_names.index(k)] == str(v) for k, v in labels.items()):
+                    counts = [a + b for a, b in zip(counts, bucket_counts)]
+                    total += count
+                    value_sum += series_sum
+        result = {"count": total, "avg_ms": round(value_sum / total * 1000, 2) if total else None}
+        for q in (0.5, 0.95, 0.99):
+            result[f"p{int(q * 100)}_ms"] = self._quantile(counts, total, q)
+        return result
+
+    def _quantile(self, counts: list, total: int, q: float) -> Optional[float]:
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                fraction = (rank - cumulative) / count
+                return round((lower + (bound - lower) * fraction) * 1000, 2)
+            cumulative += count
+            lower = bound
+        return round(self.buckets[-1] * 1000, 2)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, value_sum) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                inf_labels = _format_labels(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf_labels} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {value_sum}")
+        return lines
+
+
+class MetricsRegistry:
+    """Registro mínimo de métricas en formato de exposición de Prometheus."""
+
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = _DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "ticket_stage_duration_seconds",
+    "Duración de cada etapa del pipeline de tickets",
+    ("stage",),
+)
+LLM_REQUEST_SECONDS = metrics.histogram(
+    "llm_request_duration_seconds",
+    "Latencia de las llamadas al backend LLM",
+    ("model", "endpoint"),
+)
+LLM_RESPONSES = metrics.counter(
+    "llm_responses_total",
+    "Respuestas del backend LLM por código HTTP",
+    ("model", "endpoint", "status"),
+)
+CLASSIFICATIONS = metrics.counter(
+    "classifications_total",
+    "Clasificaciones por origen del resultado (llm, cache, neighbors, local_model, rules)",
+    ("source",),
+)
+CLASSIFICATION_RETRIES = metrics.counter(
+    "classification_retries_total",
+    "Reintentos de clasificación con LLM",
+    ("model", "reason"),
+)
+CLASSIFICATION_FALLBACKS = metrics.counter(
+    "classification_fallbacks_total",
+    "Clasificaciones resueltas por reglas en lugar del LLM",
+    ("reason",),
+)
+CONFIDENCE_REJECTIONS = metrics.counter(
+    "classification_confidence_rejections_total",
+    "Respuestas del LLM descartadas por baja confianza",
+    ("model",),
+)
+N8N_RESPONSES = metrics.counter(
+    "n8n_webhook_responses_total",
+    "Respuestas del webhook de n8n por código HTTP",
+    ("status",),
+)
+LLM_STREAM_EARLY_STOPS = metrics.counter(
+    "llm_stream_early_stops_total",
+    "Respuestas en streaming cortadas al completarse el objeto de clasificación",
+    ("model",),
+)
+PROMPT_REQUESTS = metrics.counter(
+    "llm_prompt_requests_total",
+    "Llamadas al LLM por plantilla de prompt",
+    ("template",),
+)
+PROMPT_TOKENS = metrics.counter(
+    "llm_prompt_tokens_total",
+    "Tokens reportados por el backend (usage) por plantilla: prompt, cached (prefijo reutilizado) y completion",
+    ("template", "kind"),
+)
+COALESCED_REQUESTS = metrics.counter(
+    "classification_coalesced_total",
+    "Clasificaciones que reutilizaron una llamada al LLM ya en vuelo para el mismo texto",
+)
+RATE_LIMIT_SHED = metrics.counter(
+    "llm_rate_limit_shed_total",
+    "Peticiones al LLM descartadas por el limitador",
+    ("reason",),
+)
+HTTP_REQUESTS = metrics.counter(
+    "http_requests_total",
+    "Requests atendidas por la API",
+    ("method", "endpoint", "status"),
+)
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds",
+    "Latencia de las requests atendidas por la API",
+    ("method", "endpoint"),
+)
+
+
+def _http2_available() -> bool:
+    """HTTP/2 solo si está habilitado y el paquete h2 está instalado."""
+    if not _env_flag("LLM_HTTP2", "true"):
+        return False
+    return importlib.util.find_spec("h2") is not None
+
+
+_async_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Cliente HTTP asíncrono compartido (keep-alive + pool) para el LLM."""
+    global _async_http_client
+    if _async_http_client is None or _async_http_client.is_closed:
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "200")),
+            max_keepalive_connections=int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "50")),
+            keepalive_expiry=float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "30")),
+        )
+        timeout = httpx.Timeout(
+            float(os.getenv("LLM_TIMEOUT", "30")),
+            connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+        )
+        _async_http_client = httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=_http2_available(),
+        )
+    return _async_http_client
+
+
+# Clientes reemplazados en un reload que aún pueden tener llamadas en vuelo
+_retiring_http_clients: dict = {}
+
+
+def retire_async_http_client(grace: Optional[float] = None):
+    """Desacopla el cliente compartido sin cortar las llamadas en vuelo.
+
+    Las llamadas nuevas crean otro cliente en ``get_async_http_client``; el
+    anterior se cierra tras ``grace`` segundos (por defecto LLM_TIMEOUT + 5),
+    cuando cualquier petición que lo estuviera usando ya terminó o expiró.
+    """
+    global _async_http_client
+    previous, _async_http_client = _async_http_client, None
+    if previous is None:
+        return
+    if grace is None:
+        grace = float(os.getenv("LLM_TIMEOUT", "30")) + 5.0
+
+    async def close_later():
+        try:
+            await asyncio.sleep(grace)
+        finally:
+            _retiring_http_clients.pop(task, None)
+            await previous.aclose()
+
+    task = asyncio.create_task(close_later())
+    _retiring_http_clients[task] = previous
+
+
+async def close_async_http_client():
+    global _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+    for task, client in list(_retiring_http_clients.items()):
+        task.cancel()
+        await client.aclose()
+    _retiring_http_clients.clear()
+
+
 class OpenAICompatibleAPI:
     """Wrapper para endpoints OpenAI-compatible (HF Router o vLLM)."""
     def __init__(self, model: str, base_url: str, token: Optional[str] = None):
         self.model = model
         self.token = token
         self.api_url = base_url
+        self.temperature = float(os.getenv("LLM_TEMPERATURE", "0.1"))
+        self.max_tokens = int(os.getenv("LLM_MAX_TOKENS", "200"))
+        # none | json_schema (response_format) | json_object | guided_json (vLLM)
+        self.structured_output = os.getenv("LLM_STRUCTURED_OUTPUT", "none").strip().lower()
+        # SSE: corta la generación en cuanto llega un objeto de clasificación completo
+        self.streaming = _env_flag("LLM_STREAMING")
+        self.stream_usage = True
         self.headers = {"Content-Type": "application/json"}
         if token:
             self.headers["Authorization"] = f"Bearer {token}"
 
-    def _build_chat_payload(self, prompt: str) -> dict:
+    def _build_chat_payload(self, prompt: str, max_tokens: Optional[int] = None, system: Optional[str] = None) -> dict:
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": prompt})
         return {
             "model": self.model,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": float(os.getenv("LLM_TEMPERATURE", "0.1")),
-            "max_tokens": int(os.getenv("LLM_MAX_TOKENS", "200"))
+            "messages": messages,
+            "temperature": self.temperature,
+            "max_tokens": max_tokens or self.max_tokens
         }
 
-    def _build_completion_payload(self, prompt: str) -> dict:
+    def _build_completion_payload(self, prompt: str, max_tokens: Optional[int] = None, system: Optional[str] = None) -> dict:
         return {
             "model": self.model,
-            "prompt": prompt,
-            "temperature": float(os.getenv("LLM_TEMPERATURE", "0.1")),
-            "max_tokens": int(os.getenv("LLM_MAX_TOKENS", "200"))
+            # El system va primero para que el prefijo sea idéntico entre peticiones
+            "prompt": f"{system}\n\n{prompt}" if system else prompt,
+            "temperature": self.temperature,
+            "max_tokens": max_tokens or self.max_tokens
         }
 
     def _extract_text(self, result: dict) -> Optional[str]:
@@ -54,18 +385,160 @@ class OpenAICompatibleAPI:
             return choices[0]["text"]
         return None
 
-    def invoke(self, prompt: str) -> str:
-        """Invoca el modelo y retorna la respuesta."""
+    def _apply_structured_output(self, payload: dict, schema: dict) -> dict:
+        """Restringe la decodificación del backend al esquema (si el modo está activo)."""
+        mode = self.structured_output
+        if mode == "json_schema":
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "ticket_classification", "schema": schema, "strict": True},
+            }
+        elif mode == "json_object":
+            payload["response_format"] = {"type": "json_object"}
+        elif mode == "guided_json":
+            payload["guided_json"] = schema
+        return payload
+
+    def _build_payload(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        schema: Optional[dict] = None,
+        system: Optional[str] = None,
+    ) -> dict:
         is_chat_endpoint = self.api_url.rstrip("/").endswith("/v1/chat/completions")
-        payload = self._build_chat_payload(prompt) if is_chat_endpoint else self._build_completion_payload(prompt)
+        if is_chat_endpoint:
+            payload = self._build_chat_payload(prompt, max_tokens, system)
+        else:
+            payload = self._build_completion_payload(prompt, max_tokens, system)
+        if schema is not None:
+            self._apply_structured_output(payload, schema)
+        return payload
 
+    def invoke(self, prompt: str) -> str:
+        """Invoca el modelo y retorna la respuesta."""
         response = requests.post(
             self.api_url,
-            json=payload,
+            json=self._build_payload(prompt),
             headers=self.headers,
             timeout=30
         )
-        
+        return self._handle_response(response)
+
+    async def ainvoke(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        schema: Optional[dict] = None,
+        system: Optional[str] = None,
+    ) -> str:
+        """Versión asíncrona de invoke sobre el pool HTTP compartido.
+
+        Con ``schema`` (llamada de clasificación) y LLM_STREAMING activo la respuesta
+        se pide por SSE y se corta al completarse el objeto JSON. ``system`` va como
+        mensaje system fijo (prefijo cacheable por vLLM y por el proveedor).
+        """
+        structured = schema is not None and self.structured_output != "none"
+        streaming = schema is not None and self.streaming
+        response, text = await self._asend(self._build_payload(prompt, max_tokens, schema, system), streaming)
+        if structured and response.status_code == 400:
+            # Un 400 también puede ser prompt demasiado largo, max_tokens inválido...:
+            # solo se desactiva el modo si el error nombra la salida estructurada
+            if self._rejects_structured_output(response):
+                logger.warning(
+                    f"LLM: Backend rejected structured output mode '{self.structured_output}', disabling it"
+                )
+                self.structured_output = "none"
+            response, text = await self._asend(self._build_payload(prompt, max_tokens, system=system), streaming)
+        if text is not None:
+            return text
+        return self._handle_response(response)
+
+    _STRUCTURED_OUTPUT_MARKERS = ("response_format", "guided_json", "json_schema")
+
+    @classmethod
+    def _rejects_structured_output(cls, response) -> bool:
+        try:
+            body = response.text.lower()
+        except Exception:
+            return False
+        return any(marker in body for marker in cls._STRUCTURED_OUTPUT_MARKERS)
+
+    async def _asend(self, payload: dict, streaming: bool) -> tuple:
+        """Devuelve (response, texto); texto es None si hay que pasar por _handle_response."""
+        client = get_async_http_client()
+        if not streaming:
+            response = await client.post(self.api_url, json=payload, headers=self.headers)
+            return response, None
+        stream_payload = {**payload, "stream": True}
+        if self.stream_usage:
+            # El usage llega en el último chunk: alimenta las métricas por plantilla
+            stream_payload["stream_options"] = {"include_usage": True}
+        async with client.stream("POST", self.api_url, json=stream_payload, headers=self.headers) as response:
+            if response.status_code >= 400 or "text/event-stream" not in response.headers.get("content-type", ""):
+                # Error o backend que ignora "stream": respuesta completa normal
+                await response.aread()
+                if self.stream_usage and response.status_code == 400 and "stream_options" in response.text:
+                    logger.warning("LLM: Backend rejected stream_options, streaming without usage")
+                    self.stream_usage = False
+                    return await self._asend(payload, streaming)
+                return response, None
+            return response, await self._read_stream(response)
+
+    async def _read_stream(self, response) -> str:
+        """Acumula los deltas SSE y se detiene en el primer objeto con category y sentiment.
+
+        Tras el objeto se sigue leyendo solo mientras no llegue más texto: si el
+        backend cierra (finish + chunk de ``usage``) se registra el usage; si el
+        modelo sigue generando, se corta ahí.
+        """
+        scanner = JsonObjectScanner()
+        parts = []
+        found = None
+        usage = None
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(chunk, dict) and isinstance(chunk.get("usage"), dict):
+                usage = chunk["usage"]
+            try:
+                choice = chunk["choices"][0]
+            except (KeyError, IndexError, TypeError):
+                if found is not None and usage is not None:
+                    break
+                continue
+            delta = choice.get("delta") or {}
+            piece = delta.get("content") if isinstance(delta, dict) else None
+            if piece is None:
+                piece = choice.get("text")
+            if not piece:
+                continue
+            if found is not None:
+                # Salir del contexto cierra la conexión: el backend deja de generar
+                LLM_STREAM_EARLY_STOPS.inc(model=self.model)
+                break
+            parts.append(piece)
+            for candidate in scanner.feed(piece):
+                try:
+                    parsed = json.loads(candidate)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(parsed, dict) and "category" in parsed and "sentiment" in parsed:
+                    found = candidate
+                    break
+        if usage is not None:
+            _record_prompt_usage({"usage": usage})
+        return found if found is not None else "".join(parts)
+
+    def _handle_response(self, response) -> str:
+        """Valida la respuesta (requests o httpx) y extrae el texto generado."""
         if response.status_code == 400:
             try:
                 error_body = response.json()
@@ -94,6 +567,7 @@ class OpenAICompatibleAPI:
         response.raise_for_status()
 
         result = response.json()
+        _record_prompt_usage(result)
         extracted = self._extract_text(result)
         if extracted is not None:
             return extracted
@@ -101,6 +575,304 @@ class OpenAICompatibleAPI:
         logger.warning(f"LLM: Unexpected response format: {result}")
         return str(result)
 
+
+class LLMBackend:
+    """Estado de un backend del pool: carga en vuelo, latencias recientes y salud."""
+
+    def __init__(self, client: OpenAICompatibleAPI, overflow: bool = False):
+        self.client = client
+        self.overflow = overflow
+        self.inflight = 0
+        self.ewma_latency: Optional[float] = None
+        self._latencies: deque = deque(maxlen=200)
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    @property
+    def url(self) -> str:
+        return self.client.api_url
+
+    def score(self) -> float:
+        # Menor es mejor: tiempo esperado si se encola detrás de lo que ya está en vuelo
+        latency = self.ewma_latency if self.ewma_latency is not None else 0.05
+        return (self.inflight + 1) * latency
+
+    def record(self, latency: float, ok: bool, eject_after: int):
+        self.requests += 1
+        if ok:
+            self.consecutive_failures = 0
+            self._latencies.append(latency)
+        else:
+            # Un fallo rápido no debe hacer parecer rápido al backend
+            latency = max(latency, 1.0)
+        self.ewma_latency = latency if self.ewma_latency is None else 0.8 * self.ewma_latency + 0.2 * latency
+        if ok:
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.healthy and self.consecutive_failures >= eject_after:
+            self.healthy = False
+            self.ejections += 1
+            logger.warning(f"LLM: Backend {self.url} ejected after {self.consecutive_failures} consecutive failures")
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def stats(self) -> dict:
+        p95 = self.latency_percentile(0.95)
+        return {
+            "url": self.url,
+            "model": self.client.model,
+            "overflow": self.overflow,
+            "healthy": self.healthy,
+            "inflight": self.inflight,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+        }
+
+
+class LLMBackendPool:
+    """Reparte las llamadas entre varios backends OpenAI-compatible.
+
+    Elige con power-of-two-choices sobre (en vuelo + 1) × latencia EWMA entre los
+    backends primarios sanos; los de overflow (p. ej. HF Router) solo se usan si
+    no queda ningún primario sano o todos están saturados. Un backend sale del
+    pool tras ``eject_after`` fallos seguidos y vuelve cuando pasa el health
+    check periódico. Con hedging, si la respuesta tarda más que el p95 del
+    backend se lanza una segunda petición a otro y gana la primera que responda.
+    Expone la misma interfaz que OpenAICompatibleAPI.
+    """
+
+    def __init__(
+        self,
+        backends: list,
+        max_inflight: int = 64,
+        eject_after: int = 3,
+        health_interval: float = 10.0,
+        hedge: bool = False,
+        hedge_min_delay: float = 0.2,
+    ):
+        self.backends = backends
+        self.max_inflight = max_inflight
+        self.eject_after = eject_after
+        self.health_interval = health_interval
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self._health_task: Optional[asyncio.Task] = None
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.overflow_requests = 0
+        # Interfaz de OpenAICompatibleAPI: modelo y límites del primer backend
+        first = backends[0].client
+        self.model = first.model
+        self.max_tokens = first.max_tokens
+        self.api_url = "pool"
+
+    @classmethod
+    def from_env(cls, token: Optional[str], default_model: str) -> Optional["LLMBackendPool"]:
+        """Construye el pool desde LLM_BACKENDS / LLM_OVERFLOW_BACKENDS (``url`` o ``url|modelo``)."""
+        backends = []
+        for env_name, overflow in (("LLM_BACKENDS", False), ("LLM_OVERFLOW_BACKENDS", True)):
+            for entry in os.getenv(env_name, "").split(","):
+                entry = entry.strip()
+                if not entry:
+                    continue
+                url, _, model = entry.partition("|")
+                if "huggingface.co" in urlparse(url).netloc and not token:
+                    logger.warning(f"LLM: Skipping backend {url} (token not configured)")
+                    continue
+                client = OpenAICompatibleAPI(model=model.strip() or default_model, base_url=url.strip(), token=token)
+                backends.append(LLMBackend(client, overflow=overflow))
+        if not backends:
+            return None
+        if all(backend.overflow for backend in backends):
+            for backend in backends:
+                backend.overflow = False
+        return cls(
+            backends,
+            max_inflight=int(os.getenv("LLM_BACKEND_MAX_INFLIGHT", "64")),
+            eject_after=int(os.getenv("LLM_BACKEND_EJECT_FAILURES", "3")),
+            health_interval=float(os.getenv("LLM_HEALTH_INTERVAL_SECONDS", "10")),
+            hedge=_env_flag("LLM_HEDGE_ENABLED"),
+            hedge_min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "200")) / 1000.0,
+        )
+
+    def _pick(self, exclude: Optional[LLMBackend] = None) -> Optional[LLMBackend]:
+        primaries = [
+            backend for backend in self.backends
+            if not backend.overflow and backend.healthy and backend is not exclude
+        ]
+        available = [backend for backend in primaries if backend.inflight < self.max_inflight]
+        if not available:
+            available = [
+                backend for backend in self.backends
+                if backend.overflow and backend.healthy and backend is not exclude
+            ] or primaries
+            if available and available[0].overflow:
+                self.overflow_requests += 1
+        if not available:
+            # Todo expulsado: se intenta igual con el menos cargado antes que fallar sin llamar
+            available = [backend for backend in self.backends if backend is not exclude]
+        if not available:
+            return None
+        if len(available) == 1:
+            return available[0]
+        first, second = random.sample(available, 2)
+        return first if first.score() <= second.score() else second
+
+    async def _call(self, backend: LLMBackend, prompt: str, **kwargs) -> str:
+        # Las métricas del LLM llevan el backend elegido; _invoke_llm no las repite para el pool
+        labels = {"model": backend.client.model, "endpoint": _llm_endpoint(backend.client)}
+        backend.inflight += 1
+        start_time = time.perf_counter()
+        try:
+            response = await backend.client.ainvoke(prompt, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except httpx.HTTPStatusError as e:
+            # 4xx distintos de 429 son errores de la petición, no del backend
+            status = e.response.status_code
+            elapsed = time.perf_counter() - start_time
+            backend.record(elapsed, status < 500 and status != 429, self.eject_after)
+            LLM_RESPONSES.inc(status=status, **labels)
+            LLM_REQUEST_SECONDS.observe(elapsed, **labels)
+            raise
+        except Exception:
+            elapsed = time.perf_counter() - start_time
+            backend.record(elapsed, False, self.eject_after)
+            LLM_RESPONSES.inc(status="error", **labels)
+            LLM_REQUEST_SECONDS.observe(elapsed, **labels)
+            raise
+        else:
+            elapsed = time.perf_counter() - start_time
+            backend.record(elapsed, True, self.eject_after)
+            LLM_RESPONSES.inc(status=200, **labels)
+            LLM_REQUEST_SECONDS.observe(elapsed, **labels)
+            return response
+        finally:
+            backend.inflight -= 1
+
+    def _hedge_delay(self, backend: LLMBackend) -> Optional[float]:
+        if not self.hedge:
+            return None
+        p95 = backend.latency_percentile(0.95)
+        if p95 is None:
+            return None
+        return max(self.hedge_min_delay, p95)
+
+    async def ainvoke(self, prompt: str, **kwargs) -> str:
+        # El lifespan ya lo arranca; aquí cubre usos sin app (benchmark, reclassify.py)
+        self.start()
+        backend = self._pick()
+        if backend is None:
+            raise RuntimeError("No LLM backends configured")
+        delay = self._hedge_delay(backend)
+        primary = asyncio.ensure_future(self._call(backend, prompt, **kwargs))
+        if delay is None:
+            return await primary
+        hedge: Optional[asyncio.Future] = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+            second_backend = self._pick(exclude=backend)
+            if second_backend is None:
+                return await primary
+            self.hedges_sent += 1
+            hedge = asyncio.ensure_future(self._call(second_backend, prompt, **kwargs))
+            pending = {primary, hedge}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def invoke(self, prompt: str) -> str:
+        """Versión síncrona (prueba de /diagnostics) sobre el mejor backend."""
+        backend = self._pick()
+        if backend is None:
+            raise RuntimeError("No LLM backends configured")
+        return backend.client.invoke(prompt)
+
+    async def _check(self, backend: LLMBackend) -> bool:
+        """Sanos: GET /models. Expulsados: necesitan completar una generación de 1 token."""
+        if not backend.healthy:
+            try:
+                await backend.client.ainvoke("ping", max_tokens=1)
+                return True
+            except Exception:
+                return False
+        base = backend.url.rstrip("/")
+        for suffix in ("/chat/completions", "/completions"):
+            if base.endswith(suffix):
+                base = base[: -len(suffix)]
+                break
+        try:
+            response = await get_async_http_client().get(
+                f"{base}/models", headers=backend.client.headers, timeout=5.0
+            )
+            return response.status_code < 500
+        except httpx.HTTPError:
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                results = await asyncio.gather(*(self._check(backend) for backend in self.backends))
+                for backend, ok in zip(self.backends, results):
+                    if ok and not backend.healthy:
+                        logger.info(f"LLM: Backend {backend.url} passed health check, back in pool")
+                        backend.consecutive_failures = 0
+                    elif not ok and backend.healthy:
+                        logger.warning(f"LLM: Backend {backend.url} failed health check, ejected")
+                        backend.ejections += 1
+                    backend.healthy = ok
+            except Exception as e:
+                logger.error(f"LLM: Health check pass failed - {type(e).__name__}: {e}")
+
+    def start(self):
+        """Arranca el health check, también con un solo backend: si lo expulsan solo
+        el health check lo devuelve al pool."""
+        if self._health_task is None:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def stats(self) -> dict:
+        return {
+            "backends": [backend.stats() for backend in self.backends],
+            "hedging": self.hedge,
+            "hedges_sent": self.hedges_sent,
+            "hedges_won": self.hedges_won,
+            "overflow_requests": self.overflow_requests,
+        }
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -109,7 +881,62 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="AI Support Co-Pilot")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_queue, sweeper, n8n_outbox, ticket_events, ticket_feed
+    clients.startup()
+    if isinstance(clients.llm(), LLMBackendPool):
+        clients.llm().start()
+    if _env_flag("TICKET_EVENTS_ENABLED", "true"):
+        ticket_events = TicketEventHub.from_env()
+        # Opt-in: exige tickets en la publicación supabase_realtime (supabase/setup.sql)
+        if _env_flag("TICKET_EVENTS_UPSTREAM"):
+            ticket_feed = SupabaseTicketFeed.from_env(ticket_events)
+            if ticket_feed is not None:
+                ticket_feed.start()
+    if _env_flag("JOB_QUEUE_ENABLED"):
+        job_queue = TicketJobQueue.from_env()
+        job_queue.start(int(os.getenv("JOB_QUEUE_WORKERS", "4")))
+    if _env_flag("SWEEPER_ENABLED"):
+        sweeper = UnprocessedSweeper.from_env()
+        sweeper.start()
+    if _env_flag("N8N_OUTBOX_ENABLED") and os.getenv("N8N_WEBHOOK_URL"):
+        n8n_outbox = N8nOutbox.from_env()
+        n8n_outbox.start()
+    bootstrap_task = None
+    if _env_flag("NEIGHBOR_ENABLED"):
+        neighbors = get_neighbor_index()
+        if neighbors is None:
+            logger.warning("Neighbors: numpy not installed, nearest-neighbour tier disabled")
+        elif _env_flag("NEIGHBOR_BOOTSTRAP") and not neighbors.count and get_supabase():
+            bootstrap_task = asyncio.create_task(neighbors.bootstrap(
+                get_supabase(), max_rows=int(os.getenv("NEIGHBOR_BOOTSTRAP_MAX_ROWS", "50000"))
+            ))
+    yield
+    if bootstrap_task is not None and not bootstrap_task.done():
+        bootstrap_task.cancel()
+    if _neighbor_index is not None:
+        _neighbor_index.close()
+    if sweeper is not None:
+        await sweeper.stop()
+        sweeper = None
+    if job_queue is not None:
+        await job_queue.stop()
+        job_queue = None
+    if n8n_outbox is not None:
+        await n8n_outbox.stop()
+        n8n_outbox = None
+    if ticket_feed is not None:
+        await ticket_feed.stop()
+        ticket_feed = None
+    if ticket_events is not None:
+        ticket_events.close()
+        ticket_events = None
+    await clients.close()
+
+
+app = FastAPI(title="AI Support Co-Pilot", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # En producción, especifica el dominio del frontend
@@ -119,6 +946,90 @@ app.add_middleware(
 )
 
 
+class MetricsMiddleware:
+    """Cuenta requests por método, ruta (plantilla) y status, y mide su duración completa."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_holder = {"status": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["status"] = message["status"]
+            await send(message)
+
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # La plantilla evita una serie por cada id de ticket
+            endpoint = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            HTTP_REQUESTS.inc(method=method, endpoint=endpoint, status=status_holder["status"])
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start_time, method=method, endpoint=endpoint)
+
+
+class BodySizeLimitMiddleware:
+    """Rechaza con 413 los cuerpos mayores a ``MAX_REQUEST_BODY_BYTES`` antes de parsearlos.
+
+    Con Content-Length se decide sin leer nada; los cuerpos chunked se leen
+    hasta el límite y se reenvían a la app. ``/tickets/bulk`` queda fuera: tiene
+    su propio parser incremental y límite por elemento.
+    """
+
+    EXEMPT_PATHS = ("/tickets/bulk",)
+
+    def __init__(self, app):
+        self.app = app
+        self.max_bytes = int(os.getenv("MAX_REQUEST_BODY_BYTES", "1048576"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes <= 0 or scope.get("path") in self.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        too_large = JSONResponse(status_code=413, content={"detail": f"Request body exceeds {self.max_bytes} bytes"})
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None:
+            if not content_length.isdigit() or int(content_length) > self.max_bytes:
+                await too_large(scope, receive, send)
+                return
+            await self.app(scope, receive, send)
+            return
+        if headers.get(b"transfer-encoding") is None:
+            await self.app(scope, receive, send)
+            return
+        messages, received = [], 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                await too_large(scope, receive, send)
+                return
+            if not message.get("more_body", False):
+                break
+        pending = deque(messages)
+
+        async def replay():
+            return pending.popleft() if pending else await receive()
+
+        await self.app(scope, replay, send)
+
+
+app.add_middleware(BodySizeLimitMiddleware)
+# El último agregado es el más externo: las métricas también cuentan los 413
+app.add_middleware(MetricsMiddleware)
+
+
 class TicketIn(BaseModel):
     ticket_id: Optional[str] = None
     description: str
@@ -130,7 +1041,7 @@ class TicketOut(BaseModel):
     processed: bool
 
 
-def get_supabase() -> Optional[Client]:
+def _build_supabase() -> Optional[Client]:
     url = os.getenv("SUPABASE_URL")
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
     if not url or not key:
@@ -138,9 +1049,14 @@ def get_supabase() -> Optional[Client]:
     return create_client(url, key)
 
 
-def llm_client() -> Optional[OpenAICompatibleAPI]:
+def _build_llm_client() -> Optional[OpenAICompatibleAPI]:
     token = os.getenv("HF_API_TOKEN") or os.getenv("LLM_API_TOKEN")
     model = os.getenv("HF_MODEL", "meta-llama/Llama-3.1-8B-Instruct")
+    if os.getenv("LLM_BACKENDS") or os.getenv("LLM_OVERFLOW_BACKENDS"):
+        pool = LLMBackendPool.from_env(token, model)
+        if pool is not None:
+            logger.info(f"LLM: Backend pool initialized with {len(pool.backends)} backends")
+            return pool
     base_url = os.getenv("LLM_API_BASE_URL", "https://router.huggingface.co/v1/chat/completions")
     requires_token = "huggingface.co" in urlparse(base_url).netloc
     if requires_token and not token:
@@ -155,6 +1071,105 @@ def llm_client() -> Optional[OpenAICompatibleAPI]:
         return None
 
 
+def _build_local_model():
+    path = os.getenv("LOCAL_MODEL_PATH")
+    if not path:
+        return None
+    if np is None:
+        logger.warning("Classification: numpy not installed, local model disabled")
+        return None
+    try:
+        model = LinearTicketClassifier.load(path)
+        logger.info(f"Classification: Local model {model.version} loaded from {path}")
+        return model
+    except Exception as e:
+        logger.error(f"Classification: Error loading local model - {type(e).__name__}: {e}")
+        return None
+
+
+class ClientRegistry:
+    """Clientes compartidos por todo el proceso (Supabase, LLM y modelo local).
+
+    Se construyen una sola vez (al arrancar la app o en el primer uso) y se
+    reutilizan entre requests. ``reload`` vuelve a leer la configuración para
+    rotar credenciales o cambiar de modelo sin reiniciar.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._supabase: Optional[Client] = None
+        self._llm: Optional[OpenAICompatibleAPI] = None
+        self._local_model = None
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._supabase = _build_supabase()
+            self._llm = _build_llm_client()
+            self._local_model = _build_local_model()
+            self._loaded = True
+
+    def supabase(self) -> Optional[Client]:
+        self._ensure_loaded()
+        return self._supabase
+
+    def llm(self) -> Optional[OpenAICompatibleAPI]:
+        self._ensure_loaded()
+        return self._llm
+
+    def local_model(self):
+        self._ensure_loaded()
+        return self._local_model
+
+    def startup(self):
+        self._ensure_loaded()
+
+    async def reload(self):
+        """Relee .env/variables de entorno y reconstruye los clientes."""
+        load_dotenv(override=True)
+        with self._lock:
+            previous_llm = self._llm
+            self._loaded = False
+            self._supabase = None
+            self._llm = None
+            self._local_model = None
+        if isinstance(previous_llm, LLMBackendPool):
+            await previous_llm.stop()
+        # El pool HTTP toma sus límites del entorno: se recrea en el próximo uso y
+        # el anterior se cierra cuando terminan las llamadas que lo usan
+        retire_async_http_client()
+        self._ensure_loaded()
+        if isinstance(self._llm, LLMBackendPool):
+            self._llm.start()
+        logger.info("Clients: Registry reloaded")
+
+    async def close(self):
+        with self._lock:
+            previous_llm = self._llm
+            self._supabase = None
+            self._llm = None
+            self._local_model = None
+            self._loaded = False
+        if isinstance(previous_llm, LLMBackendPool):
+            await previous_llm.stop()
+        await close_async_http_client()
+
+
+clients = ClientRegistry()
+
+
+def get_supabase() -> Optional[Client]:
+    return clients.supabase()
+
+
+def llm_client() -> Optional[OpenAICompatibleAPI]:
+    return clients.llm()
+
+
 def test_llm_connection() -> dict:
     """Test if LLM is working correctly"""
     llm = llm_client()
@@ -199,6 +1214,22 @@ def test_llm_connection() -> dict:
         }
 
 
+_llm_probe: dict = {"result": None, "checked_at": 0.0}
+_llm_probe_lock = threading.Lock()
+
+
+def cached_llm_status(force: bool = False) -> dict:
+    """Resultado de test_llm_connection reutilizado durante DIAGNOSTICS_PROBE_TTL_SECONDS."""
+    ttl = float(os.getenv("DIAGNOSTICS_PROBE_TTL_SECONDS", "300"))
+    with _llm_probe_lock:
+        age = time.time() - _llm_probe["checked_at"]
+        if force or _llm_probe["result"] is None or age >= ttl:
+            _llm_probe["result"] = test_llm_connection()
+            _llm_probe["checked_at"] = time.time()
+            age = 0.0
+        return {**_llm_probe["result"], "checked_seconds_ago": round(age, 1)}
+
+
 ALLOWED_CATEGORIES = {
     "Acceso",
     "Cuenta",
@@ -222,20 +1253,161 @@ def _simplify_text(value: str) -> str:
     )
 
 
+_SLANG_REPLACEMENTS = {
+    "rey": "",
+    "bro": "",
+    "malísimo": "muy malo",
+    "malisimo": "muy malo",
+    "no sirve": "no funciona",
+    "app": "aplicacion",
+}
+_SLANG_PATTERN = re.compile(
+    r"\b(?:" + "|".join(re.escape(word) for word in _SLANG_REPLACEMENTS) + r")\b"
+)
+# Subcadenas que deben estar presentes para que el patrón pueda coincidir
+_SLANG_HINTS = ("rey", "bro", "mal", "no sirve", "app")
+
+
 def normalize_text(text: str) -> str:
-    replacements = {
-        r"\brey\b": "",
-        r"\bbro\b": "",
-        r"\bmalísimo\b": "muy malo",
-        r"\bmalisimo\b": "muy malo",
-        r"\bno sirve\b": "no funciona",
-        r"\bapp\b": "aplicacion",
-    }
     normalized = text.lower()
-    for pattern, replacement in replacements.items():
-        normalized = re.sub(pattern, replacement, normalized, flags=re.IGNORECASE)
-    normalized = re.sub(r"\s+", " ", normalized).strip()
-    return normalized
+    if any(hint in normalized for hint in _SLANG_HINTS):
+        normalized = _SLANG_PATTERN.sub(lambda m: _SLANG_REPLACEMENTS[m.group(0)], normalized)
+    # isprintable() es False ante cualquier espacio que no sea " " (tabs, saltos, NBSP...)
+    if "  " in normalized or not normalized.isprintable():
+        return " ".join(normalized.split())
+    return normalized.strip()
+
+
+# Tokens aproximados: palabras (partidas cada 16 caracteres, así un blob sin
+# espacios no cuenta como un solo token) y signos sueltos
+_APPROX_TOKEN = re.compile(r"\w{1,16}|[^\w\s]")
+
+
+class InputBudget:
+    """Acota el texto que llega a los tiers de clasificación.
+
+    ``truncate`` conserva los primeros y los últimos tokens (el contexto suele
+    estar al inicio y el error al final de un log pegado) hasta ``max_tokens``.
+    Con ``chunked`` los textos largos se parten en segmentos de ``max_tokens``
+    y se clasifican el primero, el último y los de más palabras clave, para
+    combinar los resultados por votación. Cuenta tokens con la misma
+    aproximación que ``estimate_tokens`` sin recorrer todo el texto.
+    """
+
+    _TOKEN = _APPROX_TOKEN
+    # Cota de caracteres por token: limita la ventana del final y, como tope
+    # duro, los caracteres que conservan inicio y final
+    _MAX_TOKEN_CHARS = 16
+    # Segmentos examinados como máximo en modo chunked (el resto del medio se ignora)
+    _MAX_SCAN_SEGMENTS = 64
+
+    def __init__(self, max_tokens: int = 512, head_ratio: float = 0.7, chunked: bool = False, max_segments: int = 3):
+        self.max_tokens = max_tokens
+        self.head_ratio = min(max(head_ratio, 0.0), 1.0)
+        self.chunked = chunked
+        self.max_segments = max(max_segments, 1)
+        self.truncated = 0
+        self.chunked_tickets = 0
+
+    @classmethod
+    def from_env(cls) -> "InputBudget":
+        return cls(
+            max_tokens=int(os.getenv("LLM_INPUT_MAX_TOKENS", "512")),
+            head_ratio=float(os.getenv("LLM_INPUT_HEAD_RATIO", "0.7")),
+            chunked=_env_flag("LLM_CHUNKED_MODE"),
+            max_segments=int(os.getenv("LLM_CHUNK_MAX_SEGMENTS", "3")),
+        )
+
+    def _offset_after(self, text: str, tokens: int) -> Optional[int]:
+        """Fin del token número ``tokens`` o None si el texto tiene menos."""
+        for position, match in enumerate(self._TOKEN.finditer(text), start=1):
+            if position == tokens:
+                return match.end()
+        return None
+
+    def _tail_start(self, text: str, tokens: int) -> int:
+        window_start = max(0, len(text) - tokens * self._MAX_TOKEN_CHARS)
+        matches = list(self._TOKEN.finditer(text, window_start))
+        if not matches:
+            return len(text)
+        return matches[max(0, len(matches) - tokens)].start()
+
+    def exceeds(self, text: str) -> bool:
+        # Nunca hay más tokens que caracteres: los textos cortos no se recorren
+        if self.max_tokens <= 0 or len(text) <= self.max_tokens:
+            return False
+        if len(text) > self.max_tokens * self._MAX_TOKEN_CHARS:
+            return True
+        return self._offset_after(text, self.max_tokens + 1) is not None
+
+    def truncate(self, text: str) -> str:
+        if not self.exceeds(text):
+            return text
+        head_tokens = int(self.max_tokens * self.head_ratio)
+        head_end = self._offset_after(text, head_tokens) if head_tokens else 0
+        if head_end is not None:
+            head_end = min(head_end, head_tokens * self._MAX_TOKEN_CHARS)
+        tail_tokens = self.max_tokens - head_tokens
+        tail_start = self._tail_start(text, tail_tokens) if tail_tokens else len(text)
+        tail_start = max(tail_start, len(text) - tail_tokens * self._MAX_TOKEN_CHARS)
+        if head_end is None or tail_start <= head_end:
+            return text
+        self.truncated += 1
+        return f"{text[:head_end].rstrip()} … {text[tail_start:].lstrip()}".strip()
+
+    def segments(self, text: str) -> list:
+        """Segmentos a clasificar por votación (en orden de aparición) o [] si el texto cabe."""
+        if not self.chunked or not self.exceeds(text):
+            return []
+        # Misma medida que ``exceeds``: un segmento se cierra al llegar a
+        # ``max_tokens`` tokens o a la cota de caracteres (pocos tokens muy largos)
+        window = self.max_tokens * self._MAX_TOKEN_CHARS
+        tail_start = max(self._tail_start(text, self.max_tokens), len(text) - window)
+        bounds = [0]
+        tokens = 0
+        for match in self._TOKEN.finditer(text):
+            tokens += 1
+            if tokens >= self.max_tokens or match.end() - bounds[-1] >= window:
+                bounds.append(match.end())
+                tokens = 0
+                if match.end() >= tail_start or len(bounds) > self._MAX_SCAN_SEGMENTS:
+                    break
+        if len(bounds) < 2:
+            # Sin tokens que partir (p. ej. solo espacios): queda la truncación inicio+final
+            return []
+        head = text[:bounds[1]].strip()
+        middle = [text[start:end].strip() for start, end in zip(bounds[1:], bounds[2:]) if end <= tail_start]
+        self.chunked_tickets += 1
+        if self.max_segments == 1:
+            return [head]
+        # Del medio, los segmentos que disparan más grupos de palabras clave
+        ranked = sorted(
+            range(len(middle)),
+            key=lambda index: bin(_RULES_MATCHER.match(middle[index])).count("1"),
+            reverse=True,
+        )
+        chosen = sorted(ranked[:self.max_segments - 2])
+        return [head, *(middle[index] for index in chosen), text[tail_start:].strip()]
+
+    def stats(self) -> dict:
+        return {
+            "max_tokens": self.max_tokens,
+            "head_ratio": self.head_ratio,
+            "chunked": self.chunked,
+            "max_segments": self.max_segments,
+            "truncated": self.truncated,
+            "chunked_tickets": self.chunked_tickets,
+        }
+
+
+_input_budget: Optional[InputBudget] = None
+
+
+def get_input_budget() -> InputBudget:
+    global _input_budget
+    if _input_budget is None:
+        _input_budget = InputBudget.from_env()
+    return _input_budget
 
 
 def normalize_category(value: str) -> str:
@@ -282,66 +1454,195 @@ def normalize_sentiment(value: str) -> str:
     return normalized if normalized in ALLOWED_SENTIMENTS else ""
 
 
-def classify_with_rules(text: str) -> dict:
-    text_lower = text.lower()
-    category = "Técnico"
+# Orden = prioridad: gana la primera categoría con alguna coincidencia
+CATEGORY_RULES = (
+    ("Facturación", ("factura", "billing", "cobro", "pago", "suscripción", "reembolso")),
+    ("Acceso", ("login", "inicio de sesión", "contraseña", "bloqueo", "2fa", "otp")),
+    ("Cuenta", ("perfil", "cuenta", "usuario", "registro", "alta", "baja")),
+    ("Integraciones", ("api", "webhook", "zapier", "slack", "integración", "integraciones")),
+    ("Rendimiento", ("lento", "latencia", "demora", "performance", "rendimiento")),
+    ("UX/UI", ("diseño", "ui", "ux", "interfaz", "botón", "boton", "pantalla")),
+    ("Seguridad", ("phishing", "fraude", "seguridad", "vulnerabilidad", "hack")),
+    ("Solicitudes", ("quiero", "me gustaría", "feature", "mejorar", "solicitud")),
+    ("Comercial", ("precio", "plan", "cotización", "ventas", "comercial")),
+    ("Móvil", ("android", "ios", "móvil", "movil", "celular")),
+    ("Técnico", ("error", "fallo", "bug", "no funciona", "no sirve", "crash")),
+)
 
-    category_rules = [
-        ("Facturación", ["factura", "billing", "cobro", "pago", "suscripción", "reembolso"]),
-        ("Acceso", ["login", "inicio de sesión", "contraseña", "bloqueo", "2fa", "otp"]),
-        ("Cuenta", ["perfil", "cuenta", "usuario", "registro", "alta", "baja"]),
-        ("Integraciones", ["api", "webhook", "zapier", "slack", "integración", "integraciones"]),
-        ("Rendimiento", ["lento", "latencia", "demora", "performance", "rendimiento"]),
-        ("UX/UI", ["diseño", "ui", "ux", "interfaz", "botón", "boton", "pantalla"]),
-        ("Seguridad", ["phishing", "fraude", "seguridad", "vulnerabilidad", "hack"]),
-        ("Solicitudes", ["quiero", "me gustaría", "feature", "mejorar", "solicitud"]),
-        ("Comercial", ["precio", "plan", "cotización", "ventas", "comercial"]),
-        ("Móvil", ["android", "ios", "móvil", "movil", "celular"]),
-        ("Técnico", ["error", "fallo", "bug", "no funciona", "no sirve", "crash"]),
-    ]
+NEGATIVE_KEYWORDS = (
+    "no funciona",
+    "no sirve",
+    "no carga",
+    "se cae",
+    "error",
+    "fallo",
+    "mal",
+    "terrible",
+    "molesto",
+    "horrible",
+    "pésimo",
+    "pesimo",
+    "bug",
+    "fatal",
+)
 
-    for name, keywords in category_rules:
-        if any(k in text_lower for k in keywords):
-            category = name
-            break
+POSITIVE_KEYWORDS = ("gracias", "excelente", "genial", "perfecto", "bien", "buenísimo")
+
+
+class KeywordMatcher:
+    """Encuentra en una sola pasada qué grupos de palabras clave aparecen en un texto.
+
+    Cada grupo es un bit; ``match`` devuelve la máscara OR de los grupos con al
+    menos una subcadena presente. Con pyahocorasick instalado usa un autómata
+    Aho-Corasick; si no, búsquedas de subcadena precalculadas.
+    """
+
+    def __init__(self, groups):
+        self.labels = tuple(label for label, _ in groups)
+        self._groups = tuple((1 << bit, tuple(keywords)) for bit, (_, keywords) in enumerate(groups))
+        self._automaton = None
+        if ahocorasick is not None:
+            masks = {}
+            for bit, keywords in self._groups:
+                for keyword in keywords:
+                    masks[keyword] = masks.get(keyword, 0) | bit
+            automaton = ahocorasick.Automaton()
+            for keyword, mask in masks.items():
+                automaton.add_word(keyword, mask)
+            automaton.make_automaton()
+            self._automaton = automaton
+
+    def match(self, text: str, first_only: int = 0, stop_mask: int = 0) -> int:
+        """``first_only``: bits de los que solo interesa el primero encontrado
+        (en orden de grupo); permite cortar la búsqueda en el modo sin autómata.
+        ``stop_mask``: con todos esos bits presentes el resultado ya no puede
+        cambiar y el recorrido del autómata termina ahí."""
+        mask = 0
+        if self._automaton is not None:
+            previous = 0
+            for _, keyword_mask in self._automaton.iter(text):
+                # Palabras repetidas no aportan bits nuevos
+                if keyword_mask == previous:
+                    continue
+                previous = keyword_mask
+                mask |= keyword_mask
+                if stop_mask and mask & stop_mask == stop_mask:
+                    break
+            return mask
+        for bit, keywords in self._groups:
+            if bit & first_only and mask & first_only:
+                continue
+            for keyword in keywords:
+                if keyword in text:
+                    mask |= bit
+                    break
+        return mask
+
+
+_RULES_MATCHER = KeywordMatcher(
+    CATEGORY_RULES + (("Negativo", NEGATIVE_KEYWORDS), ("Positivo", POSITIVE_KEYWORDS))
+)
+_CATEGORY_MASK = (1 << len(CATEGORY_RULES)) - 1
+_NEGATIVE_BIT = 1 << len(CATEGORY_RULES)
+_POSITIVE_BIT = 1 << (len(CATEGORY_RULES) + 1)
+# Categoría de mayor prioridad + positivo: ninguna otra coincidencia cambia el resultado
+_RULES_STOP_MASK = 1 | _POSITIVE_BIT
+
+
+def classify_with_rules(text: str, normalized: bool = False) -> dict:
+    """``normalized``: el texto ya pasó por ``normalize_text`` (en minúsculas), no se vuelve a bajar."""
+    mask = _RULES_MATCHER.match(text if normalized else text.lower(), first_only=_CATEGORY_MASK, stop_mask=_RULES_STOP_MASK)
+
+    category = "Técnico"
+    category_bits = mask & _CATEGORY_MASK
+    if category_bits:
+        # El bit más bajo es la categoría de mayor prioridad
+        category = _RULES_MATCHER.labels[(category_bits & -category_bits).bit_length() - 1]
 
     sentiment = "Neutral"
-    if any(
-        k in text_lower
-        for k in [
-            "no funciona",
-            "no sirve",
-            "no carga",
-            "se cae",
-            "error",
-            "fallo",
-            "mal",
-            "terrible",
-            "molesto",
-            "horrible",
-            "pésimo",
-            "pesimo",
-            "bug",
-            "fatal",
-        ]
-    ):
+    if mask & _NEGATIVE_BIT:
         sentiment = "Negativo"
-    if any(k in text_lower for k in ["gracias", "excelente", "genial", "perfecto", "bien", "buenísimo"]):
+    if mask & _POSITIVE_BIT:
         sentiment = "Positivo"
 
     return {"category": category, "sentiment": sentiment}
 
 
+def _rules_fallback(normalized_text: str, reason: str = "no_llm") -> dict:
+    CLASSIFICATION_FALLBACKS.inc(reason=reason)
+    # Con modelo local cargado, su predicción sustituye a las reglas
+    local_model = clients.local_model()
+    if local_model is not None:
+        prediction = local_model.predict(normalized_text)
+        if prediction is not None:
+            return {"category": prediction["category"], "sentiment": prediction["sentiment"], "source": "local_model"}
+    return {**classify_with_rules(normalized_text, normalized=True), "source": "rules"}
+
+
+class JsonObjectScanner:
+    """Detecta objetos JSON de primer nivel en una sola pasada, admitiendo texto por trozos.
+
+    Respeta cadenas y escapes, así que llaves dentro de strings o texto alrededor
+    (prosa, bloques markdown) no rompen la detección. ``feed`` devuelve el texto
+    de cada objeto que se completa con el trozo recibido.
+    """
+
+    def __init__(self):
+        self._buffer: list = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> list:
+        completed = []
+        segment_start = 0
+        for index, char in enumerate(chunk):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                if self._depth:
+                    self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    segment_start = index
+                    self._buffer = []
+                self._depth += 1
+            elif char == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._buffer.append(chunk[segment_start:index + 1])
+                    completed.append("".join(self._buffer))
+                    self._buffer = []
+        if self._depth:
+            self._buffer.append(chunk[segment_start:])
+        return completed
+
+
 def parse_json_from_text(text: str) -> dict:
     text = text.strip()
     if not text:
         raise ValueError("Empty response")
     
-    # Primero intentar parsear el texto completo (caso más común: JSON limpio)
+    # Primero intentar parsear el texto completo (caso más común: JSON limpio
+    # o salida restringida por esquema)
     try:
         return json.loads(text)
     except json.JSONDecodeError:
         pass
+
+    # Escaneo en una pasada: primer objeto balanceado que sea JSON válido
+    for candidate in JsonObjectScanner().feed(text):
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(parsed, dict):
+            return parsed
     
     # Si no es JSON puro, buscar JSON dentro del texto
     json_match = re.search(r"\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}", text, re.DOTALL)
@@ -369,21 +1670,36 @@ def parse_json_from_text(text: str) -> dict:
     raise ValueError("No valid JSON found in response")
 
 
-def classify_ticket(description: str) -> dict:
-    normalized_text = normalize_text(description)
-    llm = llm_client()
-    if not llm:
-        logger.info("Classification: Using rules fallback (LLM not available)")
-        return classify_with_rules(normalized_text)
+def parse_json_array_from_text(text: str) -> list:
+    text = text.strip()
+    if not text:
+        raise ValueError("Empty response")
 
-    max_retries = 2
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Classification: Attempt {attempt + 1} with LLM for ticket: {description[:50]}...")
-            prompt_text = f"""Eres un clasificador de tickets de soporte. Analiza el texto y devuelve un JSON válido con exactamente dos claves: "category" y "sentiment".
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        parsed = None
+    if isinstance(parsed, list):
+        return parsed
+    if isinstance(parsed, dict):
+        return [parsed]
 
-Categorías disponibles (elige UNA):
-- Técnico: errores, bugs, fallos técnicos, problemas de funcionamiento
+    # Buscar el arreglo dentro del texto (con o sin bloque markdown)
+    start = text.find("[")
+    end = text.rfind("]")
+    if start != -1 and end > start:
+        try:
+            parsed = json.loads(text[start:end + 1])
+            if isinstance(parsed, list):
+                return parsed
+        except json.JSONDecodeError:
+            pass
+
+    raise ValueError("No valid JSON array found in response")
+
+
+CATEGORY_GUIDE = """Categorías disponibles (elige UNA):
+- Técnico: errores, bugs, fallos técnicos, problemas de funcionamiento
 - Facturación: pagos, cobros, facturas, suscripciones, reembolsos
 - Comercial: precios, planes, cotizaciones, ventas
 - Acceso: login, contraseñas, autenticación, bloqueos, 2FA
@@ -395,112 +1711,2646 @@ Categorías disponibles (elige UNA):
 - Móvil: problemas en Android, iOS, aplicaciones móviles
 - Solicitudes: peticiones de nuevas funcionalidades, mejoras
 
-Sentimientos (elige UNO):
-- Positivo: agradecimientos, elogios, satisfacción
-- Neutral: consultas, preguntas, información
-- Negativo: quejas, problemas, frustración, errores
+Sentimientos (elige UNO):
+- Positivo: agradecimientos, elogios, satisfacción
+- Neutral: consultas, preguntas, información
+- Negativo: quejas, problemas, frustración, errores"""
+
+
+# Códigos cortos de la variante compacta: menos tokens de instrucciones y de salida
+CATEGORY_CODES = {
+    "TEC": ("Técnico", "errores, bugs, fallos"),
+    "FAC": ("Facturación", "pagos, cobros, facturas, reembolsos"),
+    "COM": ("Comercial", "precios, planes, ventas"),
+    "ACC": ("Acceso", "login, contraseñas, 2FA, bloqueos"),
+    "CTA": ("Cuenta", "perfil, registro, datos, baja"),
+    "REN": ("Rendimiento", "lentitud, latencia"),
+    "UX": ("UX/UI", "diseño, interfaz, navegación"),
+    "SEG": ("Seguridad", "phishing, fraude, vulnerabilidades"),
+    "INT": ("Integraciones", "APIs, webhooks, conexiones"),
+    "MOV": ("Móvil", "Android, iOS, app móvil"),
+    "SOL": ("Solicitudes", "nuevas funcionalidades, mejoras"),
+}
+
+SENTIMENT_CODES = {
+    "POS": ("Positivo", "satisfacción, elogios"),
+    "NEU": ("Neutral", "consultas"),
+    "NEG": ("Negativo", "quejas, problemas, frustración"),
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Aproximación de tokens BPE (palabras + signos) para comparar plantillas sin tokenizer."""
+    return len(_APPROX_TOKEN.findall(text))
+
+
+class PromptTemplate:
+    """Plantilla de prompt versionada y precompilada.
+
+    Las instrucciones van completas en ``system`` (idéntico byte a byte entre
+    peticiones, así vLLM y el proveedor reutilizan el prefijo cacheado) y el
+    mensaje user lleva solo el ticket. Con ``codes`` el modelo responde con
+    códigos cortos que ``decode`` traduce a los valores permitidos.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        system: str,
+        batch_system: str,
+        user_prefix: str,
+        category_codes: Optional[dict] = None,
+        sentiment_codes: Optional[dict] = None,
+    ):
+        self.name = name
+        self.system = system
+        self.batch_system = batch_system
+        self.user_prefix = user_prefix
+        self._category_codes = {code.lower(): value for code, (value, _) in (category_codes or {}).items()}
+        self._sentiment_codes = {code.lower(): value for code, (value, _) in (sentiment_codes or {}).items()}
+        if category_codes:
+            self.schema = {
+                **CLASSIFICATION_SCHEMA,
+                "properties": {
+                    "category": {"type": "string", "enum": sorted(category_codes)},
+                    "sentiment": {"type": "string", "enum": sorted(sentiment_codes or {})},
+                },
+            }
+        else:
+            self.schema = CLASSIFICATION_SCHEMA
+        self.system_tokens = estimate_tokens(system)
+        self.batch_system_tokens = estimate_tokens(batch_system)
+        self.user_overhead_tokens = estimate_tokens(user_prefix)
+
+    def user_message(self, normalized_text: str) -> str:
+        return f"{self.user_prefix}{normalized_text}"
+
+    def batch_user_message(self, normalized_texts: list) -> str:
+        numbered = "\n".join(f"[{i}] {text}" for i, text in enumerate(normalized_texts, start=1))
+        return f"Tickets a clasificar:\n{numbered}"
+
+    def decode(self, result):
+        """Traduce códigos cortos a categoría/sentimiento; los nombres completos pasan igual."""
+        if not isinstance(result, dict) or not self._category_codes:
+            return result
+        decoded = dict(result)
+        category = str(result.get("category", "")).strip().lower()
+        sentiment = str(result.get("sentiment", "")).strip().lower()
+        decoded["category"] = self._category_codes.get(category, result.get("category", ""))
+        decoded["sentiment"] = self._sentiment_codes.get(sentiment, result.get("sentiment", ""))
+        return decoded
+
+    def stats(self) -> dict:
+        requests = PROMPT_REQUESTS.value(template=self.name)
+        prompt_tokens = PROMPT_TOKENS.value(template=self.name, kind="prompt")
+        cached_tokens = PROMPT_TOKENS.value(template=self.name, kind="cached")
+        return {
+            "system_tokens_est": self.system_tokens,
+            "batch_system_tokens_est": self.batch_system_tokens,
+            "user_overhead_tokens_est": self.user_overhead_tokens,
+            "requests": int(requests),
+            "avg_prompt_tokens": round(prompt_tokens / requests, 1) if requests and prompt_tokens else None,
+            "avg_completion_tokens": (
+                round(PROMPT_TOKENS.value(template=self.name, kind="completion") / requests, 1)
+                if requests and prompt_tokens else None
+            ),
+            "prefix_cache_hit_rate": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else None,
+        }
+
+
+def _code_list(codes: dict) -> str:
+    return "; ".join(f"{code}={hint}" for code, (_, hint) in codes.items())
+
+
+def _build_prompt_templates() -> dict:
+    full_format = '{"category": "Técnico", "sentiment": "Negativo"}'
+    compact_codes = (
+        f"Categorías: {_code_list(CATEGORY_CODES)}\n"
+        f"Sentimiento: {_code_list(SENTIMENT_CODES)}"
+    )
+    templates = (
+        PromptTemplate(
+            name="full-v1",
+            system=f"""Eres un clasificador de tickets de soporte. Analiza el texto y devuelve un JSON válido con exactamente dos claves: "category" y "sentiment".
+
+{CATEGORY_GUIDE}
+
+Responde SOLO con JSON válido. Ejemplo de formato:
+{full_format}""",
+            batch_system=f"""Eres un clasificador de tickets de soporte. Clasifica CADA ticket numerado de forma independiente.
+
+{CATEGORY_GUIDE}
+
+Responde SOLO con un arreglo JSON (JSON array) con un objeto por ticket, en el mismo orden y con su número en "id". Ejemplo de formato:
+[{{"id": 1, "category": "Técnico", "sentiment": "Negativo"}}, {{"id": 2, "category": "Facturación", "sentiment": "Neutral"}}]""",
+            user_prefix="Ticket a clasificar: ",
+        ),
+        PromptTemplate(
+            name="compact-v1",
+            system=f"""Clasifica el ticket de soporte. Responde SOLO JSON: {{"category":"<código>","sentiment":"<código>"}}
+{compact_codes}""",
+            batch_system=f"""Clasifica CADA ticket numerado por separado. Responde SOLO un arreglo JSON en el mismo orden: [{{"id":1,"category":"<código>","sentiment":"<código>"}}]
+{compact_codes}""",
+            user_prefix="Ticket: ",
+            category_codes=CATEGORY_CODES,
+            sentiment_codes=SENTIMENT_CODES,
+        ),
+    )
+    return {template.name: template for template in templates}
+
+
+# Esquema para la decodificación restringida: solo valores permitidos
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string", "enum": sorted(ALLOWED_CATEGORIES)},
+        "sentiment": {"type": "string", "enum": sorted(ALLOWED_SENTIMENTS)},
+    },
+    "required": ["category", "sentiment"],
+    "additionalProperties": False,
+}
+
+
+# Precompiladas al importar: el texto de cada system es constante durante toda la vida del proceso
+PROMPT_TEMPLATES = _build_prompt_templates()
+
+_active_prompt_template: contextvars.ContextVar = contextvars.ContextVar("active_prompt_template", default=None)
+
+
+class PromptSelector:
+    """Elige la plantilla de cada ticket: la por defecto o, para una fracción
+    estable de textos (hash del texto normalizado), la variante del A/B."""
+
+    def __init__(self, default: PromptTemplate, variant: Optional[PromptTemplate] = None, ratio: float = 0.0):
+        self.default = default
+        self.variant = variant
+        self.ratio = ratio if variant is not None else 0.0
+
+    @classmethod
+    def from_env(cls) -> "PromptSelector":
+        def lookup(name: str) -> Optional[PromptTemplate]:
+            if not name:
+                return None
+            template = PROMPT_TEMPLATES.get(name)
+            if template is None:
+                logger.warning(f"LLM: Unknown prompt template '{name}', available: {', '.join(PROMPT_TEMPLATES)}")
+            return template
+
+        return cls(
+            default=lookup(os.getenv("PROMPT_TEMPLATE", "full-v1")) or PROMPT_TEMPLATES["full-v1"],
+            variant=lookup(os.getenv("PROMPT_AB_VARIANT", "")),
+            ratio=float(os.getenv("PROMPT_AB_RATIO", "0")),
+        )
+
+    def pick(self, normalized_text: str) -> PromptTemplate:
+        # Mismo texto, misma variante: no rompe la caché ni la coalescencia
+        if self.ratio > 0 and zlib.crc32(normalized_text.encode("utf-8")) % 10000 < self.ratio * 10000:
+            return self.variant
+        return self.default
+
+    def stats(self) -> dict:
+        return {
+            "default": self.default.name,
+            "ab_variant": self.variant.name if self.variant else None,
+            "ab_ratio": self.ratio,
+            "templates": {name: template.stats() for name, template in PROMPT_TEMPLATES.items()},
+        }
+
+
+_prompt_selector: Optional[PromptSelector] = None
+
+
+def get_prompt_selector() -> PromptSelector:
+    global _prompt_selector
+    if _prompt_selector is None:
+        _prompt_selector = PromptSelector.from_env()
+    return _prompt_selector
+
+
+def _record_prompt_usage(result: dict):
+    """Acumula el ``usage`` de la respuesta en la plantilla activa (si la hay)."""
+    template = _active_prompt_template.get()
+    usage = result.get("usage") if isinstance(result, dict) else None
+    if template is None or not isinstance(usage, dict):
+        return
+    details = usage.get("prompt_tokens_details") or {}
+    for kind, value in (
+        ("prompt", usage.get("prompt_tokens")),
+        ("completion", usage.get("completion_tokens")),
+        ("cached", details.get("cached_tokens") if isinstance(details, dict) else None),
+    ):
+        if isinstance(value, (int, float)) and value:
+            PROMPT_TOKENS.inc(value, template=template, kind=kind)
+
+
+def validate_classification(result) -> Optional[dict]:
+    """Normaliza categoría y sentimiento; None si alguno no es válido."""
+    if not isinstance(result, dict):
+        return None
+    category = normalize_category(str(result.get("category", "")))
+    sentiment = normalize_sentiment(str(result.get("sentiment", "")))
+    if category not in ALLOWED_CATEGORIES or sentiment not in ALLOWED_SENTIMENTS:
+        return None
+    return {"category": category, "sentiment": sentiment}
+
+
+class CircuitBreaker:
+    """Circuit breaker del backend LLM.
+
+    Registra las últimas ``window`` llamadas (éxito/fallo + latencia). Se abre si
+    la tasa de error o el p95 de latencia superan su umbral; mientras está
+    abierto las clasificaciones van directo a reglas. Pasado ``cooldown`` pasa a
+    semiabierto y deja pasar ``half_open_probes`` llamadas de prueba: si salen
+    bien se cierra, si alguna falla vuelve a abrirse.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        window: int = 50,
+        min_requests: int = 10,
+        error_rate_threshold: float = 0.5,
+        latency_p95_threshold: float = 10.0,
+        cooldown: float = 30.0,
+        half_open_probes: int = 1,
+        enabled: bool = True,
+    ):
+        self.enabled = enabled
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate_threshold
+        self.latency_p95_threshold = latency_p95_threshold
+        self.cooldown = cooldown
+        self.half_open_probes = max(1, half_open_probes)
+        self._outcomes: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.times_opened = 0
+        self.short_circuited = 0
+        self.last_trip_reason: Optional[str] = None
+
+    @classmethod
+    def from_env(cls) -> "CircuitBreaker":
+        return cls(
+            window=int(os.getenv("LLM_BREAKER_WINDOW", "50")),
+            min_requests=int(os.getenv("LLM_BREAKER_MIN_REQUESTS", "10")),
+            error_rate_threshold=float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5")),
+            latency_p95_threshold=float(os.getenv("LLM_BREAKER_LATENCY_P95_MS", "10000")) / 1000.0,
+            cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30")),
+            half_open_probes=int(os.getenv("LLM_BREAKER_HALF_OPEN_PROBES", "1")),
+            enabled=_env_flag("LLM_BREAKER_ENABLED", "true"),
+        )
+
+    def _cooldown_elapsed(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.cooldown
+
+    def rejecting(self) -> bool:
+        """True si una llamada nueva sería rechazada (no consume sondas)."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self.state == self.OPEN:
+                return not self._cooldown_elapsed()
+            if self.state == self.HALF_OPEN:
+                return self._probes_in_flight >= self.half_open_probes
+            return False
+
+    def allow_request(self) -> bool:
+        """Decide si se puede llamar al LLM; en semiabierto reserva una sonda."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.state == self.OPEN:
+                if not self._cooldown_elapsed():
+                    self.short_circuited += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes_in_flight = 0
+                self._probe_successes = 0
+                logger.info("LLM: Circuit breaker half-open, sending probe")
+            if self.state == self.HALF_OPEN:
+                if self._probes_in_flight >= self.half_open_probes:
+                    self.short_circuited += 1
+                    return False
+                self._probes_in_flight += 1
+            return True
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self._outcomes.append((True, latency))
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if latency >= self.latency_p95_threshold:
+                    self._trip(f"probe latency {latency:.2f}s")
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    logger.info("LLM: Circuit breaker closed")
+                return
+            self._evaluate()
+
+    def record_failure(self, latency: float):
+        with self._lock:
+            self._outcomes.append((False, latency))
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._trip("probe failed")
+                return
+            self._evaluate()
+
+    def release(self):
+        """Libera una sonda sin registrar resultado (llamada cancelada)."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def _evaluate(self):
+        if self.state != self.CLOSED or len(self._outcomes) < self.min_requests:
+            return
+        error_rate = self._error_rate()
+        if error_rate >= self.error_rate_threshold:
+            self._trip(f"error rate {error_rate:.0%}")
+            return
+        p95 = self._latency_percentile(0.95)
+        if p95 >= self.latency_p95_threshold:
+            self._trip(f"p95 latency {p95:.2f}s")
+
+    def _trip(self, reason: str):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self.times_opened += 1
+        self.last_trip_reason = reason
+        logger.warning(f"LLM: Circuit breaker opened ({reason}), routing to rules for {self.cooldown:.0f}s")
+
+    def _error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for ok, _ in self._outcomes if not ok) / len(self._outcomes)
+
+    def _latency_percentile(self, q: float) -> float:
+        latencies = sorted(latency for _, latency in self._outcomes)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "state": self.state,
+                "window_size": len(self._outcomes),
+                "error_rate": round(self._error_rate(), 4),
+                "latency_p50_ms": round(self._latency_percentile(0.50) * 1000, 1),
+                "latency_p95_ms": round(self._latency_percentile(0.95) * 1000, 1),
+                "latency_p99_ms": round(self._latency_percentile(0.99) * 1000, 1),
+                "times_opened": self.times_opened,
+                "short_circuited": self.short_circuited,
+                "last_trip_reason": self.last_trip_reason,
+                "seconds_until_probe": (
+                    round(max(0.0, self.cooldown - (time.monotonic() - self._opened_at)), 1)
+                    if self.state == self.OPEN else None
+                ),
+            }
+
+
+_llm_breaker: Optional[CircuitBreaker] = None
+
+
+def get_llm_breaker() -> CircuitBreaker:
+    global _llm_breaker
+    if _llm_breaker is None:
+        _llm_breaker = CircuitBreaker.from_env()
+    return _llm_breaker
+
+
+def _llm_endpoint(llm: OpenAICompatibleAPI) -> str:
+    parsed = urlparse(llm.api_url)
+    return f"{parsed.netloc}{parsed.path}"
+
+
+class LLMRateLimited(Exception):
+    """La petición al LLM se descartó por el limitador (cola llena o espera excesiva)."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class LLMRateLimiter:
+    """Control de admisión hacia el LLM: peticiones/s y tokens/min con cola acotada.
+
+    Las peticiones esperan en orden FIFO hasta que ambos buckets tienen saldo y
+    ha pasado cualquier ``Retry-After`` recibido. Si la cola ya tiene
+    ``max_queue`` esperando o la espera superaría ``max_wait`` segundos, la
+    petición se descarta con LLMRateLimited y el llamador cae al tier local.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 10.0,
+        burst: int = 20,
+        tokens_per_minute: float = 0.0,
+        max_queue: int = 100,
+        max_wait: float = 2.0,
+    ):
+        self.requests = TokenBucket(requests_per_second, max(1, burst))
+        self.tokens = (
+            TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) if tokens_per_minute > 0 else None
+        )
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock: Optional[asyncio.Lock] = None
+        self._blocked_until = 0.0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_max_wait = 0
+        self.retry_after_blocks = 0
+
+    @classmethod
+    def from_env(cls) -> "LLMRateLimiter":
+        return cls(
+            requests_per_second=float(os.getenv("LLM_RATE_LIMIT_RPS", "10")),
+            burst=int(os.getenv("LLM_RATE_LIMIT_BURST", "20")),
+            tokens_per_minute=float(os.getenv("LLM_RATE_LIMIT_TOKENS_PER_MIN", "0")),
+            max_queue=int(os.getenv("LLM_RATE_LIMIT_MAX_QUEUE", "100")),
+            max_wait=float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT_MS", "2000")) / 1000.0,
+        )
+
+    def _shed(self, reason: str):
+        if reason == "queue_full":
+            self.shed_queue_full += 1
+        else:
+            self.shed_max_wait += 1
+        RATE_LIMIT_SHED.inc(reason=reason)
+        raise LLMRateLimited(reason)
+
+    async def acquire(self, tokens: int = 0):
+        """Espera turno o lanza LLMRateLimited."""
+        if self.waiting >= self.max_queue:
+            self._shed("queue_full")
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        deadline = time.monotonic() + self.max_wait
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    wait = max(
+                        self._blocked_until - now,
+                        self.requests.time_until(1, now),
+                        self.tokens.time_until(tokens, now) if self.tokens else 0.0,
+                    )
+                    if wait <= 0:
+                        self.requests.take(1)
+                        if self.tokens:
+                            self.tokens.take(tokens)
+                        self.admitted += 1
+                        return
+                    if now + wait > deadline:
+                        self._shed("max_wait")
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+    def block_for(self, seconds: float):
+        """Pausa la admisión (Retry-After del proveedor)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self.retry_after_blocks += 1
+        logger.warning(f"LLM: Provider asked to back off, pausing admission for {seconds:.1f}s")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "requests_per_second": self.requests.rate,
+            "burst": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity if self.tokens else None,
+            "queue_depth": self.waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_max_wait": self.shed_max_wait,
+            "retry_after_blocks": self.retry_after_blocks,
+            "blocked_for_seconds": round(max(0.0, self._blocked_until - time.monotonic()), 1),
+        }
+
+
+_llm_rate_limiter: Optional[LLMRateLimiter] = None
+
+
+def get_llm_rate_limiter() -> Optional[LLMRateLimiter]:
+    global _llm_rate_limiter
+    if not _env_flag("LLM_RATE_LIMIT_ENABLED"):
+        return None
+    if _llm_rate_limiter is None:
+        _llm_rate_limiter = LLMRateLimiter.from_env()
+    return _llm_rate_limiter
+
+
+def _retry_after_seconds(response) -> Optional[float]:
+    """Segundos de Retry-After (número o fecha HTTP); 1s por defecto en un 429 sin cabecera."""
+    value = response.headers.get("retry-after")
+    if value:
+        try:
+            return min(300.0, max(0.0, float(value)))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+                return min(300.0, max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+            except (TypeError, ValueError):
+                pass
+    if response.status_code == 429:
+        return 1.0
+    return None
+
+
+async def _invoke_llm(llm: OpenAICompatibleAPI, prompt: str, **kwargs) -> str:
+    """Llama al LLM registrando el resultado en el circuit breaker y en las métricas."""
+    breaker = get_llm_breaker()
+    limiter = get_llm_rate_limiter()
+    if limiter is not None:
+        # Estimación gruesa: ~4 caracteres por token de entrada + tope de salida
+        estimated_tokens = (len(prompt) + len(kwargs.get("system") or "")) // 4 + (kwargs.get("max_tokens") or llm.max_tokens)
+        try:
+            await limiter.acquire(estimated_tokens)
+        except (LLMRateLimited, asyncio.CancelledError):
+            breaker.release()
+            raise
+    # El pool etiqueta sus métricas con el backend que atendió cada llamada
+    labels = None if isinstance(llm, LLMBackendPool) else {"model": llm.model, "endpoint": _llm_endpoint(llm)}
+    start_time = time.perf_counter()
+    try:
+        response = await llm.ainvoke(prompt, **kwargs)
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+    except Exception as e:
+        elapsed = time.perf_counter() - start_time
+        breaker.record_failure(elapsed)
+        if limiter is not None and isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (429, 503):
+            retry_after = _retry_after_seconds(e.response)
+            if retry_after:
+                limiter.block_for(retry_after)
+        if labels is not None:
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else "error"
+            LLM_RESPONSES.inc(status=status, **labels)
+            LLM_REQUEST_SECONDS.observe(elapsed, **labels)
+        STAGE_SECONDS.observe(elapsed, stage="llm_request")
+        raise
+    elapsed = time.perf_counter() - start_time
+    breaker.record_success(elapsed)
+    if labels is not None:
+        LLM_RESPONSES.inc(status=200, **labels)
+        LLM_REQUEST_SECONDS.observe(elapsed, **labels)
+    STAGE_SECONDS.observe(elapsed, stage="llm_request")
+    return response
+
+
+async def _invoke_template(llm: OpenAICompatibleAPI, template: PromptTemplate, prompt: str, system: str, **kwargs) -> str:
+    """Invoca el LLM con el system fijo de la plantilla y atribuye el ``usage`` a ella."""
+    PROMPT_REQUESTS.inc(template=template.name)
+    token = _active_prompt_template.set(template.name)
+    try:
+        return await _invoke_llm(llm, prompt, system=system, **kwargs)
+    finally:
+        _active_prompt_template.reset(token)
+
+
+async def _classify_with_llm(
+    llm: OpenAICompatibleAPI,
+    normalized_text: str,
+    description: str,
+    template: Optional[PromptTemplate] = None,
+) -> dict:
+    breaker = get_llm_breaker()
+    template = template or get_prompt_selector().pick(normalized_text)
+    max_retries = 2
+    for attempt in range(max_retries):
+        if not breaker.allow_request():
+            logger.warning("LLM: Circuit breaker open, using rules fallback")
+            return _rules_fallback(normalized_text, "breaker_open")
+        try:
+            logger.info(f"Classification: Attempt {attempt + 1} with LLM for ticket: {description[:50]}...")
+            start_time = time.time()
+            try:
+                response = await _invoke_template(
+                    llm, template, template.user_message(normalized_text), template.system, schema=template.schema
+                )
+            except httpx.HTTPStatusError as e:
+                if e.response is not None and e.response.status_code == 503:
+                    logger.warning("LLM: Model is loading, will retry...")
+                    if attempt < max_retries - 1:
+                        CLASSIFICATION_RETRIES.inc(model=llm.model, reason="model_loading")
+                        await asyncio.sleep(2)
+                        continue
+                raise
+            elapsed = time.time() - start_time
+            
+            logger.info(f"LLM: Response received in {elapsed:.2f}s, length: {len(response) if response else 0}")
+            
+            if not response or not response.strip():
+                raise ValueError("Empty response from LLM")
+            
+            logger.debug(f"LLM: Raw response: {response[:200]}...")
+            
+            with STAGE_SECONDS.time(stage="json_parse"):
+                result = template.decode(parse_json_from_text(response))
+            
+            if not isinstance(result, dict):
+                raise ValueError("Response is not a dictionary")
+            
+            category = normalize_category(result.get("category", ""))
+            sentiment = normalize_sentiment(result.get("sentiment", ""))
+            
+            if not category or not sentiment:
+                raise ValueError(f"Missing category or sentiment - category: {category}, sentiment: {sentiment}")
+            
+            if category not in ALLOWED_CATEGORIES:
+                raise ValueError(f"Invalid category: {category}")
+            
+            if sentiment not in ALLOWED_SENTIMENTS:
+                raise ValueError(f"Invalid sentiment: {sentiment}")
+            
+            confidence = 1.0
+            
+            response_lower = response.lower()
+            uncertainty_indicators = [
+                "no estoy seguro", "no sé", "tal vez", "quizás", 
+                "posiblemente", "probablemente", "?", "maybe"
+            ]
+            if any(indicator in response_lower for indicator in uncertainty_indicators):
+                confidence = min(confidence, 0.4)
+                logger.warning(f"LLM: Low confidence detected due to uncertainty indicators")
+            
+            if len(response) > 500:
+                confidence = min(confidence, 0.5)
+                logger.warning(f"LLM: Low confidence due to long response ({len(response)} chars)")
+            
+            threshold = float(os.getenv("LLM_CONFIDENCE_THRESHOLD", "0.5"))
+            if confidence < threshold:
+                logger.warning(f"LLM: Confidence {confidence} below threshold {threshold}, using rules fallback")
+                CONFIDENCE_REJECTIONS.inc(model=llm.model)
+                return _rules_fallback(normalized_text, "low_confidence")
+            
+            logger.info(f"LLM: Successfully classified - Category: {category}, Sentiment: {sentiment}")
+            return {"category": category, "sentiment": sentiment, "source": "llm"}
+            
+        except LLMRateLimited as e:
+            # Reintentar solo agravaría la cola: se resuelve en el tier local
+            logger.warning(f"LLM: Rate limiter shed request ({e}), using rules fallback")
+            return _rules_fallback(normalized_text, "rate_limited")
+        except Exception as e:
+            error_type = type(e).__name__
+            error_msg = str(e)
+            logger.error(f"LLM: Classification attempt {attempt + 1} failed - {error_type}: {error_msg}")
+            if attempt < max_retries - 1:
+                logger.info(f"LLM: Retrying in 0.5s...")
+                CLASSIFICATION_RETRIES.inc(model=llm.model, reason=error_type)
+                await asyncio.sleep(0.5)
+                continue
+            logger.warning("LLM: All attempts failed, falling back to rules-based classification")
+            return _rules_fallback(normalized_text, "llm_error")
+
+
+class ClassificationBatcher:
+    """Agrupa los tickets que llegan dentro de una ventana corta en una sola llamada al LLM.
+
+    Cada ticket espera su propio future; el resultado del arreglo JSON se reparte
+    por posición/"id". Si un hueco no pasa la validación (o la respuesta completa
+    no se puede interpretar) ese ticket se reclasifica individualmente con
+    ``_classify_with_llm``. Si el backend falla, el lote entero va a reglas y el
+    breaker decide cuándo volver a llamar.
+    """
+
+    def __init__(self, window_ms: float, max_size: int):
+        self.window = window_ms / 1000.0
+        self.max_size = max(1, max_size)
+        self._pending: list = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.batches_sent = 0
+        self.tickets_batched = 0
+        self.slot_retries = 0
+
+    def submit(self, normalized_text: str, description: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((normalized_text, description, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: list):
+        llm = llm_client()
+        try:
+            if llm is None:
+                for normalized_text, _, future in batch:
+                    _resolve(future, _rules_fallback(normalized_text))
+                return
+            if len(batch) == 1 or not get_llm_breaker().allow_request():
+                # Un solo ticket o breaker abierto: el camino individual decide
+                await asyncio.gather(*(
+                    self._retry_single(llm, normalized_text, description, future)
+                    for normalized_text, description, future in batch
+                ))
+                return
+
+            self.batches_sent += 1
+            self.tickets_batched += len(batch)
+            slots = await self._invoke_batch(llm, [item[0] for item in batch])
+            retries = []
+            for index, (normalized_text, description, future) in enumerate(batch):
+                classification = validate_classification(slots.get(index + 1))
+                if classification:
+                    _resolve(future, {**classification, "source": "llm"})
+                else:
+                    retries.append((normalized_text, description, future))
+            if retries:
+                self.slot_retries += len(retries)
+                logger.warning(f"LLM: {len(retries)}/{len(batch)} batch slots invalid, retrying individually")
+                await asyncio.gather(*(
+                    self._retry_single(llm, normalized_text, description, future)
+                    for normalized_text, description, future in retries
+                ))
+        except LLMRateLimited:
+            for normalized_text, _, future in batch:
+                _resolve(future, _rules_fallback(normalized_text, "rate_limited"))
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            # El backend falló (y ya quedó registrado en el breaker): reintentar ticket
+            # a ticket multiplicaría la carga justo cuando el breaker intenta aliviarla
+            logger.error(f"LLM: Batch request failed - {type(e).__name__}: {e}")
+            for normalized_text, _, future in batch:
+                _resolve(future, _rules_fallback(normalized_text, "llm_error"))
+        except Exception as e:
+            # Respuesta inutilizable: camino individual solo si el breaker admite llamadas
+            logger.error(f"LLM: Batch classification failed - {type(e).__name__}: {e}")
+            if get_llm_breaker().rejecting():
+                for normalized_text, _, future in batch:
+                    _resolve(future, _rules_fallback(normalized_text, "breaker_open"))
+                return
+            await asyncio.gather(*(
+                self._retry_single(llm, normalized_text, description, future)
+                for normalized_text, description, future in batch
+                if not future.done()
+            ))
+
+    async def _invoke_batch(self, llm: OpenAICompatibleAPI, normalized_texts: list) -> dict:
+        """Devuelve {número de ticket: objeto} a partir de la respuesta del lote."""
+        start_time = time.time()
+        # Los lotes mezclan textos: siempre la plantilla por defecto, sin A/B
+        template = get_prompt_selector().default
+        response = await _invoke_template(
+            llm,
+            template,
+            template.batch_user_message(normalized_texts),
+            template.batch_system,
+            max_tokens=max(llm.max_tokens, 40 * len(normalized_texts)),
+        )
+        elapsed = time.time() - start_time
+        logger.info(f"LLM: Batch of {len(normalized_texts)} classified in {elapsed:.2f}s")
+        with STAGE_SECONDS.time(stage="json_parse"):
+            items = parse_json_array_from_text(response)
+        slots = {}
+        for position, item in enumerate(items, start=1):
+            if not isinstance(item, dict):
+                continue
+            try:
+                slot = int(item.get("id", position))
+            except (TypeError, ValueError):
+                slot = position
+            slots.setdefault(slot, template.decode(item))
+        return slots
+
+    async def _retry_single(self, llm, normalized_text: str, description: str, future: asyncio.Future):
+        try:
+            if llm is None:
+                _resolve(future, _rules_fallback(normalized_text))
+            else:
+                _resolve(future, await _classify_with_llm(llm, normalized_text, description))
+        except Exception:
+            _resolve(future, _rules_fallback(normalized_text, "llm_error"))
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window * 1000,
+            "max_size": self.max_size,
+            "batches_sent": self.batches_sent,
+            "tickets_batched": self.tickets_batched,
+            "slot_retries": self.slot_retries,
+            "pending": len(self._pending),
+        }
+
+
+def _resolve(future: asyncio.Future, value: dict):
+    if not future.done():
+        future.set_result(value)
+
+
+_batcher: Optional[ClassificationBatcher] = None
+_batcher_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_batcher() -> Optional[ClassificationBatcher]:
+    """Batcher del event loop actual, o None si LLM_BATCH_ENABLED está apagado."""
+    global _batcher, _batcher_loop
+    if not _env_flag("LLM_BATCH_ENABLED"):
+        return None
+    loop = asyncio.get_running_loop()
+    if _batcher is None or _batcher_loop is not loop:
+        _batcher = ClassificationBatcher(
+            window_ms=float(os.getenv("LLM_BATCH_WINDOW_MS", "20")),
+            max_size=int(os.getenv("LLM_BATCH_MAX_SIZE", "16")),
+        )
+        _batcher_loop = loop
+    return _batcher
+
+
+class ClassificationCache:
+    """Caché de clasificaciones direccionada por contenido.
+
+    La clave es un hash del texto normalizado + modelo + versión del prompt, así
+    que cambiar de modelo o de prompt invalida las entradas automáticamente.
+    Nivel 1: LRU en memoria. Nivel 2 (opcional): SQLite en disco.
+    Ambos niveles expiran por TTL y por tamaño máximo.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl_seconds: float = 86400,
+        sqlite_path: Optional[str] = None,
+        sqlite_max_entries: int = 200000,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.sqlite_max_entries = sqlite_max_entries
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # SQLite tiene su propio lock: una escritura lenta no bloquea el LRU
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("pragma journal_mode=wal")
+            self._db.execute(
+                "create table if not exists classification_cache ("
+                "key text primary key, category text not null, sentiment text not null, "
+                "created_at real not null)"
+            )
+            self._db.execute(
+                "create index if not exists classification_cache_created_at "
+                "on classification_cache (created_at)"
+            )
+
+    @classmethod
+    def from_env(cls) -> "ClassificationCache":
+        return cls(
+            max_entries=int(os.getenv("CLASSIFY_CACHE_MAX_ENTRIES", "10000")),
+            ttl_seconds=float(os.getenv("CLASSIFY_CACHE_TTL_SECONDS", "86400")),
+            sqlite_path=os.getenv("CLASSIFY_CACHE_SQLITE_PATH") or None,
+            sqlite_max_entries=int(os.getenv("CLASSIFY_CACHE_SQLITE_MAX_ENTRIES", "200000")),
+        )
+
+    @staticmethod
+    def make_key(normalized_text: str, model: str, prompt_version: str) -> str:
+        """``prompt_version`` es el nombre de la plantilla (p. ej. ``full-v1``): cambiarla invalida la caché."""
+        raw = f"{prompt_version}\x00{model}\x00{normalized_text}".encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    @property
+    def has_disk(self) -> bool:
+        return self._db is not None
+
+    def get_memory(self, key: str) -> Optional[dict]:
+        """Solo el LRU en memoria: barato, apto para el event loop. Sin disco, un fallo cuenta como miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return dict(value)
+                del self._memory[key]
+                self.evictions += 1
+            if self._db is None:
+                self.misses += 1
+            return None
+
+    def get_disk(self, key: str) -> Optional[dict]:
+        """Nivel SQLite (bloqueante: llamar fuera del event loop). Un acierto se sube a memoria."""
+        now = time.time()
+        with self._db_lock:
+            row = self._db.execute(
+                "select category, sentiment, created_at from classification_cache where key = ?",
+                (key,),
+            ).fetchone()
+        with self._lock:
+            if row and now - row[2] <= self.ttl:
+                value = {"category": row[0], "sentiment": row[1]}
+                self._store_memory(key, value, row[2])
+                self.hits += 1
+                self.disk_hits += 1
+                return dict(value)
+            self.misses += 1
+            return None
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.get_memory(key)
+        if value is None and self._db is not None:
+            value = self.get_disk(key)
+        return value
+
+    def set_memory(self, key: str, value: dict):
+        with self._lock:
+            self._store_memory(key, {"category": value["category"], "sentiment": value["sentiment"]}, time.time())
+
+    def set_disk(self, key: str, value: dict):
+        """Escribe en SQLite (bloqueante: llamar fuera del event loop)."""
+        now = time.time()
+        with self._db_lock:
+            self._db.execute(
+                "insert or replace into classification_cache (key, category, sentiment, created_at) "
+                "values (?, ?, ?, ?)",
+                (key, value["category"], value["sentiment"], now),
+            )
+            self._db_writes += 1
+            if self._db_writes % 1000 == 0:
+                self._prune_disk(now)
+
+    def set(self, key: str, value: dict):
+        self.set_memory(key, value)
+        if self._db is not None:
+            self.set_disk(key, value)
+
+    def _store_memory(self, key: str, value: dict, created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _prune_disk(self, now: float):
+        self._db.execute("delete from classification_cache where created_at < ?", (now - self.ttl,))
+        self._db.execute(
+            "delete from classification_cache where key in ("
+            "select key from classification_cache order by created_at desc limit -1 offset ?)",
+            (self.sqlite_max_entries,),
+        )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "sqlite_enabled": self._db is not None,
+        }
+
+
+_classification_cache: Optional[ClassificationCache] = None
+_classification_cache_lock = threading.Lock()
+
+
+def get_classification_cache() -> Optional[ClassificationCache]:
+    """Caché compartida del proceso, o None si CLASSIFY_CACHE_ENABLED está apagado."""
+    global _classification_cache
+    if not _env_flag("CLASSIFY_CACHE_ENABLED", "true"):
+        return None
+    if _classification_cache is None:
+        with _classification_cache_lock:
+            if _classification_cache is None:
+                _classification_cache = ClassificationCache.from_env()
+    return _classification_cache
+
+
+# Versión del vectorizador: cambiarla invalida los índices persistidos
+VECTORIZER_VERSION = "hash-ngram-v1"
+
+
+def hashed_ngram_features(normalized_text: str, dim: int) -> tuple:
+    """Índices y signos (hashing trick) de palabras y trigramas de caracteres."""
+    text = f" {normalized_text} "
+    features = [f"w:{word}" for word in normalized_text.split()]
+    features.extend(f"c:{text[i:i + 3]}" for i in range(len(text) - 2))
+    indices = []
+    signs = []
+    for feature in features:
+        # crc32 es estable entre procesos (hash() de Python no)
+        h = zlib.crc32(feature.encode("utf-8"))
+        indices.append(h % dim)
+        signs.append(1.0 if h & 0x80000000 else -1.0)
+    return indices, signs
+
+
+def hashed_ngram_vector(normalized_text: str, dim: int):
+    """Vector L2-normalizado de n-gramas con hashing; None si el texto no tiene rasgos."""
+    indices, signs = hashed_ngram_features(normalized_text, dim)
+    if not indices:
+        return None
+    vector = np.bincount(indices, weights=signs, minlength=dim).astype(np.float32)
+    norm = float(np.linalg.norm(vector))
+    if norm == 0.0:
+        return None
+    return vector / norm
+
+
+class NeighborIndex:
+    """Clasificador por vecinos más cercanos sobre tickets ya clasificados.
+
+    Los vectores (n-gramas con hashing, normalizados) viven en un archivo
+    ``<path>.vec`` mapeado en memoria y las etiquetas en ``<path>.lbl``; ``<path>.json``
+    guarda dimensión, versión y número de filas válidas. Abrir el índice no lee
+    los datos, así que el arranque es inmediato. Las altas se escriben in situ y el
+    archivo crece por duplicación.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dim: int = 512,
+        threshold: float = 0.85,
+        top_k: int = 5,
+        min_rows: int = 50,
+        flush_every: int = 50,
+    ):
+        self.path = path
+        self.dim = dim
+        self.threshold = threshold
+        self.top_k = max(1, top_k)
+        self.min_rows = min_rows
+        self.flush_every = max(1, flush_every)
+        self.categories = sorted(ALLOWED_CATEGORIES)
+        self.sentiments = sorted(ALLOWED_SENTIMENTS)
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._labels = None
+        self.count = 0
+        self.capacity = 0
+        self._unflushed = 0
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        self._open()
+
+    @classmethod
+    def from_env(cls) -> "NeighborIndex":
+        return cls(
+            path=os.getenv("NEIGHBOR_INDEX_PATH", "neighbors.idx"),
+            dim=int(os.getenv("NEIGHBOR_DIM", "512")),
+            threshold=float(os.getenv("NEIGHBOR_THRESHOLD", "0.85")),
+            top_k=int(os.getenv("NEIGHBOR_TOP_K", "5")),
+            min_rows=int(os.getenv("NEIGHBOR_MIN_ROWS", "50")),
+            flush_every=int(os.getenv("NEIGHBOR_FLUSH_EVERY", "50")),
+        )
+
+    def _meta(self) -> dict:
+        return {
+            "version": VECTORIZER_VERSION,
+            "dim": self.dim,
+            "count": self.count,
+            "capacity": self.capacity,
+            "categories": self.categories,
+            "sentiments": self.sentiments,
+        }
+
+    def _open(self):
+        meta = None
+        try:
+            with open(f"{self.path}.json", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        compatible = (
+            meta is not None
+            and meta.get("version") == VECTORIZER_VERSION
+            and meta.get("dim") == self.dim
+            and meta.get("categories") == self.categories
+            and meta.get("sentiments") == self.sentiments
+            and os.path.exists(f"{self.path}.vec")
+            and os.path.exists(f"{self.path}.lbl")
+        )
+        if compatible:
+            self.count = int(meta["count"])
+            self._map(int(meta["capacity"]), mode="r+")
+            logger.info(f"Neighbors: Loaded index with {self.count} rows from {self.path}")
+        else:
+            if meta is not None:
+                logger.warning(f"Neighbors: Index at {self.path} is incompatible, rebuilding")
+            self.count = 0
+            self._map(1024, mode="w+")
+            self._write_meta()
+
+    def _map(self, capacity: int, mode: str):
+        self.capacity = capacity
+        self._vectors = np.memmap(f"{self.path}.vec", dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+        self._labels = np.memmap(f"{self.path}.lbl", dtype=np.uint8, mode=mode, shape=(capacity, 2))
+
+    def _grow(self):
+        self._vectors.flush()
+        self._labels.flush()
+        new_capacity = self.capacity * 2
+        for suffix, row_bytes in ((".vec", self.dim * 4), (".lbl", 2)):
+            with open(f"{self.path}{suffix}", "r+b") as f:
+                f.truncate(new_capacity * row_bytes)
+        self._map(new_capacity, mode="r+")
+
+    def _write_meta(self):
+        # Escritura atómica: un corte a medias no deja el índice ilegible
+        tmp_path = f"{self.path}.json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._meta(), f)
+        os.replace(tmp_path, f"{self.path}.json")
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._vectors.flush()
+        self._labels.flush()
+        self._write_meta()
+        self._unflushed = 0
+
+    def add(self, normalized_text: str, category: str, sentiment: str):
+        if category not in ALLOWED_CATEGORIES or sentiment not in ALLOWED_SENTIMENTS:
+            return
+        vector = hashed_ngram_vector(normalized_text, self.dim)
+        if vector is None:
+            return
+        with self._lock:
+            if self.count >= self.capacity:
+                self._grow()
+            self._vectors[self.count] = vector
+            self._labels[self.count] = (self.categories.index(category), self.sentiments.index(sentiment))
+            self.count += 1
+            self.added += 1
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._flush_locked()
+
+    def lookup(self, normalized_text: str) -> Optional[dict]:
+        """Etiqueta por voto ponderado de los top-k vecinos sobre el umbral; None si no hay."""
+        if self.count < self.min_rows:
+            return None
+        vector = hashed_ngram_vector(normalized_text, self.dim)
+        if vector is None:
+            return None
+        with self._lock:
+            count = self.count
+            scores = self._vectors[:count] @ vector
+            k = min(self.top_k, count)
+            top = np.argpartition(scores, -k)[-k:]
+            top = top[scores[top] >= self.threshold]
+            labels = np.array(self._labels[top]) if len(top) else None
+        if labels is None:
+            self.misses += 1
+            return None
+        weights = scores[top]
+        category_votes = np.bincount(labels[:, 0], weights=weights, minlength=len(self.categories))
+        sentiment_votes = np.bincount(labels[:, 1], weights=weights, minlength=len(self.sentiments))
+        self.hits += 1
+        return {
+            "category": self.categories[int(category_votes.argmax())],
+            "sentiment": self.sentiments[int(sentiment_votes.argmax())],
+            "similarity": round(float(weights.max()), 4),
+        }
+
+    async def bootstrap(self, supabase: Client, page_size: int = 1000, max_rows: int = 50000):
+        """Carga en el índice los tickets ya procesados de Supabase (solo si está vacío)."""
+        if self.count:
+            return
+        repository = TicketRepository(supabase)
+        loaded = 0
+        cursor = None
+        while loaded < max_rows:
+            # Keyset (created_at, id): cada página cuesta lo mismo, sin OFFSET
+            rows = await repository.page(
+                "id, created_at, description, category, sentiment",
+                min(page_size, max_rows - loaded),
+                cursor=cursor,
+                filters={"processed": True},
+                ascending=True,
+            )
+            if not rows:
+                break
+            cursor = (rows[-1]["created_at"], rows[-1]["id"])
+            loaded += await run_in_threadpool(self._add_rows, rows)
+            if len(rows) < page_size:
+                break
+        await run_in_threadpool(self.flush)
+        logger.info(f"Neighbors: Bootstrapped {loaded} rows from Supabase")
+
+    def _add_rows(self, rows: list) -> int:
+        added = 0
+        for row in rows:
+            description = row.get("description")
+            if description:
+                self.add(normalize_text(description), row.get("category"), row.get("sentiment"))
+                added += 1
+        return added
+
+    def close(self):
+        with self._lock:
+            if self._unflushed:
+                self._flush_locked()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": True,
+            "rows": self.count,
+            "capacity": self.capacity,
+            "dim": self.dim,
+            "threshold": self.threshold,
+            "top_k": self.top_k,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "added": self.added,
+        }
+
+
+class LinearTicketClassifier:
+    """Regresión logística (categoría y sentimiento) sobre n-gramas con hashing, solo NumPy.
+
+    Se entrena con ``train_classifier.py`` a partir de etiquetas del LLM y se
+    guarda como ``.npz`` versionado. Las probabilidades se calibran con una
+    temperatura por cabeza ajustada sobre un holdout.
+    """
+
+    def __init__(self, dim: int, heads: dict, version: str, info: Optional[dict] = None):
+        # heads: nombre -> {"labels": [...], "weights": (dim, C), "bias": (C,), "temperature": float}
+        self.dim = dim
+        self.heads = heads
+        self.version = version
+        self.info = info or {}
+
+    @classmethod
+    def load(cls, path: str) -> "LinearTicketClassifier":
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("vectorizer") != VECTORIZER_VERSION:
+                raise ValueError(f"Vectorizer {meta.get('vectorizer')} != {VECTORIZER_VERSION}")
+            heads = {
+                name: {
+                    "labels": meta["heads"][name]["labels"],
+                    "temperature": float(meta["heads"][name]["temperature"]),
+                    "weights": data[f"{name}_weights"].astype(np.float32),
+                    "bias": data[f"{name}_bias"].astype(np.float32),
+                }
+                for name in ("category", "sentiment")
+            }
+        return cls(dim=int(meta["dim"]), heads=heads, version=meta["version"], info=meta.get("metrics"))
+
+    def save(self, path: str):
+        meta = {
+            "version": self.version,
+            "vectorizer": VECTORIZER_VERSION,
+            "dim": self.dim,
+            "heads": {
+                name: {"labels": head["labels"], "temperature": head["temperature"]}
+                for name, head in self.heads.items()
+            },
+            "metrics": self.info,
+        }
+        arrays = {"meta": np.array(json.dumps(meta, ensure_ascii=False))}
+        for name, head in self.heads.items():
+            arrays[f"{name}_weights"] = head["weights"]
+            arrays[f"{name}_bias"] = head["bias"]
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def predict_proba(self, vector) -> dict:
+        """Probabilidades calibradas por cabeza para un vector de hashed_ngram_vector."""
+        probabilities = {}
+        for name, head in self.heads.items():
+            logits = (vector @ head["weights"] + head["bias"]) / head["temperature"]
+            logits -= logits.max()
+            exp = np.exp(logits)
+            probabilities[name] = exp / exp.sum()
+        return probabilities
+
+    def predict(self, normalized_text: str) -> Optional[dict]:
+        vector = hashed_ngram_vector(normalized_text, self.dim)
+        if vector is None:
+            return None
+        probabilities = self.predict_proba(vector)
+        result = {}
+        for name, probs in probabilities.items():
+            best = int(probs.argmax())
+            result[name] = self.heads[name]["labels"][best]
+            result[f"{name}_probability"] = float(probs[best])
+        # Confianza del ticket: la menor de las dos cabezas
+        result["confidence"] = min(result["category_probability"], result["sentiment_probability"])
+        return result
+
+    def stats(self) -> dict:
+        return {"enabled": True, "version": self.version, "dim": self.dim, "metrics": self.info}
+
+
+_label_log_lock = threading.Lock()
+
+
+def _record_llm_label(normalized_text: str, result: dict):
+    """Anexa la etiqueta del LLM a LOCAL_MODEL_LABEL_LOG (JSONL) para reentrenar."""
+    path = os.getenv("LOCAL_MODEL_LABEL_LOG")
+    if not path:
+        return
+    line = json.dumps(
+        {"normalized_text": normalized_text, "category": result["category"], "sentiment": result["sentiment"]},
+        ensure_ascii=False,
+    )
+    try:
+        with _label_log_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logger.warning(f"Classification: Could not write label log - {e}")
+
+
+_neighbor_index: Optional[NeighborIndex] = None
+_neighbor_index_lock = threading.Lock()
+
+
+def get_neighbor_index() -> Optional[NeighborIndex]:
+    global _neighbor_index
+    if not _env_flag("NEIGHBOR_ENABLED"):
+        return None
+    if np is None:
+        return None
+    if _neighbor_index is None:
+        with _neighbor_index_lock:
+            if _neighbor_index is None:
+                _neighbor_index = NeighborIndex.from_env()
+    return _neighbor_index
+
+
+class SingleFlight:
+    """Deduplica trabajo en vuelo: llamadas concurrentes con la misma clave comparten resultado.
+
+    El resultado se publica en un ``concurrent.futures.Future`` protegido por un
+    lock de hilo, así que también lo pueden esperar corrutinas de otros event
+    loops (p. ej. workers del threadpool que corren su propio loop). El trabajo
+    del líder corre en su propia tarea: si quien lo inició se cancela, los demás
+    siguen recibiendo el resultado.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, factory) -> dict:
+        with self._lock:
+            shared = self._inflight.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._inflight[key] = concurrent.futures.Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            COALESCED_REQUESTS.inc()
+            return dict(await asyncio.wrap_future(shared))
+        task = asyncio.ensure_future(self._lead(key, shared, factory))
+        return dict(await asyncio.shield(task))
+
+    async def _lead(self, key: str, shared: concurrent.futures.Future, factory) -> dict:
+        try:
+            result = await factory()
+        except BaseException as e:
+            shared.set_exception(e)
+            raise
+        else:
+            shared.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            inflight = len(self._inflight)
+        return {
+            "enabled": _env_flag("CLASSIFY_COALESCE_ENABLED", "true"),
+            "inflight": inflight,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+inflight_classifications = SingleFlight()
+
+
+async def classify_ticket(description: str, use_cache: bool = True, use_neighbors: bool = True) -> dict:
+    """Clasifica por tiers. ``use_cache``/``use_neighbors=False`` no leen etiquetas
+    ya guardadas (reclasificación tras cambiar modelo, prompt o categorías)."""
+    result = await _classify_ticket(description, use_cache, use_neighbors)
+    CLASSIFICATIONS.inc(source=result.get("source", "unknown"))
+    return result
+
+
+async def _classify_segments(
+    llm: OpenAICompatibleAPI, segments: list, description: str, template: PromptTemplate
+) -> dict:
+    """Clasifica los segmentos de un ticket largo en paralelo y combina por votación.
+
+    Los empates se resuelven por orden de aparición (gana el inicio del ticket).
+    """
+    results = await asyncio.gather(*(
+        _classify_with_llm(llm, segment, description, template) for segment in segments
+    ))
+    votes = [result for result in results if result.get("source") == "llm"]
+    if not votes:
+        return results[0]
+    category = TallyCounter(result["category"] for result in votes).most_common(1)[0][0]
+    sentiment = TallyCounter(result["sentiment"] for result in votes).most_common(1)[0][0]
+    return {"category": category, "sentiment": sentiment, "source": "llm"}
+
+
+async def _classify_ticket(description: str, use_cache: bool = True, use_neighbors: bool = True) -> dict:
+    budget = get_input_budget()
+    with STAGE_SECONDS.time(stage="normalize"):
+        full_text = normalize_text(description)
+        segments = budget.segments(full_text)
+        normalized_text = budget.truncate(full_text)
+    llm = llm_client()
+    # La plantilla forma parte de la clave: variantes del A/B y versiones nuevas no comparten caché
+    selector = get_prompt_selector()
+    template = selector.pick(normalized_text)
+    cache = get_classification_cache() if llm else None
+    cache_key = ClassificationCache.make_key(normalized_text, llm.model, template.name) if cache else None
+    if cache and use_cache:
+        # LRU en el event loop; el nivel SQLite, en el threadpool
+        cached = cache.get_memory(cache_key)
+        if cached is None and cache.has_disk:
+            cached = await run_in_threadpool(cache.get_disk, cache_key)
+        if cached is not None:
+            return {**cached, "source": "cache"}
+
+    # Tier local: vecinos ya clasificados muy parecidos resuelven sin LLM
+    neighbors = get_neighbor_index()
+    if neighbors is not None and use_neighbors:
+        with STAGE_SECONDS.time(stage="neighbors"):
+            # Escaneo O(N·dim) bajo lock: fuera del event loop
+            match = await run_in_threadpool(neighbors.lookup, normalized_text)
+        if match is not None:
+            return {"category": match["category"], "sentiment": match["sentiment"], "source": "neighbors"}
+
+    # Modelo lineal local: solo los tickets con baja probabilidad calibrada pasan al LLM
+    local_model = clients.local_model()
+    if local_model is not None and llm:
+        with STAGE_SECONDS.time(stage="local_model"):
+            prediction = local_model.predict(normalized_text)
+        threshold = float(os.getenv("LOCAL_MODEL_THRESHOLD", "0.9"))
+        if prediction is not None and prediction["confidence"] >= threshold:
+            return {"category": prediction["category"], "sentiment": prediction["sentiment"], "source": "local_model"}
+
+    if not llm:
+        logger.info("Classification: Using rules fallback (LLM not available)")
+        return _rules_fallback(normalized_text)
+
+    # Con el breaker abierto no se espera al LLM: reglas directamente
+    if get_llm_breaker().rejecting():
+        return _rules_fallback(normalized_text, "breaker_open")
+
+    async def classify_with_llm() -> dict:
+        batcher = get_batcher()
+        if segments:
+            result = await _classify_segments(llm, segments, description, template)
+        elif batcher is not None and template is selector.default:
+            # Los lotes usan siempre la plantilla por defecto
+            result = await batcher.submit(normalized_text, description)
+        else:
+            result = await _classify_with_llm(llm, normalized_text, description, template)
+        # Solo se cachean respuestas del LLM: un fallback por caída no debe persistir.
+        # También sin use_cache: la etiqueta nueva reemplaza a la vieja
+        if result.get("source") == "llm":
+            if cache:
+                cache.set_memory(cache_key, result)
+                if cache.has_disk:
+                    await run_in_threadpool(cache.set_disk, cache_key, result)
+            if neighbors is not None:
+                await run_in_threadpool(neighbors.add, normalized_text, result["category"], result["sentiment"])
+            if os.getenv("LOCAL_MODEL_LABEL_LOG"):
+                await run_in_threadpool(_record_llm_label, normalized_text, result)
+        return result
+
+    if not _env_flag("CLASSIFY_COALESCE_ENABLED", "true"):
+        return await classify_with_llm()
+    # Textos idénticos en vuelo comparten una sola llamada al LLM
+    return await inflight_classifications.run(
+        f"{llm.model}\0{template.name}\0{normalized_text}", classify_with_llm
+    )
+
+
+def notify_n8n_if_negative(description: str, category: str, sentiment: str, ticket_id: Optional[str] = None):
+    if sentiment.lower() != "negativo":
+        return
+    
+    n8n_webhook_url = os.getenv("N8N_WEBHOOK_URL")
+    if not n8n_webhook_url:
+        return
+    
+    try:
+        payload = _n8n_payload(description, category, sentiment, ticket_id)
+        
+        with STAGE_SECONDS.time(stage="n8n_webhook"):
+            response = requests.post(
+                n8n_webhook_url,
+                json=payload,
+                timeout=5,
+                headers={"Content-Type": "application/json"}
+            )
+        N8N_RESPONSES.inc(status=response.status_code)
+    except Exception as e:
+        N8N_RESPONSES.inc(status="error")
+        logger.warning(f"n8n: Failed to notify webhook - {type(e).__name__}: {e}")
+
+
+def _n8n_payload(description: str, category: str, sentiment: str, ticket_id: Optional[str]) -> dict:
+    payload = {
+        "description": description,
+        "category": category,
+        "sentiment": sentiment,
+    }
+    if ticket_id:
+        payload["id"] = ticket_id
+    return payload
+
+
+class N8nOutbox:
+    """Outbox durable para las notificaciones a n8n.
+
+    Cada notificación se guarda en SQLite (tabla ``outbox``) y en una cola en
+    memoria; una tarea de fondo la entrega sobre un cliente HTTP con keep-alive.
+    Los envíos fallidos (error de red o status no 2xx) se reintentan con backoff
+    exponencial leyendo de SQLite, así que sobreviven a reinicios de n8n y de la
+    API; agotados los intentos pasan a ``dead_outbox``. Con ``batch_size > 1`` se
+    envían varios tickets por llamada como ``{"tickets": [...]}`` (el workflow de
+    n8n debe aceptar ese formato).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        webhook_url: str,
+        batch_size: int = 1,
+        batch_window: float = 0.2,
+        max_attempts: int = 20,
+        max_backoff: float = 300.0,
+        timeout: float = 5.0,
+    ):
+        self.path = path
+        self.webhook_url = webhook_url
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("pragma synchronous=normal")
+        self._db.executescript(
+            """
+            create table if not exists outbox (
+                id integer primary key autoincrement,
+                payload text not null,
+                attempts integer not null default 0,
+                available_at real not null,
+                last_error text,
+                created_at real not null
+            );
+            create index if not exists outbox_retry on outbox (attempts, available_at);
+            create table if not exists dead_outbox (
+                id integer primary key,
+                payload text not null,
+                attempts integer not null,
+                last_error text,
+                created_at real not null,
+                failed_at real not null
+            );
+            """
+        )
+        self._lock = threading.Lock()
+        self._ready: deque = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.delivered = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.batches_sent = 0
+
+    @classmethod
+    def from_env(cls) -> "N8nOutbox":
+        return cls(
+            path=os.getenv("N8N_OUTBOX_PATH", "n8n_outbox.db"),
+            webhook_url=os.getenv("N8N_WEBHOOK_URL", ""),
+            batch_size=int(os.getenv("N8N_BATCH_SIZE", "1")),
+            batch_window=float(os.getenv("N8N_BATCH_WINDOW_MS", "200")) / 1000.0,
+            max_attempts=int(os.getenv("N8N_OUTBOX_MAX_ATTEMPTS", "20")),
+            max_backoff=float(os.getenv("N8N_OUTBOX_MAX_BACKOFF_SECONDS", "300")),
+            timeout=float(os.getenv("N8N_TIMEOUT", "5")),
+        )
+
+    def enqueue(self, payload: dict):
+        now = time.time()
+        body = json.dumps(payload, ensure_ascii=False)
+        with self._lock:
+            cursor = self._db.execute(
+                "insert into outbox (payload, available_at, created_at) values (?, ?, ?)",
+                (body, now, now),
+            )
+        self._ready.append((cursor.lastrowid, 0, payload))
+        if self._wakeup is not None:
+            # Se llama desde el threadpool: el Event del dispatcher se toca en su loop
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _load_pending(self):
+        """Al arrancar: lo que quedó sin entregar vuelve a la cola en memoria."""
+        with self._lock:
+            rows = self._db.execute(
+                "select id, attempts, payload from outbox where attempts = 0 order by id"
+            ).fetchall()
+        for row_id, attempts, body in rows:
+            self._ready.append((row_id, attempts, json.loads(body)))
+
+    def _due_retries(self, limit: int) -> list:
+        with self._lock:
+            rows = self._db.execute(
+                "select id, attempts, payload from outbox where attempts > 0 and available_at <= ? "
+                "order by available_at limit ?",
+                (time.time(), limit),
+            ).fetchall()
+        return [(row_id, attempts, json.loads(body)) for row_id, attempts, body in rows]
+
+    def _complete(self, items: list):
+        with self._lock:
+            self._db.executemany("delete from outbox where id = ?", [(item[0],) for item in items])
+        self.delivered += len(items)
+
+    def _fail(self, items: list, error: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute("begin")
+            for row_id, attempts, _ in items:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self._db.execute(
+                        "insert or replace into dead_outbox (id, payload, attempts, last_error, created_at, failed_at) "
+                        "select id, payload, ?, ?, created_at, ? from outbox where id = ?",
+                        (attempts, error, now, row_id),
+                    )
+                    self._db.execute("delete from outbox where id = ?", (row_id,))
+                    self.dead_lettered += 1
+                    continue
+                backoff = min(self.max_backoff, 2.0 ** attempts)
+                self._db.execute(
+                    "update outbox set attempts = ?, available_at = ?, last_error = ? where id = ?",
+                    (attempts, now + backoff, error, row_id),
+                )
+                self.retried += 1
+            self._db.execute("commit")
+
+    async def _send(self, items: list):
+        if self.batch_size > 1:
+            body = {"tickets": [payload for _, _, payload in items]}
+        else:
+            body = items[0][2]
+        try:
+            with STAGE_SECONDS.time(stage="n8n_webhook"):
+                response = await self._client.post(self.webhook_url, json=body)
+            N8N_RESPONSES.inc(status=response.status_code)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            if not isinstance(e, httpx.HTTPStatusError):
+                N8N_RESPONSES.inc(status="error")
+            logger.warning(f"n8n: Delivery of {len(items)} notification(s) failed - {type(e).__name__}: {e}")
+            await run_in_threadpool(self._fail, items, f"{type(e).__name__}: {e}")
+            return
+        self.batches_sent += 1
+        await run_in_threadpool(self._complete, items)
+
+    async def _take_batch(self) -> list:
+        items = []
+        while self._ready and len(items) < self.batch_size:
+            items.append(self._ready.popleft())
+        if items and len(items) < self.batch_size and self.batch_window > 0:
+            # Ventana corta para juntar más tickets en la misma llamada
+            await asyncio.sleep(self.batch_window)
+            while self._ready and len(items) < self.batch_size:
+                items.append(self._ready.popleft())
+        if len(items) < self.batch_size:
+            items.extend(await run_in_threadpool(self._due_retries, self.batch_size - len(items)))
+        return items
+
+    async def _run(self):
+        poll_seconds = float(os.getenv("N8N_OUTBOX_POLL_SECONDS", "1"))
+        while True:
+            try:
+                items = await self._take_batch()
+                if items:
+                    await self._send(items)
+                    continue
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"n8n: Outbox dispatcher error - {type(e).__name__}: {e}")
+                await asyncio.sleep(poll_seconds)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+        )
+        self._load_pending()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"n8n: Outbox dispatcher started on {self.path} ({len(self._ready)} pending)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = self._db.execute("select count(*) from outbox").fetchone()[0]
+            dead = self._db.execute("select count(*) from dead_outbox").fetchone()[0]
+        return {
+            "enabled": True,
+            "pending": pending,
+            "in_memory": len(self._ready),
+            "dead": dead,
+            "batch_size": self.batch_size,
+            "delivered": self.delivered,
+            "batches_sent": self.batches_sent,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+        }
+
+
+n8n_outbox: Optional[N8nOutbox] = None
+
+
+async def notify_negative(description: str, category: str, sentiment: str, ticket_id: Optional[str] = None):
+    """Notifica a n8n un ticket negativo: por el outbox si está activo, si no en el threadpool."""
+    if n8n_outbox is None:
+        await run_in_threadpool(notify_n8n_if_negative, description, category, sentiment, ticket_id)
+        return
+    if sentiment.lower() != "negativo":
+        return
+    # INSERT + commit en SQLite bajo el lock del outbox: fuera del event loop
+    await run_in_threadpool(n8n_outbox.enqueue, _n8n_payload(description, category, sentiment, ticket_id))
+
+
+_SUPABASE_STAGES = {"GET": "supabase_select", "HEAD": "supabase_select", "POST": "supabase_insert", "PATCH": "supabase_update", "DELETE": "supabase_delete"}
+
+
+def _timed_execute(query):
+    """Ejecuta una consulta de Supabase midiendo su etapa (select/insert/upsert/update/delete)."""
+    method = str(getattr(query, "http_method", "")).upper()
+    stage = _SUPABASE_STAGES.get(method, "supabase_other")
+    if method == "POST" and "resolution=" in str(getattr(query, "headers", {}).get("Prefer", "")):
+        stage = "supabase_upsert"
+    elif "/rpc/" in str(getattr(query, "path", "")):
+        stage = "supabase_rpc"
+    with STAGE_SECONDS.time(stage=stage):
+        return query.execute()
+
+
+async def _execute(query):
+    """Ejecuta una consulta del cliente síncrono de Supabase fuera del event loop."""
+    return await run_in_threadpool(_timed_execute, query)
+
+
+def _returning(query, columns: str):
+    """Limita las columnas que devuelve un insert/update/delete (``select`` de PostgREST)."""
+    query.params = query.params.set("select", columns)
+    return query
+
+
+class TicketRepository:
+    """Acceso a ``tickets`` con una sola ida y vuelta por operación.
+
+    Las escrituras devuelven solo las columnas pedidas (``returning``) y la
+    existencia se deduce del resultado: ``update``/``delete`` devuelven None si
+    ningún registro coincidió, sin un select previo.
+    """
+
+    def __init__(self, supabase: Client):
+        self.supabase = supabase
+
+    def _table(self):
+        return self.supabase.table("tickets")
+
+    async def insert(self, fields, columns: str = "id") -> list:
+        result = await _execute(_returning(self._table().insert(fields), columns))
+        return result.data or []
+
+    async def update(self, ticket_id: str, fields: dict, columns: Optional[str] = "id") -> Optional[dict]:
+        """Actualiza y devuelve la fila (None si no existe). ``columns=None``: sin cuerpo de respuesta."""
+        if columns is None:
+            await _execute(self._table().update(fields, returning=ReturnMethod.minimal).eq("id", ticket_id))
+            return None
+        result = await _execute(_returning(self._table().update(fields).eq("id", ticket_id), columns))
+        return result.data[0] if result.data else None
+
+    async def delete(self, ticket_id: str, columns: str = "id") -> Optional[dict]:
+        result = await _execute(_returning(self._table().delete().eq("id", ticket_id), columns))
+        return result.data[0] if result.data else None
+
+    async def upsert(self, rows: list):
+        await _execute(self._table().upsert(rows, returning=ReturnMethod.minimal))
+
+    async def update_labels(self, rows: list, only_unprocessed: bool = False) -> list:
+        """Guarda category/sentiment/processed de muchas filas con un UPDATE por id (RPC ``apply_ticket_labels``).
+
+        No escribe description ni inserta: una fila borrada o ya procesada
+        (con ``only_unprocessed``) simplemente no aparece en el resultado,
+        que trae ``id``, ``created_at`` y ``description`` de las filas actualizadas.
+        """
+        labels = [{"id": row["id"], "category": row["category"], "sentiment": row["sentiment"]} for row in rows]
+        result = await _execute(
+            self.supabase.rpc("apply_ticket_labels", {"rows": labels, "only_unprocessed": only_unprocessed})
+        )
+        return result.data or []
+
+    async def page(
+        self,
+        columns: str,
+        limit: int,
+        cursor: Optional[tuple] = None,
+        filters: Optional[dict] = None,
+        ascending: bool = False,
+    ) -> list:
+        """Página keyset en orden ``(created_at, id)`` (descendente por defecto), sin OFFSET."""
+        query = self._table().select(columns)
+        for column, value in (filters or {}).items():
+            query = query.eq(column, value)
+        if cursor:
+            created_at, ticket_id = cursor
+            op = "gt" if ascending else "lt"
+            query = query.or_(
+                f'created_at.{op}."{created_at}",and(created_at.eq."{created_at}",id.{op}.{ticket_id})'
+            )
+        desc = not ascending
+        result = await _execute(query.order("created_at", desc=desc).order("id", desc=desc).limit(limit))
+        return result.data or []
+
+    async def stats(self) -> list:
+        """Filas de ``ticket_stats``: conteos por (categoría, sentimiento, processed) mantenidos por trigger."""
+        result = await _execute(self.supabase.table("ticket_stats").select("category, sentiment, processed, total"))
+        return result.data or []
+
+
+TICKET_COLUMNS = ("id", "created_at", "description", "category", "sentiment", "processed")
+
+
+def _encode_cursor(row: dict) -> str:
+    raw = json.dumps([row["created_at"], row["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, ticket_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Los valores se interpolan en el filtro or=() de PostgREST: solo formatos esperados
+    if not re.fullmatch(r"[0-9T:.+\- ]+", str(created_at)) or not re.fullmatch(r"[0-9a-fA-F-]+", str(ticket_id)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, ticket_id
+
+
+def _ticket_columns(fields: Optional[str]) -> str:
+    """Proyección pedida con ``fields``; ``created_at`` e ``id`` siempre van para el cursor."""
+    if not fields:
+        return ", ".join(TICKET_COLUMNS)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in TICKET_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ", ".join(column for column in TICKET_COLUMNS if column in {"id", "created_at", *requested})
+
+
+def _classified_fields(classification: dict) -> dict:
+    return {
+        "category": classification["category"],
+        "sentiment": classification["sentiment"],
+        "processed": True,
+    }
+
+
+class TicketEventHub:
+    """Fan-out de cambios de tickets a los dashboards por SSE.
+
+    Los handlers publican deltas compactos (``upsert`` con los campos que
+    cambiaron o ``delete``); cada ventana de ``window`` segundos se agrupan en un
+    solo frame, fusionando los cambios del mismo ticket, que se serializa una vez
+    y se reparte a todas las conexiones. Un ring buffer con los últimos eventos
+    permite reanudar desde ``Last-Event-ID`` (``<época>-<secuencia>``); si el
+    hueco ya no está en el buffer o el proceso se reinició, el cliente recibe
+    ``reset`` y debe volver a pedir ``GET /tickets``. Un suscriptor que no
+    consume a tiempo se desconecta y reanuda con su último id.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int = 10000,
+        window: float = 0.1,
+        subscriber_queue: int = 256,
+        heartbeat: float = 15.0,
+    ):
+        self.window = window
+        self.subscriber_queue = subscriber_queue
+        self.heartbeat = heartbeat
+        self.epoch = format(int(time.time() * 1000), "x")
+        self.seq = 0
+        self.flushed_seq = 0
+        self._events: deque = deque(maxlen=buffer_size)
+        self._pending: dict = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._subscribers: set = set()
+        self.published = 0
+        self.frames = 0
+        self.dropped_subscribers = 0
+
+    @classmethod
+    def from_env(cls) -> "TicketEventHub":
+        return cls(
+            buffer_size=int(os.getenv("TICKET_EVENTS_BUFFER", "10000")),
+            window=float(os.getenv("TICKET_EVENTS_WINDOW_MS", "100")) / 1000.0,
+            subscriber_queue=int(os.getenv("TICKET_EVENTS_SUBSCRIBER_QUEUE", "256")),
+            heartbeat=float(os.getenv("TICKET_EVENTS_HEARTBEAT_SECONDS", "15")),
+        )
+
+    @staticmethod
+    def _merge(pending: dict, event: dict):
+        """Fusiona un evento en ``pending`` (por id): los upserts acumulan campos, delete gana."""
+        previous = pending.pop(event["id"], None)
+        if previous is not None and previous["op"] == "upsert" and event["op"] == "upsert":
+            event = {**previous, **event}
+        pending[event["id"]] = event
+
+    def publish(self, op: str, ticket_id: str, fields: Optional[dict] = None):
+        """Registra un cambio; debe llamarse desde el event loop."""
+        self.seq += 1
+        self.published += 1
+        event = {"op": op, "id": ticket_id, **(fields or {}), "seq": self.seq}
+        self._events.append(event)
+        self._merge(self._pending, event)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _frame(self, name: str, seq: int, events: Optional[list] = None) -> bytes:
+        payload = {"seq": seq}
+        if events is not None:
+            payload["events"] = [{key: value for key, value in event.items() if key != "seq"} for event in events]
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        return f"id: {self.epoch}-{seq}\nevent: {name}\ndata: {data}\n\n".encode("utf-8")
+
+    def _flush(self):
+        self._flush_handle = None
+        events = list(self._pending.values())
+        self._pending.clear()
+        if not events:
+            return
+        self.flushed_seq = self.seq
+        frame = self._frame("tickets", self.flushed_seq, events)
+        self.frames += 1
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._drop(queue)
+
+    def _drop(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        self.dropped_subscribers += 1
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def _replay(self, last_event_id: Optional[str]) -> bytes:
+        """Frame inicial: ``ready``, los eventos perdidos desde ``last_event_id`` o ``reset``."""
+        if not last_event_id:
+            return self._frame("ready", self.flushed_seq)
+        epoch, _, seq = last_event_id.partition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.flushed_seq:
+            return self._frame("reset", self.flushed_seq)
+        since = int(seq)
+        if since == self.flushed_seq:
+            return self._frame("ready", self.flushed_seq)
+        oldest = self._events[0]["seq"] if self._events else self.seq + 1
+        if since + 1 < oldest:
+            return self._frame("reset", self.flushed_seq)
+        pending = {}
+        for event in itertools.islice(self._events, since + 1 - oldest, None):
+            if event["seq"] > self.flushed_seq:
+                break
+            self._merge(pending, event)
+        return self._frame("tickets", self.flushed_seq, list(pending.values()))
+
+    async def subscribe(self, last_event_id: Optional[str] = None):
+        """Genera los frames SSE de una conexión hasta que se cierre o se quede atrás."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.subscriber_queue)
+        self._subscribers.add(queue)
+        try:
+            yield self._replay(last_event_id)
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            self._subscribers.discard(queue)
+
+    def reset(self):
+        """Pide a todos los suscriptores recargar el snapshot (p. ej. tras un hueco upstream)."""
+        self._flush()
+        frame = self._frame("reset", self.flushed_seq)
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._drop(queue)
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for queue in list(self._subscribers):
+            self._drop(queue)
+
+    def stats(self) -> dict:
+        return {
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "subscribers": len(self._subscribers),
+            "buffered": len(self._events),
+            "published": self.published,
+            "frames": self.frames,
+            "dropped_subscribers": self.dropped_subscribers,
+            "window_ms": round(self.window * 1000, 1),
+        }
 
-Responde SOLO con JSON válido. Ejemplo de formato:
-{{"category": "Técnico", "sentiment": "Negativo"}}
 
-Ticket a clasificar: {normalized_text}"""
-            
-            start_time = time.time()
+ticket_events: Optional[TicketEventHub] = None
+
+
+def _feed_live() -> bool:
+    # Con la suscripción upstream activa los cambios llegan por ahí: publicarlos aquí los duplicaría
+    return ticket_feed is not None and ticket_feed.subscribed
+
+
+def publish_ticket_change(ticket_id: Optional[str], **fields):
+    """Publica un delta ``upsert`` para los dashboards conectados a /tickets/events."""
+    if ticket_events is not None and ticket_id and not _feed_live():
+        ticket_events.publish("upsert", ticket_id, fields)
+
+
+def publish_ticket_delete(ticket_id: str):
+    if ticket_events is not None and not _feed_live():
+        ticket_events.publish("delete", ticket_id)
+
+
+class SupabaseTicketFeed:
+    """Suscripción única del proceso a los cambios de ``tickets`` en Supabase realtime.
+
+    Escucha ``postgres_changes`` y publica cada fila en el ``TicketEventHub``,
+    así los dashboards reciben también lo que no pasa por los handlers de este
+    proceso (otras réplicas, inserts directos, ``reclassify.py``, SQL manual)
+    con una conexión upstream por réplica en lugar de una por pestaña. Mientras
+    está suscrita, los handlers no publican sus propios deltas. Si se cae, los
+    handlers vuelven a publicar y, al recuperarla, el hub envía ``reset`` para
+    que los dashboards recarguen lo que se perdió en el hueco.
+    """
+
+    _LOST_STATES = {"CHANNEL_ERROR", "TIMED_OUT", "CLOSED"}
+
+    def __init__(self, url: str, key: str, hub: TicketEventHub, retry_interval: float = 5.0):
+        self.url = url
+        self.key = key
+        self.hub = hub
+        self.retry_interval = retry_interval
+        self.subscribed = False
+        self._lost: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.reconnects = 0
+
+    @classmethod
+    def from_env(cls, hub: TicketEventHub) -> Optional["SupabaseTicketFeed"]:
+        url = os.getenv("SUPABASE_URL")
+        key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+        if not url or not key:
+            return None
+        return cls(url, key, hub, retry_interval=float(os.getenv("TICKET_EVENTS_UPSTREAM_RETRY_SECONDS", "5")))
+
+    def _on_change(self, payload: dict):
+        data = payload.get("data", payload)
+        self.received += 1
+        if data.get("type") == "DELETE":
+            ticket_id = (data.get("old_record") or {}).get("id")
+            if ticket_id:
+                self.hub.publish("delete", ticket_id)
+            return
+        record = data.get("record") or {}
+        if record.get("id"):
+            fields = {column: record[column] for column in TICKET_COLUMNS if column != "id" and column in record}
+            self.hub.publish("upsert", record["id"], fields)
+
+    def _on_status(self, status, error: Optional[Exception] = None):
+        status = getattr(status, "value", status)
+        if status == "SUBSCRIBED":
+            if self.reconnects:
+                # Lo ocurrido mientras no había suscripción no llegó al hub
+                self.hub.reset()
+            self.subscribed = True
+            logger.info("Ticket feed: Subscribed to Supabase realtime")
+        elif status in self._LOST_STATES:
+            self.subscribed = False
+            if error is not None:
+                logger.warning(f"Ticket feed: {status} - {type(error).__name__}: {error}")
+            if self._lost is not None:
+                self._lost.set()
+
+    async def _listen_once(self):
+        client = await acreate_client(self.url, self.key)
+        try:
+            channel = client.channel("tickets-feed")
+            channel.on_postgres_changes("*", schema="public", table="tickets", callback=self._on_change)
+            await channel.subscribe(self._on_status)
+            await self._lost.wait()
+        finally:
+            self.subscribed = False
             try:
-                response = llm.invoke(prompt_text)
-            except requests.exceptions.HTTPError as e:
-                if e.response and e.response.status_code == 503:
-                    logger.warning("LLM: Model is loading, will retry...")
-                    if attempt < max_retries - 1:
-                        time.sleep(2)
-                        continue
+                await client.remove_all_channels()
+            except Exception as e:
+                logger.debug(f"Ticket feed: Cleanup failed - {type(e).__name__}: {e}")
+
+    async def _run(self):
+        while True:
+            self._lost = asyncio.Event()
+            try:
+                await self._listen_once()
+            except asyncio.CancelledError:
                 raise
-            elapsed = time.time() - start_time
-            
-            logger.info(f"LLM: Response received in {elapsed:.2f}s, length: {len(response) if response else 0}")
-            
-            if not response or not response.strip():
-                raise ValueError("Empty response from LLM")
-            
-            logger.debug(f"LLM: Raw response: {response[:200]}...")
-            
-            result = parse_json_from_text(response)
-            
-            if not isinstance(result, dict):
-                raise ValueError("Response is not a dictionary")
-            
-            category = normalize_category(result.get("category", ""))
-            sentiment = normalize_sentiment(result.get("sentiment", ""))
-            
-            if not category or not sentiment:
-                raise ValueError(f"Missing category or sentiment - category: {category}, sentiment: {sentiment}")
-            
-            if category not in ALLOWED_CATEGORIES:
-                raise ValueError(f"Invalid category: {category}")
-            
-            if sentiment not in ALLOWED_SENTIMENTS:
-                raise ValueError(f"Invalid sentiment: {sentiment}")
-            
-            confidence = 1.0
-            
-            response_lower = response.lower()
-            uncertainty_indicators = [
-                "no estoy seguro", "no sé", "tal vez", "quizás", 
-                "posiblemente", "probablemente", "?", "maybe"
-            ]
-            if any(indicator in response_lower for indicator in uncertainty_indicators):
-                confidence = min(confidence, 0.4)
-                logger.warning(f"LLM: Low confidence detected due to uncertainty indicators")
-            
-            if len(response) > 500:
-                confidence = min(confidence, 0.5)
-                logger.warning(f"LLM: Low confidence due to long response ({len(response)} chars)")
-            
-            threshold = float(os.getenv("LLM_CONFIDENCE_THRESHOLD", "0.5"))
-            if confidence < threshold:
-                logger.warning(f"LLM: Confidence {confidence} below threshold {threshold}, using rules fallback")
-                return classify_with_rules(normalized_text)
-            
-            logger.info(f"LLM: Successfully classified - Category: {category}, Sentiment: {sentiment}")
-            return {"category": category, "sentiment": sentiment}
-            
-        except Exception as e:
-            error_type = type(e).__name__
-            error_msg = str(e)
-            logger.error(f"LLM: Classification attempt {attempt + 1} failed - {error_type}: {error_msg}")
-            if attempt < max_retries - 1:
-                logger.info(f"LLM: Retrying in 0.5s...")
-                time.sleep(0.5)
+            except Exception as e:
+                logger.error(f"Ticket feed: Subscription failed - {type(e).__name__}: {e}")
+            self.reconnects += 1
+            await asyncio.sleep(self.retry_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info("Ticket feed: Started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "subscribed": self.subscribed,
+            "received": self.received,
+            "reconnects": self.reconnects,
+        }
+
+
+ticket_feed: Optional[SupabaseTicketFeed] = None
+
+
+async def _classify_and_store(supabase: Client, ticket_id: str, description: str) -> dict:
+    """Clasifica un ticket ya insertado, guarda el resultado y notifica a n8n."""
+    classification = await classify_ticket(description)
+
+    await TicketRepository(supabase).update(ticket_id, _classified_fields(classification), columns=None)
+    publish_ticket_change(ticket_id, **_classified_fields(classification))
+
+    await notify_negative(
+        description,
+        classification["category"],
+        classification["sentiment"],
+        ticket_id
+    )
+    return classification
+
+
+class TicketJobQueue:
+    """Cola persistente de clasificaciones pendientes en un SQLite local.
+
+    ``/create-ticket`` inserta el ticket, encola un job y responde 202; un pool de
+    workers asyncio reclama jobs con un lease (si un proceso muere, el job vuelve
+    a estar disponible al expirar), clasifica, actualiza Supabase y notifica a
+    n8n. Los fallos se reintentan con backoff exponencial y, agotados los
+    intentos, el job pasa a la tabla ``dead_jobs``.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 5, lease_seconds: float = 120.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.executescript(
+            """
+            create table if not exists jobs (
+                id integer primary key autoincrement,
+                ticket_id text not null,
+                description text not null,
+                status text not null default 'pending',
+                attempts integer not null default 0,
+                available_at real not null,
+                lease_expires_at real,
+                last_error text,
+                created_at real not null
+            );
+            create index if not exists jobs_claim on jobs (status, available_at);
+            create table if not exists dead_jobs (
+                id integer primary key,
+                ticket_id text not null,
+                description text not null,
+                attempts integer not null,
+                last_error text,
+                created_at real not null,
+                failed_at real not null
+            );
+            """
+        )
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._workers: list = []
+        self.processed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    @classmethod
+    def from_env(cls) -> "TicketJobQueue":
+        return cls(
+            path=os.getenv("JOB_QUEUE_PATH", "jobs.db"),
+            max_attempts=int(os.getenv("JOB_QUEUE_MAX_ATTEMPTS", "5")),
+            lease_seconds=float(os.getenv("JOB_QUEUE_LEASE_SECONDS", "120")),
+        )
+
+    def enqueue(self, ticket_id: str, description: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "insert into jobs (ticket_id, description, available_at, created_at) values (?, ?, ?, ?)",
+                (ticket_id, description, now, now),
+            )
+        if self._wakeup is not None:
+            # Se llama desde el threadpool: asyncio.Event no es thread-safe
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def claim(self) -> Optional[tuple]:
+        now = time.time()
+        with self._lock:
+            return self._db.execute(
+                """
+                update jobs set status = 'running', attempts = attempts + 1, lease_expires_at = ?
+                where id = (
+                    select id from jobs
+                    where (status = 'pending' and available_at <= ?)
+                       or (status = 'running' and lease_expires_at < ?)
+                    order by id limit 1
+                )
+                returning id, ticket_id, description, attempts
+                """,
+                (now + self.lease_seconds, now, now),
+            ).fetchone()
+
+    def complete(self, job_id: int):
+        with self._lock:
+            self._db.execute("delete from jobs where id = ?", (job_id,))
+        self.processed += 1
+
+    def fail(self, job_id: int, attempts: int, error: str):
+        now = time.time()
+        with self._lock:
+            if attempts >= self.max_attempts:
+                self._db.execute("begin")
+                self._db.execute(
+                    "insert or replace into dead_jobs (id, ticket_id, description, attempts, last_error, created_at, failed_at) "
+                    "select id, ticket_id, description, attempts, ?, created_at, ? from jobs where id = ?",
+                    (error, now, job_id),
+                )
+                self._db.execute("delete from jobs where id = ?", (job_id,))
+                self._db.execute("commit")
+                self.dead_lettered += 1
+                return
+            backoff = min(300.0, 2.0 ** attempts)
+            self._db.execute(
+                "update jobs set status = 'pending', available_at = ?, last_error = ?, lease_expires_at = null "
+                "where id = ?",
+                (now + backoff, error, job_id),
+            )
+            self.retried += 1
+
+    async def _worker(self, name: str):
+        poll_seconds = float(os.getenv("JOB_QUEUE_POLL_SECONDS", "1"))
+        while True:
+            job = await run_in_threadpool(self.claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
                 continue
-            logger.warning("LLM: All attempts failed, falling back to rules-based classification")
-            return classify_with_rules(normalized_text)
 
+            job_id, ticket_id, description, attempts = job
+            try:
+                supabase = get_supabase()
+                if not supabase:
+                    raise RuntimeError("Supabase not configured")
+                await _classify_and_store(supabase, ticket_id, description)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Jobs: {name} failed job {job_id} (attempt {attempts}) - {type(e).__name__}: {e}")
+                await run_in_threadpool(self.fail, job_id, attempts, f"{type(e).__name__}: {e}")
+                continue
+            await run_in_threadpool(self.complete, job_id)
 
-def notify_n8n_if_negative(description: str, category: str, sentiment: str, ticket_id: Optional[str] = None):
-    if sentiment.lower() != "negativo":
-        return
-    
-    n8n_webhook_url = os.getenv("N8N_WEBHOOK_URL")
-    if not n8n_webhook_url:
-        return
-    
-    try:
-        payload = {
-            "description": description,
-            "category": category,
-            "sentiment": sentiment,
+    def start(self, workers: int):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker(f"worker-{i}")) for i in range(max(1, workers))
+        ]
+        logger.info(f"Jobs: Started {len(self._workers)} workers on {self.path}")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._db.execute("select status, count(*) from jobs group by status").fetchall())
+            dead = self._db.execute("select count(*) from dead_jobs").fetchone()[0]
+        return {
+            "enabled": True,
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "dead": dead,
+            "workers": len(self._workers),
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
         }
-        if ticket_id:
-            payload["id"] = ticket_id
-        
-        requests.post(
-            n8n_webhook_url,
-            json=payload,
-            timeout=5,
-            headers={"Content-Type": "application/json"}
+
+
+job_queue: Optional[TicketJobQueue] = None
+
+
+class UnprocessedSweeper:
+    """Reclasifica en segundo plano los tickets que quedaron con ``processed = false``.
+
+    Recorre la tabla en orden keyset ``(created_at, id)`` apoyado en el índice
+    parcial ``tickets_unprocessed_idx``, clasifica cada página con concurrencia
+    acotada y guarda las etiquetas con un único UPDATE por página, solo en las
+    filas que siguen con ``processed = false``. Solo toma tickets con más de
+    ``min_age`` segundos para no competir con /create-ticket ni con la cola de
+    jobs.
+    """
+
+    def __init__(
+        self,
+        page_size: int = 500,
+        concurrency: int = 64,
+        interval: float = 60.0,
+        min_age: float = 120.0,
+        notify: bool = False,
+    ):
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.min_age = min_age
+        self.notify = notify
+        self._task: Optional[asyncio.Task] = None
+        self.total_processed = 0
+        self.total_failed = 0
+        self.passes = 0
+        self.backlog: Optional[int] = None
+        self.last_pass_seconds: Optional[float] = None
+        self.last_pass_processed = 0
+        self.throughput_per_second = 0.0
+
+    @classmethod
+    def from_env(cls) -> "UnprocessedSweeper":
+        return cls(
+            page_size=int(os.getenv("SWEEPER_PAGE_SIZE", "500")),
+            concurrency=int(os.getenv("SWEEPER_CONCURRENCY", "64")),
+            interval=float(os.getenv("SWEEPER_INTERVAL_SECONDS", "60")),
+            min_age=float(os.getenv("SWEEPER_MIN_AGE_SECONDS", "120")),
+            notify=_env_flag("SWEEPER_NOTIFY_N8N"),
         )
-    except Exception as e:
-        logger.warning(f"n8n: Failed to notify webhook - {type(e).__name__}: {e}")
+
+    async def _fetch_page(self, supabase: Client, cutoff: str, cursor: Optional[tuple]) -> list:
+        query = (
+            supabase.table("tickets")
+            .select("id, description, created_at")
+            .eq("processed", False)
+            .lt("created_at", cutoff)
+        )
+        if cursor:
+            created_at, ticket_id = cursor
+            # Comillas: el timestamp lleva ":" y "+" que PostgREST no admite sin escapar
+            query = query.or_(
+                f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{ticket_id})'
+            )
+        result = await _execute(query.order("created_at").order("id").limit(self.page_size))
+        return result.data or []
+
+    async def _count_backlog(self, supabase: Client) -> Optional[int]:
+        try:
+            result = await _execute(
+                supabase.table("tickets").select("id", count="exact").eq("processed", False).limit(1)
+            )
+            return result.count
+        except Exception as e:
+            logger.warning(f"Sweeper: Could not count backlog - {type(e).__name__}: {e}")
+            return None
+
+    async def _process_page(self, supabase: Client, rows: list) -> int:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def classify(row: dict):
+            async with semaphore:
+                try:
+                    return row, await classify_ticket(row["description"])
+                except Exception as e:
+                    logger.error(f"Sweeper: Failed to classify {row['id']} - {type(e).__name__}: {e}")
+                    return row, None
+
+        results = await asyncio.gather(*(classify(row) for row in rows))
+        classified = {row["id"]: (row, classification) for row, classification in results if classification}
+        self.total_failed += len(rows) - len(classified)
+        if not classified:
+            return 0
+        # Solo etiquetas y solo si sigue sin procesar: un ticket borrado, editado
+        # o procesado por otra vía mientras tanto no se pisa ni se revive
+        applied = await TicketRepository(supabase).update_labels(
+            [{"id": ticket_id, **_classified_fields(classification)} for ticket_id, (_, classification) in classified.items()],
+            only_unprocessed=True,
+        )
+        for updated in applied:
+            ticket_id = str(updated["id"])
+            _, classification = classified[ticket_id]
+            publish_ticket_change(
+                ticket_id,
+                description=updated["description"],
+                created_at=updated["created_at"],
+                **_classified_fields(classification),
+            )
+            if self.notify:
+                await notify_negative(updated["description"], classification["category"], classification["sentiment"], ticket_id)
+        return len(applied)
+
+    async def sweep_once(self) -> int:
+        """Recorre todo el backlog una vez; devuelve cuántos tickets procesó."""
+        supabase = get_supabase()
+        if not supabase:
+            return 0
+        started = time.perf_counter()
+        cutoff = datetime.fromtimestamp(time.time() - self.min_age, tz=timezone.utc).isoformat()
+        self.backlog = await self._count_backlog(supabase)
+        cursor = None
+        processed = 0
+        while True:
+            rows = await self._fetch_page(supabase, cutoff, cursor)
+            if not rows:
+                break
+            processed += await self._process_page(supabase, rows)
+            cursor = (rows[-1]["created_at"], rows[-1]["id"])
+            elapsed = time.perf_counter() - started
+            self.throughput_per_second = round(processed / elapsed, 2) if elapsed else 0.0
+            if len(rows) < self.page_size:
+                break
+        self.total_processed += processed
+        self.passes += 1
+        self.last_pass_processed = processed
+        self.last_pass_seconds = round(time.perf_counter() - started, 3)
+        if processed:
+            logger.info(
+                f"Sweeper: Processed {processed} tickets in {self.last_pass_seconds}s "
+                f"({self.throughput_per_second}/s)"
+            )
+            self.backlog = await self._count_backlog(supabase)
+        return processed
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Sweeper: Pass failed - {type(e).__name__}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info("Sweeper: Started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "backlog": self.backlog,
+            "passes": self.passes,
+            "total_processed": self.total_processed,
+            "total_failed": self.total_failed,
+            "last_pass_processed": self.last_pass_processed,
+            "last_pass_seconds": self.last_pass_seconds,
+            "throughput_per_second": self.throughput_per_second,
+        }
+
+
+sweeper: Optional[UnprocessedSweeper] = None
 
 
 @app.get("/health")
@@ -508,13 +4358,54 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+def metrics_endpoint():
+    """Métricas en formato de exposición de Prometheus."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def _metrics_summary() -> dict:
+    stages = (
+        "normalize", "neighbors", "local_model", "llm_request", "json_parse",
+        "supabase_select", "supabase_insert", "supabase_upsert", "supabase_update", "supabase_delete",
+        "n8n_webhook",
+    )
+    return {
+        "stages": {stage: STAGE_SECONDS.summary(stage=stage) for stage in stages},
+        "classifications": {
+            source: CLASSIFICATIONS.value(source=source) for source in ("llm", "cache", "neighbors", "local_model", "rules")
+        },
+        "retries": CLASSIFICATION_RETRIES.value(),
+        "fallbacks": CLASSIFICATION_FALLBACKS.value(),
+        "confidence_rejections": CONFIDENCE_REJECTIONS.value(),
+        "llm_errors": LLM_RESPONSES.value() - LLM_RESPONSES.value(status=200),
+    }
+
+
 @app.get("/diagnostics")
-def diagnostics():
+def diagnostics(probe: bool = False):
     """Endpoint to check LLM status and configuration"""
-    llm_status = test_llm_connection()
+    # La prueba en vivo se cachea; ?probe=true la fuerza
+    llm_status = cached_llm_status(force=probe)
     
     return {
         "llm": llm_status,
+        "metrics": _metrics_summary(),
+        "batching": _batcher.stats() if _batcher else {"enabled": _env_flag("LLM_BATCH_ENABLED")},
+        "circuit_breaker": get_llm_breaker().stats(),
+        "rate_limiter": _llm_rate_limiter.stats() if _llm_rate_limiter else {"enabled": _env_flag("LLM_RATE_LIMIT_ENABLED")},
+        "llm_backends": clients.llm().stats() if isinstance(clients.llm(), LLMBackendPool) else None,
+        "job_queue": job_queue.stats() if job_queue else {"enabled": False},
+        "sweeper": sweeper.stats() if sweeper else {"enabled": False},
+        "n8n_outbox": n8n_outbox.stats() if n8n_outbox else {"enabled": False},
+        "ticket_events": ticket_events.stats() if ticket_events else {"enabled": False},
+        "ticket_feed": ticket_feed.stats() if ticket_feed else {"enabled": False},
+        "prompts": get_prompt_selector().stats(),
+        "input_budget": get_input_budget().stats(),
+        "coalescing": inflight_classifications.stats(),
+        "cache": _classification_cache.stats() if _classification_cache else {"enabled": _env_flag("CLASSIFY_CACHE_ENABLED", "true")},
+        "neighbors": _neighbor_index.stats() if _neighbor_index else {"enabled": _env_flag("NEIGHBOR_ENABLED")},
+        "local_model": clients.local_model().stats() if clients.local_model() else {"enabled": False},
         "config": {
             "hf_model": os.getenv("HF_MODEL", "meta-llama/Llama-3.1-8B-Instruct"),
             "llm_base_url": os.getenv("LLM_API_BASE_URL", "https://router.huggingface.co/v1/chat/completions"),
@@ -527,8 +4418,29 @@ def diagnostics():
     }
 
 
+@app.post("/admin/reload-clients")
+async def reload_clients(x_admin_token: Optional[str] = Header(default=None)):
+    """Reconstruye los clientes compartidos tras rotar configuración."""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Reload disabled (ADMIN_TOKEN not set)")
+    if x_admin_token != admin_token:
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    global _prompt_selector
+    await clients.reload()
+    # La selección de plantilla y el A/B también se releen del entorno
+    _prompt_selector = None
+    local_model = clients.local_model()
+    return {
+        "message": "Clientes recargados",
+        "llm_configured": llm_client() is not None,
+        "local_model_version": local_model.version if local_model else None,
+        "prompt_templates": get_prompt_selector().stats()["default"],
+    }
+
+
 @app.post("/create-ticket", response_model=dict)
-def create_ticket(ticket: TicketIn):
+async def create_ticket(ticket: TicketIn):
     if not ticket.description:
         raise HTTPException(status_code=400, detail="description is required")
 
@@ -536,28 +4448,31 @@ def create_ticket(ticket: TicketIn):
     if not supabase:
         raise HTTPException(status_code=500, detail="Supabase not configured")
 
-    ticket_data = {
-        "description": ticket.description,
-        "processed": False,
-    }
-    result = supabase.table("tickets").insert(ticket_data).execute()
-    
-    if not result.data or len(result.data) == 0:
-        raise HTTPException(status_code=500, detail="Failed to create ticket")
-    
-    ticket_id = result.data[0]["id"]
+    repository = TicketRepository(supabase)
 
-    classification = classify_ticket(ticket.description)
-    
-    supabase.table("tickets").update(
-        {
-            "category": classification["category"],
-            "sentiment": classification["sentiment"],
-            "processed": True,
-        }
-    ).eq("id", ticket_id).execute()
+    if job_queue is not None:
+        # Modo asíncrono: los workers clasifican; el dashboard recibe el update por realtime
+        rows = await repository.insert({"description": ticket.description, "processed": False}, columns="id, created_at")
+        if not rows:
+            raise HTTPException(status_code=500, detail="Failed to create ticket")
+        ticket_id = rows[0]["id"]
+        publish_ticket_change(ticket_id, created_at=rows[0].get("created_at"), description=ticket.description, processed=False)
+        await run_in_threadpool(job_queue.enqueue, ticket_id, ticket.description)
+        return JSONResponse(
+            status_code=202,
+            content={"ticket_id": ticket_id, "processed": False, "status": "queued"},
+        )
+
+    # Modo síncrono: se clasifica primero y el ticket se inserta ya clasificado en un solo statement
+    classification = await classify_ticket(ticket.description)
+    fields = {"description": ticket.description, **_classified_fields(classification)}
+    rows = await repository.insert(fields, columns="id, created_at")
+    if not rows:
+        raise HTTPException(status_code=500, detail="Failed to create ticket")
+    ticket_id = rows[0]["id"]
+    publish_ticket_change(ticket_id, created_at=rows[0].get("created_at"), **fields)
 
-    notify_n8n_if_negative(
+    await notify_negative(
         ticket.description,
         classification["category"],
         classification["sentiment"],
@@ -573,24 +4488,19 @@ def create_ticket(ticket: TicketIn):
 
 
 @app.post("/process-ticket", response_model=TicketOut)
-def process_ticket(ticket: TicketIn):
+async def process_ticket(ticket: TicketIn):
     if not ticket.description:
         raise HTTPException(status_code=400, detail="description is required")
 
-    result = classify_ticket(ticket.description)
+    result = await classify_ticket(ticket.description)
     processed = True
 
     supabase = get_supabase()
     if ticket.ticket_id and supabase:
-        supabase.table("tickets").update(
-            {
-                "category": result["category"],
-                "sentiment": result["sentiment"],
-                "processed": True,
-            }
-        ).eq("id", ticket.ticket_id).execute()
+        await TicketRepository(supabase).update(ticket.ticket_id, _classified_fields(result), columns=None)
+        publish_ticket_change(ticket.ticket_id, **_classified_fields(result))
 
-    notify_n8n_if_negative(
+    await notify_negative(
         ticket.description,
         result["category"],
         result["sentiment"],
@@ -604,8 +4514,301 @@ def process_ticket(ticket: TicketIn):
     )
 
 
+async def _spool_request_body(request: Request):
+    """Vuelca el cuerpo a un archivo temporal (en memoria hasta un límite, luego a disco).
+
+    Se lee completo antes de responder porque StreamingResponse escucha
+    ``http.disconnect`` en paralelo y consumiría los chunks del cuerpo.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=int(os.getenv("BULK_SPOOL_MEMORY_BYTES", "4194304")))
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+async def _iter_bulk_items(stream):
+    """Itera los elementos de un cuerpo JSON array o NDJSON sin cargarlo completo en memoria.
+
+    El spool puede estar en disco: cada lectura corre en el threadpool.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    max_item_bytes = int(os.getenv("BULK_MAX_ITEM_BYTES", "1048576"))
+    buffer = ""
+    in_array = None
+    while True:
+        chunk = await run_in_threadpool(stream.read, 65536)
+        buffer += utf8.decode(chunk, final=not chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if in_array is None:
+                in_array = buffer[pos] == "["
+                if in_array:
+                    pos += 1
+                    continue
+            if in_array and buffer[pos] == "]":
+                pos += 1
+                continue
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Elemento incompleto: esperar el siguiente chunk
+                break
+            yield item
+        buffer = buffer[pos:]
+        if not chunk:
+            break
+        if len(buffer) > max_item_bytes:
+            raise ValueError(f"Bulk item exceeds {max_item_bytes} bytes or is not valid JSON")
+    if buffer.strip():
+        raise ValueError("Invalid JSON/NDJSON body")
+
+
+def _bulk_description(item) -> Optional[str]:
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict) and isinstance(item.get("description"), str):
+        return item["description"]
+    return None
+
+
+def _ndjson(payload: dict) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+# Notificaciones de /tickets/bulk en curso; referencia fuerte hasta que terminan
+_bulk_notify_tasks: set = set()
+
+
+async def _bulk_notify(negatives: list, semaphore: asyncio.Semaphore):
+    """Notifica los tickets negativos de un lote con concurrencia acotada."""
+
+    async def notify(description: str, category: str, sentiment: str, ticket_id: str):
+        async with semaphore:
+            await notify_negative(description, category, sentiment, ticket_id)
+
+    results = await asyncio.gather(*(notify(*negative) for negative in negatives), return_exceptions=True)
+    for (_, _, _, ticket_id), result in zip(negatives, results):
+        if isinstance(result, Exception):
+            logger.error(f"Bulk: Notifying ticket {ticket_id} failed - {type(result).__name__}: {result}")
+
+
+async def _bulk_process_chunk(supabase: Client, chunk: list, semaphore: asyncio.Semaphore, stats: dict):
+    """Inserta un chunk con un único insert, clasifica con concurrencia acotada y
+    guarda las etiquetas por lotes. Emite una línea NDJSON por ticket, solo cuando
+    su lote ya quedó guardado (o falló)."""
+    upsert_size = int(os.getenv("BULK_UPSERT_SIZE", "200"))
+    notify_semaphore = asyncio.Semaphore(int(os.getenv("BULK_NOTIFY_CONCURRENCY", "8")))
+    repository = TicketRepository(supabase)
+    inserted = await repository.insert(
+        [{"description": description, "processed": False} for _, description in chunk],
+        columns="id, created_at",
+    )
+    if len(inserted) != len(chunk):
+        stats["errors"] += len(chunk)
+        for index, _ in chunk:
+            yield _ndjson({"index": index, "error": "Failed to create ticket"})
+        return
+
+    async def classify(index: int, ticket_id: str):
+        async with semaphore:
+            return index, ticket_id, await classify_ticket(descriptions[index])
+
+    descriptions = dict(chunk)
+    for (_, description), row in zip(chunk, inserted):
+        publish_ticket_change(row["id"], created_at=row.get("created_at"), description=description, processed=False)
+    tasks = [
+        asyncio.create_task(classify(index, row["id"]))
+        for (index, _), row in zip(chunk, inserted)
+    ]
+    pending = []
+    notifications = []
+
+    async def flush():
+        batch = pending[:]
+        pending.clear()
+        negatives = []
+        try:
+            # Solo etiquetas por id: un ticket borrado entretanto no se revive
+            applied = await repository.update_labels(
+                [{"id": ticket_id, **_classified_fields(classification)} for _, ticket_id, classification in batch]
+            )
+        except Exception as e:
+            logger.error(f"Bulk: Storing {len(batch)} classifications failed - {type(e).__name__}: {e}")
+            stats["errors"] += len(batch)
+            return [
+                _ndjson({"index": index, "ticket_id": ticket_id, "error": "Failed to store classification"})
+                for index, ticket_id, _ in batch
+            ], negatives
+        stored = {str(row["id"]): row for row in applied}
+        lines = []
+        for index, ticket_id, classification in batch:
+            row = stored.get(str(ticket_id))
+            if row is None:
+                stats["errors"] += 1
+                lines.append(_ndjson({"index": index, "ticket_id": ticket_id, "error": "Ticket no longer exists"}))
+                continue
+            stats["processed"] += 1
+            publish_ticket_change(
+                ticket_id,
+                created_at=row["created_at"],
+                description=row["description"],
+                **_classified_fields(classification),
+            )
+            lines.append(_ndjson({"index": index, "ticket_id": ticket_id, **_classified_fields(classification)}))
+            negatives.append((row["description"], classification["category"], classification["sentiment"], ticket_id))
+        return lines, negatives
+
+    async def emit():
+        lines, negatives = await flush()
+        for line in lines:
+            yield line
+        # Las notificaciones (hasta 5 s cada una sin outbox) no frenan el stream
+        if negatives:
+            task = asyncio.create_task(_bulk_notify(negatives, notify_semaphore))
+            _bulk_notify_tasks.add(task)
+            task.add_done_callback(_bulk_notify_tasks.discard)
+            notifications.append(task)
+
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            pending.append(await next_done)
+            if len(pending) >= upsert_size:
+                async for line in emit():
+                    yield line
+        if pending:
+            async for line in emit():
+                yield line
+        # El chunk termina cuando sus notificaciones terminan. wait (no gather) no
+        # las cancela si el cliente corta antes: siguen en segundo plano
+        if notifications:
+            await asyncio.wait(notifications)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/tickets/bulk")
+async def bulk_create_tickets(request: Request):
+    """Ingesta masiva: cuerpo JSON array o NDJSON, respuesta NDJSON en streaming"""
+    supabase = get_supabase()
+    if not supabase:
+        raise HTTPException(status_code=500, detail="Supabase not configured")
+
+    chunk_size = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+    semaphore = asyncio.Semaphore(int(os.getenv("BULK_CONCURRENCY", "32")))
+    body = await _spool_request_body(request)
+
+    async def results():
+        stats = {"received": 0, "processed": 0, "errors": 0}
+        chunk = []
+        try:
+            async for item in _iter_bulk_items(body):
+                index = stats["received"]
+                stats["received"] += 1
+                description = _bulk_description(item)
+                if not description:
+                    stats["errors"] += 1
+                    yield _ndjson({"index": index, "error": "description is required"})
+                    continue
+                chunk.append((index, description))
+                if len(chunk) >= chunk_size:
+                    async for line in _bulk_process_chunk(supabase, chunk, semaphore, stats):
+                        yield line
+                    chunk = []
+            if chunk:
+                async for line in _bulk_process_chunk(supabase, chunk, semaphore, stats):
+                    yield line
+        except Exception as e:
+            logger.error(f"Bulk: Aborted - {type(e).__name__}: {e}")
+            yield _ndjson({"error": f"{type(e).__name__}: {e}"})
+        finally:
+            body.close()
+        yield _ndjson({"summary": stats})
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+@app.get("/tickets")
+async def list_tickets(
+    limit: int = Query(50, ge=1),
+    cursor: Optional[str] = None,
+    category: Optional[str] = None,
+    sentiment: Optional[str] = None,
+    processed: Optional[bool] = None,
+    fields: Optional[str] = None,
+):
+    """Lista tickets del más reciente al más antiguo con paginación keyset (``next_cursor``)"""
+    supabase = get_supabase()
+    if not supabase:
+        raise HTTPException(status_code=500, detail="Supabase not configured")
+
+    limit = min(limit, int(os.getenv("TICKETS_PAGE_MAX", "500")))
+    filters = {
+        column: value
+        for column, value in (("category", category), ("sentiment", sentiment), ("processed", processed))
+        if value is not None
+    }
+    # Se pide una fila extra para saber si hay más páginas sin un count
+    rows = await TicketRepository(supabase).page(
+        _ticket_columns(fields),
+        limit + 1,
+        cursor=_decode_cursor(cursor) if cursor else None,
+        filters=filters,
+    )
+    items = rows[:limit]
+    return {
+        "items": items,
+        "next_cursor": _encode_cursor(items[-1]) if len(rows) > limit else None,
+    }
+
+
+@app.get("/tickets/stats")
+async def ticket_stats():
+    """Conteos categoría × sentimiento desde el agregado incremental ``ticket_stats``"""
+    supabase = get_supabase()
+    if not supabase:
+        raise HTTPException(status_code=500, detail="Supabase not configured")
+
+    summary = {"total": 0, "processed": 0, "pending": 0, "by_category": {}, "by_sentiment": {}, "matrix": {}}
+    for row in await TicketRepository(supabase).stats():
+        total = int(row.get("total") or 0)
+        if total <= 0:
+            continue
+        summary["total"] += total
+        if not row.get("processed"):
+            summary["pending"] += total
+            continue
+        category = row.get("category") or "Sin categoría"
+        sentiment = row.get("sentiment") or "Sin sentimiento"
+        summary["processed"] += total
+        summary["by_category"][category] = summary["by_category"].get(category, 0) + total
+        summary["by_sentiment"][sentiment] = summary["by_sentiment"].get(sentiment, 0) + total
+        cell = summary["matrix"].setdefault(category, {})
+        cell[sentiment] = cell.get(sentiment, 0) + total
+    return summary
+
+
+@app.get("/tickets/events")
+async def ticket_events_stream(request: Request, since: Optional[str] = None):
+    """Deltas de tickets en tiempo real (SSE); reanuda con ``Last-Event-ID`` o ``?since=``"""
+    if ticket_events is None:
+        raise HTTPException(status_code=503, detail="Ticket events disabled (TICKET_EVENTS_ENABLED=false)")
+    last_event_id = request.headers.get("last-event-id") or since
+    return StreamingResponse(
+        ticket_events.subscribe(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.put("/tickets/{ticket_id}", response_model=dict)
-def update_ticket(ticket_id: str, ticket: TicketIn):
+async def update_ticket(ticket_id: str, ticket: TicketIn):
     """Actualiza un ticket y lo re-evalúa con IA"""
     if not ticket.description:
         raise HTTPException(status_code=400, detail="description is required")
@@ -614,26 +4817,19 @@ def update_ticket(ticket_id: str, ticket: TicketIn):
     if not supabase:
         raise HTTPException(status_code=500, detail="Supabase not configured")
 
-    # Verificar que el ticket existe
-    existing = supabase.table("tickets").select("*").eq("id", ticket_id).execute()
-    if not existing.data or len(existing.data) == 0:
-        raise HTTPException(status_code=404, detail="Ticket not found")
-
     # Re-evaluar con IA
-    classification = classify_ticket(ticket.description)
-
-    # Actualizar en Supabase
-    supabase.table("tickets").update(
-        {
-            "description": ticket.description,
-            "category": classification["category"],
-            "sentiment": classification["sentiment"],
-            "processed": True,
-        }
-    ).eq("id", ticket_id).execute()
+    classification = await classify_ticket(ticket.description)
+
+    # Descripción y etiquetas en un solo UPDATE ... returning id: sin filas
+    # devueltas el ticket no existe (se acepta la clasificación desperdiciada)
+    fields = {"description": ticket.description, **_classified_fields(classification)}
+    updated = await TicketRepository(supabase).update(ticket_id, fields, columns="id")
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    publish_ticket_change(ticket_id, **fields)
 
     # Notificar n8n si es negativo
-    notify_n8n_if_negative(
+    await notify_negative(
         ticket.description,
         classification["category"],
         classification["sentiment"],
@@ -650,18 +4846,16 @@ def update_ticket(ticket_id: str, ticket: TicketIn):
 
 
 @app.delete("/tickets/{ticket_id}")
-def delete_ticket(ticket_id: str):
+async def delete_ticket(ticket_id: str):
     """Elimina un ticket"""
     supabase = get_supabase()
     if not supabase:
         raise HTTPException(status_code=500, detail="Supabase not configured")
 
-    # Verificar que el ticket existe
-    existing = supabase.table("tickets").select("*").eq("id", ticket_id).execute()
-    if not existing.data or len(existing.data) == 0:
+    # Eliminar; sin filas devueltas el ticket no existe
+    deleted = await TicketRepository(supabase).delete(ticket_id)
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Ticket not found")
-
-    # Eliminar
-    supabase.table("tickets").delete().eq("id", ticket_id).execute()
+    publish_ticket_delete(ticket_id)
 
     return {"message": "Ticket eliminado exitosamente", "ticket_id": ticket_id}
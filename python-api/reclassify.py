@@ -0,0 +1,307 @@
+"""
+Reclasifica tickets históricos tras cambiar de modelo, de prompt o de categorías.
+
+Fuentes (una por corrida):
+
+- ``--supabase``: recorre ``tickets`` en orden keyset ``(created_at, id)``
+  (requiere SUPABASE_URL y SUPABASE_SERVICE_ROLE_KEY);
+- ``--input export.jsonl`` o ``--input export.parquet`` (Parquet requiere
+  pyarrow): filas con ``id``, ``description`` y las etiquetas guardadas
+  ``category``/``sentiment``.
+
+Cada página pasa primero por los tiers locales en un pool de procesos
+(normalización, presupuesto de entrada, modelo lineal local con
+LOCAL_MODEL_PATH y, con ``--local-only``, reglas). Lo que queda bajo
+LOCAL_MODEL_THRESHOLD va al LLM con concurrencia acotada a través del mismo
+motor que la API (coalescencia, micro-batching, limitador, breaker), pero sin
+leer la caché ni el índice de vecinos: ambos devolverían las etiquetas viejas.
+Sin LLM configurado la corrida aborta salvo con ``--local-only``; si el LLM
+cae y el motor devuelve un fallback, la fila se omite en vez de pisar la
+etiqueta guardada.
+
+Las diferencias con las etiquetas guardadas se escriben en ``--diff`` (JSONL)
+y, con ``--apply``, se guardan por lotes con un UPDATE por id que solo toca
+las etiquetas (RPC ``apply_ticket_labels``): un ticket borrado o editado
+después del export no se revive ni se revierte. Tras cada página se escribe
+``--checkpoint``; ``--resume`` continúa desde ahí. No se notifica a n8n.
+
+Uso:
+    python reclassify.py --supabase --diff diffs.jsonl
+    python reclassify.py --supabase --apply --resume --workers 8 --concurrency 64
+    python reclassify.py --input export.parquet --diff diffs.jsonl --local-only
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import main
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Opcional: solo para --input *.parquet
+    pq = None
+
+COLUMNS = ("id", "description", "category", "sentiment")
+
+# Fuentes del motor que cuentan como clasificación nueva; el resto son fallbacks
+LLM_STAGE_SOURCES = {"llm"}
+
+
+# ===== FUENTES =====
+
+async def supabase_pages(page_size: int, cursor):
+    """Páginas de Supabase; la posición es el cursor keyset de la última fila."""
+    supabase = main.get_supabase()
+    if supabase is None:
+        raise SystemExit("Supabase not configured (SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY)")
+    repository = main.TicketRepository(supabase)
+    cursor = tuple(cursor) if cursor else None
+    while True:
+        rows = await repository.page(
+            "id, created_at, description, category, sentiment", page_size, cursor=cursor, ascending=True
+        )
+        if not rows:
+            return
+        cursor = (rows[-1]["created_at"], rows[-1]["id"])
+        yield rows, list(cursor)
+        if len(rows) < page_size:
+            return
+
+
+def _jsonl_rows(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _parquet_rows(path: str, page_size: int):
+    if pq is None:
+        raise SystemExit("Reading Parquet requires pyarrow (pip install pyarrow)")
+    parquet = pq.ParquetFile(path)
+    columns = [column for column in COLUMNS if column in parquet.schema_arrow.names]
+    for batch in parquet.iter_batches(batch_size=page_size, columns=columns):
+        yield from batch.to_pylist()
+
+
+async def file_pages(path: str, page_size: int, offset):
+    """Páginas de un export; la posición es el número de filas ya consumidas."""
+    offset = offset or 0
+    rows = _parquet_rows(path, page_size) if path.endswith(".parquet") else _jsonl_rows(path)
+    page, position = [], 0
+    for row in rows:
+        position += 1
+        if position <= offset:
+            continue
+        page.append(row)
+        if len(page) >= page_size:
+            yield page, position
+            page = []
+    if page:
+        yield page, position
+
+
+# ===== TIERS LOCALES (pool de procesos) =====
+
+def local_stage(items: list, threshold: float, use_rules: bool) -> list:
+    """Resuelve en el worker lo que no necesita LLM; None marca las filas que sí."""
+    budget = main.get_input_budget()
+    model = main.clients.local_model()
+    results = []
+    for description in items:
+        text = budget.truncate(main.normalize_text(description))
+        prediction = model.predict(text) if model is not None else None
+        if prediction is not None and prediction["confidence"] >= threshold:
+            results.append({"category": prediction["category"], "sentiment": prediction["sentiment"], "source": "local_model"})
+        elif use_rules:
+            results.append({**main.classify_with_rules(text, normalized=True), "source": "rules"})
+        else:
+            results.append(None)
+    return results
+
+
+def _init_worker():
+    logging.getLogger("main").setLevel(logging.WARNING)
+    # Carga el modelo local una vez por proceso
+    main.clients.local_model()
+
+
+# ===== PIPELINE =====
+
+class Reclassifier:
+    def __init__(self, args, pool: ProcessPoolExecutor):
+        self.args = args
+        self.pool = pool
+        self.llm = None if args.local_only else main.llm_client()
+        if self.llm is None and not args.local_only:
+            # Sin LLM las reglas pisarían las etiquetas guardadas: solo con --local-only explícito
+            raise SystemExit("LLM not configured (HF_API_TOKEN / LLM_API_TOKEN); pass --local-only to use the local model and rules")
+        self.threshold = float(os.getenv("LOCAL_MODEL_THRESHOLD", "0.9"))
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.supabase = main.get_supabase() if args.apply else None
+        if args.apply and self.supabase is None:
+            raise SystemExit("--apply requires Supabase (SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY)")
+        self.stats = {"rows": 0, "changed": 0, "applied": 0, "missing": 0, "skipped": 0, "sources": {}}
+
+    async def _local(self, descriptions: list) -> list:
+        loop = asyncio.get_running_loop()
+        use_rules = self.args.local_only
+        chunk = max(1, -(-len(descriptions) // self.args.workers))
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(self.pool, local_stage, descriptions[start:start + chunk], self.threshold, use_rules)
+            for start in range(0, len(descriptions), chunk)
+        ))
+        return [result for part in parts for result in part]
+
+    async def _llm(self, description: str) -> dict:
+        async with self.semaphore:
+            result = await main.classify_ticket(description, use_cache=False, use_neighbors=False)
+        return result if result.get("source") in LLM_STAGE_SOURCES else None
+
+    async def process_page(self, rows: list, diff_file) -> None:
+        rows = [row for row in rows if row.get("id") and row.get("description")]
+        results = await self._local([row["description"] for row in rows])
+        pending = [index for index, result in enumerate(results) if result is None]
+        for index, result in zip(pending, await asyncio.gather(*(self._llm(rows[index]["description"]) for index in pending))):
+            results[index] = result
+
+        updates = []
+        for row, result in zip(rows, results):
+            self.stats["rows"] += 1
+            if result is None:
+                self.stats["skipped"] += 1
+                continue
+            sources = self.stats["sources"]
+            sources[result["source"]] = sources.get(result["source"], 0) + 1
+            if (row.get("category"), row.get("sentiment")) == (result["category"], result["sentiment"]):
+                continue
+            self.stats["changed"] += 1
+            if diff_file is not None:
+                diff_file.write(json.dumps({
+                    "id": row["id"],
+                    "old_category": row.get("category"),
+                    "old_sentiment": row.get("sentiment"),
+                    "category": result["category"],
+                    "sentiment": result["sentiment"],
+                    "source": result["source"],
+                }, ensure_ascii=False) + "\n")
+            updates.append({"id": row["id"], **main._classified_fields(result)})
+
+        if self.supabase is not None and updates:
+            repository = main.TicketRepository(self.supabase)
+            for start in range(0, len(updates), self.args.batch_size):
+                batch = updates[start:start + self.args.batch_size]
+                applied = await repository.update_labels(batch)
+                self.stats["applied"] += len(applied)
+                # Filas del export que ya no existen en la tabla
+                self.stats["missing"] += len(batch) - len(applied)
+
+
+def load_checkpoint(path: str, source: str) -> dict:
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != source:
+        raise SystemExit(f"Checkpoint {path} belongs to source {checkpoint.get('source')!r}, not {source!r}")
+    return checkpoint
+
+
+def save_checkpoint(path: str, source: str, position, stats: dict):
+    """Escritura atómica: un corte a mitad nunca deja un checkpoint corrupto."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "source": source,
+            "position": position,
+            "stats": stats,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+async def run(args) -> dict:
+    source = "supabase" if args.supabase else os.path.abspath(args.input)
+    checkpoint = load_checkpoint(args.checkpoint, source) if args.resume else {}
+    position = checkpoint.get("position")
+    if args.supabase:
+        pages = supabase_pages(args.page_size, position)
+    else:
+        pages = file_pages(args.input, args.page_size, position)
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        reclassifier = Reclassifier(args, pool)
+        previous = checkpoint.get("stats") or {}
+        for key in ("rows", "changed", "applied", "missing", "skipped"):
+            reclassifier.stats[key] = previous.get(key, 0)
+        reclassifier.stats["sources"] = dict(previous.get("sources") or {})
+        # Se abre tras validar (sin LLM, Reclassifier aborta): un arranque fallido no
+        # trunca el --diff anterior, y --resume sigue escribiendo al final
+        diff_context = contextlib.nullcontext()
+        if args.diff:
+            diff_context = open(args.diff, "a" if args.resume else "w", encoding="utf-8")
+        with diff_context as diff_file:
+            try:
+                # La siguiente página se lee mientras se clasifica la actual
+                next_page = asyncio.ensure_future(anext(pages, None))
+                while True:
+                    item = await next_page
+                    if item is None:
+                        break
+                    rows, position = item
+                    next_page = asyncio.ensure_future(anext(pages, None))
+                    await reclassifier.process_page(rows, diff_file)
+                    if diff_file is not None:
+                        diff_file.flush()
+                    if args.checkpoint:
+                        save_checkpoint(args.checkpoint, source, position, reclassifier.stats)
+                    elapsed = time.perf_counter() - start_time
+                    print(
+                        f"{reclassifier.stats['rows']} rows, {reclassifier.stats['changed']} changed, "
+                        f"{reclassifier.stats['skipped']} skipped ({elapsed:.0f}s)",
+                        file=sys.stderr,
+                    )
+                    if args.limit and reclassifier.stats["rows"] >= args.limit:
+                        next_page.cancel()
+                        break
+            finally:
+                await main.clients.close()
+    elapsed = time.perf_counter() - start_time
+    return {**reclassifier.stats, "elapsed_seconds": round(elapsed, 1)}
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Reclasifica tickets históricos")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--supabase", action="store_true", help="Leer los tickets de Supabase")
+    source.add_argument("--input", help="Export JSONL o Parquet con id, description, category, sentiment")
+    parser.add_argument("--diff", help="JSONL con las filas cuya etiqueta cambia")
+    parser.add_argument("--apply", action="store_true", help="Guardar los cambios en Supabase")
+    parser.add_argument("--checkpoint", default="reclassify.checkpoint.json")
+    parser.add_argument("--resume", action="store_true", help="Continuar desde --checkpoint")
+    parser.add_argument("--local-only", action="store_true", help="Sin LLM: modelo local y reglas")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--concurrency", type=int, default=32, help="Llamadas al LLM en vuelo")
+    parser.add_argument("--batch-size", type=int, default=500, help="Filas por UPDATE con --apply")
+    parser.add_argument("--limit", type=int, default=0, help="Detener tras N filas (0 = todas)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("main").setLevel(logging.WARNING)
+    summary = asyncio.run(run(args))
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import main
+from main import ClassificationBatcher
+
+
+class FakeLLM:
+    model = "fake"
+    max_tokens = 50
+    api_url = "http://llm.local/v1/chat/completions"
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(main, "llm_client", lambda: llm)
+    monkeypatch.setattr(main, "_llm_breaker", main.CircuitBreaker(enabled=False))
+    return llm
+
+
+def run_batch(texts):
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        batch = [(text, text, loop.create_future()) for text in texts]
+        await ClassificationBatcher(window_ms=1, max_size=len(texts))._run_batch(batch)
+        return [future.result() for _, _, future in batch]
+
+    return asyncio.run(scenario())
+
+
+def test_backend_failure_falls_back_without_fan_out(fake_llm, monkeypatch):
+    calls = []
+
+    async def failing_invoke(llm, prompt, **kwargs):
+        calls.append(prompt)
+        raise httpx.ConnectError("backend down")
+
+    monkeypatch.setattr(main, "_invoke_llm", failing_invoke)
+    results = run_batch([f"factura duplicada {i}" for i in range(5)])
+    assert len(calls) == 1
+    assert [result["source"] for result in results] == ["rules"] * 5
+    assert all(result["category"] == "Facturación" for result in results)
+
+
+def test_invalid_slots_are_retried_individually(fake_llm, monkeypatch):
+    async def batch_invoke(llm, prompt, **kwargs):
+        return json.dumps([
+            {"id": 1, "category": "Acceso", "sentiment": "Negativo"},
+            {"id": 2, "category": "Inventada", "sentiment": "Neutral"},
+        ])
+
+    retried = []
+
+    async def classify_single(llm, normalized_text, description, template=None):
+        retried.append(normalized_text)
+        return {"category": "Cuenta", "sentiment": "Neutral", "source": "llm"}
+
+    monkeypatch.setattr(main, "_invoke_llm", batch_invoke)
+    monkeypatch.setattr(main, "_classify_with_llm", classify_single)
+    results = run_batch(["no puedo entrar", "cambiar mi perfil"])
+    assert results[0] == {"category": "Acceso", "sentiment": "Negativo", "source": "llm"}
+    assert results[1]["category"] == "Cuenta"
+    assert retried == ["cambiar mi perfil"]
@@ -0,0 +1,49 @@
+import asyncio
+import io
+
+import pytest
+
+from main import _iter_bulk_items
+
+
+def parse(body: bytes):
+    async def scenario():
+        return [item async for item in _iter_bulk_items(io.BytesIO(body))]
+
+    return asyncio.run(scenario())
+
+
+def test_json_array():
+    assert parse(b'[{"description": "a"}, "b" ,\n {"description": "c"}]') == [{"description": "a"}, "b", {"description": "c"}]
+
+
+def test_ndjson():
+    assert parse(b'{"description": "a"}\n{"description": "b"}\r\n\n') == [{"description": "a"}, {"description": "b"}]
+
+
+def test_items_spanning_read_chunks():
+    items = [{"description": "x" * 50000, "n": n} for n in range(4)]
+    body = "[" + ",".join(f'{{"description": "{item["description"]}", "n": {item["n"]}}}' for item in items) + "]"
+    assert parse(body.encode()) == items
+
+
+def test_multibyte_character_split_across_chunks():
+    # "ó" queda partido entre dos lecturas de 64 KB
+    text = "a" * (65536 - len('["') - 1) + "ó"
+    assert parse(f'["{text}"]'.encode()) == [text]
+
+
+def test_empty_body():
+    assert parse(b"") == []
+    assert parse(b"[]") == []
+
+
+def test_invalid_json_raises():
+    with pytest.raises(ValueError):
+        parse(b'{"description": "a"}\n{"description": ')
+
+
+def test_oversized_item_raises(monkeypatch):
+    monkeypatch.setenv("BULK_MAX_ITEM_BYTES", "100")
+    with pytest.raises(ValueError):
+        parse(b'["' + b"x" * 70000 + b'"]')
@@ -0,0 +1,110 @@
+import pytest
+
+import main
+from main import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    return fake
+
+
+def make_breaker(**kwargs):
+    options = dict(window=10, min_requests=4, error_rate_threshold=0.5, latency_p95_threshold=5.0, cooldown=30.0)
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def trip(breaker):
+    for _ in range(breaker.min_requests):
+        assert breaker.allow_request()
+        breaker.record_failure(0.1)
+
+
+def test_stays_closed_below_min_requests(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure(0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_opens_on_error_rate_and_short_circuits(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.rejecting()
+    assert not breaker.allow_request()
+    assert breaker.short_circuited == 1
+    assert breaker.last_trip_reason.startswith("error rate")
+
+
+def test_opens_on_p95_latency(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record_success(6.0)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.last_trip_reason.startswith("p95 latency")
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = make_breaker(half_open_probes=1)
+    trip(breaker)
+    clock.now += 30
+    assert not breaker.rejecting()
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Solo una sonda en vuelo
+    assert breaker.rejecting()
+    assert not breaker.allow_request()
+    breaker.record_success(0.2)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.now += 30
+    assert breaker.allow_request()
+    breaker.record_failure(0.2)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+    assert not breaker.allow_request()
+
+
+def test_slow_probe_reopens(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.now += 30
+    assert breaker.allow_request()
+    breaker.record_success(6.0)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_release_frees_the_probe_slot(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.now += 30
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.release()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request()
+
+
+def test_disabled_breaker_always_allows(clock):
+    breaker = make_breaker(enabled=False)
+    trip(breaker)
+    assert not breaker.rejecting()
+    assert breaker.allow_request()
@@ -0,0 +1,77 @@
+import pytest
+
+import main
+from main import ClassificationCache
+
+VALUE = {"category": "Acceso", "sentiment": "Negativo"}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    return now
+
+
+def test_key_changes_with_model_and_prompt_version():
+    key = ClassificationCache.make_key("no puedo entrar", "llama", "full-v1")
+    assert key == ClassificationCache.make_key("no puedo entrar", "llama", "full-v1")
+    assert key != ClassificationCache.make_key("no puedo entrar", "llama", "full-v2")
+    assert key != ClassificationCache.make_key("no puedo entrar", "qwen", "full-v1")
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ClassificationCache(max_entries=2)
+    cache.set("a", VALUE)
+    cache.set("b", VALUE)
+    assert cache.get("a") == VALUE
+    cache.set("c", VALUE)
+    assert cache.get("b") is None
+    assert cache.get("a") == VALUE and cache.get("c") == VALUE
+    assert cache.evictions == 1
+
+
+def test_returned_values_are_copies():
+    cache = ClassificationCache()
+    cache.set("a", {**VALUE, "source": "llm"})
+    first = cache.get("a")
+    assert first == VALUE
+    first["category"] = "Cuenta"
+    assert cache.get("a") == VALUE
+
+
+def test_memory_entries_expire(clock):
+    cache = ClassificationCache(ttl_seconds=10)
+    cache.set("a", VALUE)
+    clock[0] += 11
+    assert cache.get("a") is None
+    assert cache.misses == 1
+
+
+def test_disk_hit_is_promoted_to_memory(tmp_path):
+    path = str(tmp_path / "cache.db")
+    ClassificationCache(sqlite_path=path).set("a", VALUE)
+    cache = ClassificationCache(sqlite_path=path)
+    # Sin disco consultado, el nivel de memoria no cuenta el fallo
+    assert cache.get_memory("a") is None and cache.misses == 0
+    assert cache.get_disk("a") == VALUE
+    assert cache.get_memory("a") == VALUE
+    assert cache.disk_hits == 1
+
+
+def test_disk_entries_expire(tmp_path, clock):
+    cache = ClassificationCache(ttl_seconds=10, sqlite_path=str(tmp_path / "cache.db"))
+    cache.set_disk("a", VALUE)
+    clock[0] += 11
+    assert cache.get_disk("a") is None
+    assert cache.misses == 1
+
+
+def test_disk_prune_keeps_newest_entries(tmp_path, clock):
+    cache = ClassificationCache(sqlite_path=str(tmp_path / "cache.db"), sqlite_max_entries=3)
+    for index in range(5):
+        clock[0] += 1
+        cache.set_disk(str(index), VALUE)
+    cache._prune_disk(clock[0])
+    keys = [row[0] for row in cache._db.execute("select key from classification_cache order by key")]
+    assert keys == ["2", "3", "4"]
@@ -0,0 +1,50 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+from main import ClientRegistry
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    counts = {"supabase": 0, "llm": 0, "local_model": 0}
+
+    def builder(name):
+        def build():
+            counts[name] += 1
+            return f"{name}-{counts[name]}"
+
+        return build
+
+    monkeypatch.setattr(main, "_build_supabase", builder("supabase"))
+    monkeypatch.setattr(main, "_build_llm_client", builder("llm"))
+    monkeypatch.setattr(main, "_build_local_model", builder("local_model"))
+    monkeypatch.setattr(main, "load_dotenv", lambda **kwargs: None)
+    return counts
+
+
+def test_clients_are_built_once_across_threads(builds):
+    registry = ClientRegistry()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(lambda _: (registry.supabase(), registry.llm()), range(64)))
+    assert set(results) == {("supabase-1", "llm-1")}
+    assert builds == {"supabase": 1, "llm": 1, "local_model": 1}
+
+
+def test_reload_rebuilds_clients(builds):
+    registry = ClientRegistry()
+    registry.startup()
+    asyncio.run(registry.reload())
+    assert registry.supabase() == "supabase-2"
+    assert registry.llm() == "llm-2"
+    assert registry.local_model() == "local_model-2"
+
+
+def test_close_drops_clients_until_next_use(builds):
+    registry = ClientRegistry()
+    registry.startup()
+    asyncio.run(registry.close())
+    assert builds["llm"] == 1
+    assert registry.llm() == "llm-2"
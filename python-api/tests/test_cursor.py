@@ -0,0 +1,34 @@
+import pytest
+from fastapi import HTTPException
+
+from main import _decode_cursor, _encode_cursor
+
+
+def test_round_trip():
+    row = {"created_at": "2024-05-01T10:20:30.123456+00:00", "id": "0b6f1c9e-2d4a-4f3b-9a51-7c8d2e3f4a5b"}
+    cursor = _encode_cursor(row)
+    assert "=" not in cursor
+    assert _decode_cursor(cursor) == (row["created_at"], row["id"])
+
+
+def test_numeric_ids_round_trip():
+    assert _decode_cursor(_encode_cursor({"created_at": "2024-05-01 10:20:30", "id": 42})) == ("2024-05-01 10:20:30", 42)
+
+
+@pytest.mark.parametrize("cursor", ["", "no-es-base64!", _encode_cursor({"created_at": "2024-05-01", "id": "abc"})[:-3]])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as exc:
+        _decode_cursor(cursor)
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "row",
+    [
+        {"created_at": "2024-05-01),id.gt.0", "id": "abc"},
+        {"created_at": "2024-05-01T10:00:00", "id": "abc,processed.eq.true"},
+    ],
+)
+def test_filter_injection_is_rejected(row):
+    with pytest.raises(HTTPException):
+        _decode_cursor(_encode_cursor(row))
@@ -0,0 +1,59 @@
+import main
+from main import InputBudget
+
+
+def test_short_text_is_untouched():
+    budget = InputBudget(max_tokens=512, chunked=True)
+    text = "no puedo iniciar sesión"
+    assert not budget.exceeds(text)
+    assert budget.truncate(text) == text
+    assert budget.segments(text) == []
+
+
+def test_truncate_keeps_head_and_tail():
+    budget = InputBudget(max_tokens=10, head_ratio=0.5)
+    text = " ".join(f"w{i}" for i in range(100))
+    truncated = budget.truncate(text)
+    assert truncated.startswith("w0 w1 w2 w3 w4")
+    assert truncated.endswith("w95 w96 w97 w98 w99")
+    assert "w50" not in truncated
+    assert budget.truncated == 1
+
+
+def test_truncate_caps_characters_of_unbroken_runs():
+    budget = InputBudget(max_tokens=8)
+    truncated = budget.truncate("x" * 10_000)
+    assert len(truncated) <= 8 * InputBudget._MAX_TOKEN_CHARS + 3
+
+
+def test_segments_long_text_with_few_tokens():
+    # Supera la cota de caracteres con menos de max_tokens tokens
+    budget = InputBudget(max_tokens=512, chunked=True)
+    text = "abcdefghijklmnop " * 500
+    assert budget.exceeds(text)
+    segments = budget.segments(text)
+    assert segments
+    window = budget.max_tokens * InputBudget._MAX_TOKEN_CHARS
+    assert all(0 < len(segment) <= window + InputBudget._MAX_TOKEN_CHARS for segment in segments)
+
+
+def test_segments_without_tokens_falls_back_to_truncation():
+    budget = InputBudget(max_tokens=4, chunked=True)
+    assert budget.segments(" " * 1_000) == []
+
+
+def test_segments_keep_first_and_last_and_cap_count():
+    budget = InputBudget(max_tokens=10, chunked=True, max_segments=3)
+    filler = " ".join(f"w{i}" for i in range(200))
+    text = f"inicio {filler} factura cobro pago {filler} final"
+    segments = budget.segments(text)
+    assert len(segments) == 3
+    assert segments[0].startswith("inicio")
+    assert segments[-1].endswith("final")
+    assert main._RULES_MATCHER.match(segments[1])
+    assert budget.chunked_tickets == 1
+
+
+def test_segments_disabled_without_chunked_mode():
+    budget = InputBudget(max_tokens=10)
+    assert budget.segments(" ".join(["palabra"] * 100)) == []
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+import main
+from main import TicketJobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    jobs = TicketJobQueue(str(tmp_path / "jobs.db"), max_attempts=3, lease_seconds=30)
+    yield jobs
+    jobs._db.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    return now
+
+
+def test_claim_leases_in_order_and_complete_deletes(queue):
+    queue.enqueue("t1", "primero")
+    queue.enqueue("t2", "segundo")
+    first = queue.claim()
+    assert first[1:] == ("t1", "primero", 1)
+    assert queue.claim()[1] == "t2"
+    assert queue.claim() is None
+    queue.complete(first[0])
+    assert queue.stats()["running"] == 1
+    assert queue.processed == 1
+
+
+def test_expired_lease_is_reclaimed(queue, clock):
+    queue.enqueue("t1", "texto")
+    job_id = queue.claim()[0]
+    assert queue.claim() is None
+    clock[0] += 31
+    assert queue.claim() == (job_id, "t1", "texto", 2)
+
+
+def test_failures_back_off_then_dead_letter(queue, clock):
+    queue.enqueue("t1", "texto")
+    job_id, _, _, attempts = queue.claim()
+    queue.fail(job_id, attempts, "ConnectError: down")
+    # Backoff de 2 s tras el primer intento
+    assert queue.claim() is None
+    clock[0] += 2
+    job_id, _, _, attempts = queue.claim()
+    assert attempts == 2
+    queue.fail(job_id, attempts, "ConnectError: down")
+    clock[0] += 4
+    job_id, _, _, attempts = queue.claim()
+    queue.fail(job_id, attempts, "HTTPStatusError: 500")
+    assert queue.stats()["pending"] == 0
+    assert queue._db.execute("select id, ticket_id, attempts, last_error from dead_jobs").fetchall() == [
+        (job_id, "t1", 3, "HTTPStatusError: 500")
+    ]
+    assert queue.retried == 2
+    assert queue.dead_lettered == 1
+
+
+def test_worker_retries_failed_job(tmp_path, monkeypatch):
+    jobs = TicketJobQueue(str(tmp_path / "jobs.db"), max_attempts=3)
+    calls = []
+
+    async def classify_and_store(supabase, ticket_id, description):
+        calls.append(ticket_id)
+        if len(calls) == 1:
+            raise RuntimeError("supabase down")
+
+    monkeypatch.setattr(main, "get_supabase", lambda: object())
+    monkeypatch.setattr(main, "_classify_and_store", classify_and_store)
+    monkeypatch.setenv("JOB_QUEUE_POLL_SECONDS", "0.01")
+
+    async def scenario():
+        jobs.start(1)
+        # enqueue corre en el threadpool, como desde /create-ticket
+        await main.run_in_threadpool(jobs.enqueue, "t1", "texto")
+        for _ in range(100):
+            if jobs.retried:
+                break
+            await asyncio.sleep(0.01)
+        jobs._db.execute("update jobs set available_at = 0")
+        for _ in range(100):
+            if jobs.processed:
+                break
+            await asyncio.sleep(0.01)
+        await jobs.stop()
+
+    asyncio.run(scenario())
+    assert calls == ["t1", "t1"]
+    assert jobs.retried == 1
+    assert jobs.processed == 1
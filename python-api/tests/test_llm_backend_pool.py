@@ -0,0 +1,76 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from main import LLMBackend, LLMBackendPool
+
+
+class FakeClient:
+    max_tokens = 50
+    headers: dict = {}
+
+    def __init__(self, url, fail=False):
+        self.api_url = url
+        self.model = "fake"
+        self.fail = fail
+        self.calls = []
+
+    async def ainvoke(self, prompt, **kwargs):
+        self.calls.append(prompt)
+        if self.fail:
+            raise httpx.ConnectError("backend down")
+        return "ok"
+
+
+@pytest.fixture(autouse=True)
+def no_breaker(monkeypatch):
+    monkeypatch.setattr(main, "_llm_breaker", main.CircuitBreaker(enabled=False))
+
+
+def test_metrics_are_labelled_with_the_chosen_backend():
+    client = FakeClient("http://replica-a.local/v1/chat/completions")
+    pool = LLMBackendPool([LLMBackend(client)])
+    before = main.LLM_RESPONSES.value(endpoint="replica-a.local/v1/chat/completions", status=200)
+
+    async def scenario():
+        result = await main._invoke_llm(pool, "hola")
+        await pool.stop()
+        return result
+
+    assert asyncio.run(scenario()) == "ok"
+    assert main.LLM_RESPONSES.value(endpoint="replica-a.local/v1/chat/completions", status=200) == before + 1
+    assert main.LLM_RESPONSES.value(endpoint="pool") == 0
+
+
+def test_failures_are_labelled_with_the_backend():
+    client = FakeClient("http://replica-b.local/v1/chat/completions", fail=True)
+    pool = LLMBackendPool([LLMBackend(client)])
+
+    async def scenario():
+        with pytest.raises(httpx.ConnectError):
+            await main._invoke_llm(pool, "hola")
+        await pool.stop()
+
+    asyncio.run(scenario())
+    assert main.LLM_RESPONSES.value(endpoint="replica-b.local/v1/chat/completions", status="error") == 1
+
+
+def test_single_ejected_backend_is_probed_back_into_the_pool():
+    client = FakeClient("http://overflow.local/v1/chat/completions")
+    backend = LLMBackend(client, overflow=True)
+    backend.healthy = False
+    pool = LLMBackendPool([backend], health_interval=0.01)
+
+    async def scenario():
+        pool.start()
+        for _ in range(100):
+            if backend.healthy:
+                break
+            await asyncio.sleep(0.01)
+        await pool.stop()
+
+    asyncio.run(scenario())
+    assert backend.healthy
+    assert client.calls and client.calls[0] == "ping"
@@ -0,0 +1,94 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from main import N8nOutbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    box = N8nOutbox(str(tmp_path / "outbox.db"), "http://n8n.local/webhook", batch_window=0, max_attempts=3)
+    yield box
+    box._db.close()
+
+
+def rows(box, table="outbox"):
+    return box._db.execute(f"select id, attempts, last_error from {table} order by id").fetchall()
+
+
+def test_enqueue_persists_and_complete_deletes(outbox):
+    outbox.enqueue({"ticket_id": "a"})
+    outbox.enqueue({"ticket_id": "b"})
+    assert [row[0] for row in rows(outbox)] == [1, 2]
+    items = [outbox._ready.popleft(), outbox._ready.popleft()]
+    outbox._complete(items)
+    assert rows(outbox) == []
+    assert outbox.delivered == 2
+
+
+def test_failures_back_off_then_dead_letter(outbox, monkeypatch):
+    outbox.enqueue({"ticket_id": "a"})
+    item = outbox._ready.popleft()
+    outbox._fail([item], "ConnectError: down")
+    [(row_id, attempts, error)] = rows(outbox)
+    assert attempts == 1 and error == "ConnectError: down"
+    # Aún no vence el backoff
+    assert outbox._due_retries(10) == []
+    clock = [main.time.time()]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    clock[0] += 2
+    retry = outbox._due_retries(10)
+    assert [(entry[0], entry[1]) for entry in retry] == [(row_id, 1)]
+    outbox._fail(retry, "HTTPStatusError: 500")
+    clock[0] += 4
+    outbox._fail(outbox._due_retries(10), "HTTPStatusError: 500")
+    assert rows(outbox) == []
+    assert rows(outbox, "dead_outbox") == [(row_id, 3, "HTTPStatusError: 500")]
+    assert outbox.retried == 2
+    assert outbox.dead_lettered == 1
+
+
+def test_pending_rows_survive_restart(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    first = N8nOutbox(path, "http://n8n.local/webhook")
+    first.enqueue({"ticket_id": "a"})
+    first._db.close()
+    second = N8nOutbox(path, "http://n8n.local/webhook")
+    second._load_pending()
+    assert [payload for _, _, payload in second._ready] == [{"ticket_id": "a"}]
+    second._db.close()
+
+
+def test_dispatcher_retries_failed_delivery(tmp_path, monkeypatch):
+    box = N8nOutbox(str(tmp_path / "outbox.db"), "http://n8n.local/webhook", batch_window=0)
+    statuses = [500, 200]
+    received = []
+
+    def handler(request):
+        received.append(request.content)
+        return httpx.Response(statuses.pop(0))
+
+    async def scenario():
+        box.start()
+        box._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        # enqueue corre en el threadpool, como desde notify_negative
+        await main.run_in_threadpool(box.enqueue, {"ticket_id": "a"})
+        for _ in range(100):
+            if box.retried:
+                break
+            await asyncio.sleep(0.01)
+        box._db.execute("update outbox set available_at = 0")
+        box._wakeup.set()
+        for _ in range(100):
+            if box.delivered:
+                break
+            await asyncio.sleep(0.01)
+        await box.stop()
+
+    monkeypatch.setenv("N8N_OUTBOX_POLL_SECONDS", "0.01")
+    asyncio.run(scenario())
+    assert box.retried == 1
+    assert box.delivered == 1
+    assert len(received) == 2
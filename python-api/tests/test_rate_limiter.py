@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from main import LLMRateLimited, LLMRateLimiter
+
+
+def test_burst_is_admitted_without_waiting():
+    limiter = LLMRateLimiter(requests_per_second=1, burst=5, max_wait=0.01)
+
+    async def scenario():
+        for _ in range(5):
+            await limiter.acquire()
+
+    asyncio.run(scenario())
+    assert limiter.admitted == 5
+
+
+def test_sheds_when_wait_exceeds_max_wait():
+    limiter = LLMRateLimiter(requests_per_second=1, burst=1, max_wait=0.05)
+
+    async def scenario():
+        await limiter.acquire()
+        with pytest.raises(LLMRateLimited):
+            await limiter.acquire()
+
+    asyncio.run(scenario())
+    assert limiter.shed_max_wait == 1
+    assert limiter.waiting == 0
+
+
+def test_waits_for_refill_within_max_wait():
+    limiter = LLMRateLimiter(requests_per_second=50, burst=1, max_wait=1.0)
+
+    async def scenario():
+        await limiter.acquire()
+        await limiter.acquire()
+
+    asyncio.run(scenario())
+    assert limiter.admitted == 2
+    assert limiter.shed_max_wait == 0
+
+
+def test_sheds_when_queue_is_full():
+    limiter = LLMRateLimiter(requests_per_second=20, burst=1, max_queue=2, max_wait=1.0)
+
+    async def scenario():
+        await limiter.acquire()
+        waiters = [asyncio.ensure_future(limiter.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(LLMRateLimited):
+            await limiter.acquire()
+        await asyncio.gather(*waiters)
+
+    asyncio.run(scenario())
+    assert limiter.shed_queue_full == 1
+    assert limiter.admitted == 3
+
+
+def test_admits_in_fifo_order():
+    limiter = LLMRateLimiter(requests_per_second=100, burst=1, max_wait=1.0)
+    order = []
+
+    async def one(index):
+        await limiter.acquire()
+        order.append(index)
+
+    async def scenario():
+        await asyncio.gather(*(one(index) for index in range(5)))
+
+    asyncio.run(scenario())
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_token_budget_sheds_large_requests():
+    limiter = LLMRateLimiter(requests_per_second=100, burst=10, tokens_per_minute=600, max_wait=0.05)
+
+    async def scenario():
+        await limiter.acquire(tokens=600)
+        with pytest.raises(LLMRateLimited):
+            await limiter.acquire(tokens=100)
+
+    asyncio.run(scenario())
+    assert limiter.shed_max_wait == 1
+
+
+def test_retry_after_blocks_admission():
+    limiter = LLMRateLimiter(requests_per_second=100, burst=10, max_wait=0.05)
+    limiter.block_for(5)
+
+    async def scenario():
+        with pytest.raises(LLMRateLimited):
+            await limiter.acquire()
+
+    asyncio.run(scenario())
+    assert limiter.retry_after_blocks == 1
+    assert limiter.admitted == 0
@@ -0,0 +1,33 @@
+import main
+from main import KeywordMatcher, classify_with_rules
+
+
+def test_first_category_in_rule_order_wins():
+    # "api" (Integraciones) aparece antes en el texto, pero Facturación tiene prioridad
+    assert classify_with_rules("la api falla al generar la factura")["category"] == "Facturación"
+    assert classify_with_rules("Texto sin palabras clave") == {"category": "Técnico", "sentiment": "Neutral"}
+
+
+def test_positive_overrides_negative():
+    assert classify_with_rules("el login no funciona")["sentiment"] == "Negativo"
+    assert classify_with_rules("el login no funciona, gracias")["sentiment"] == "Positivo"
+
+
+def test_normalized_text_is_not_lowered_again():
+    assert classify_with_rules("FACTURA", normalized=True)["category"] == "Técnico"
+    assert classify_with_rules("FACTURA")["category"] == "Facturación"
+
+
+def test_stop_mask_does_not_change_result():
+    text = "factura gracias " + "perfil webhook lento error " * 50
+    assert classify_with_rules(text) == {"category": "Facturación", "sentiment": "Positivo"}
+    assert main._RULES_MATCHER.match(text, stop_mask=main._RULES_STOP_MASK) & main._RULES_STOP_MASK == main._RULES_STOP_MASK
+
+
+def test_matcher_without_automaton_matches_automaton(monkeypatch):
+    groups = (("a", ("uno", "dos")), ("b", ("tres",)), ("c", ("dos tres",)))
+    with_automaton = KeywordMatcher(groups)
+    monkeypatch.setattr(main, "ahocorasick", None)
+    plain = KeywordMatcher(groups)
+    for text in ("uno", "dos tres", "nada", "tres uno tres"):
+        assert with_automaton.match(text) == plain.match(text)
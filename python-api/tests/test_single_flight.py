@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from main import SingleFlight
+
+
+def test_concurrent_identical_keys_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"category": "Acceso", "sentiment": "Neutral"}
+
+    async def scenario():
+        return await asyncio.gather(*(flight.run("same", factory) for _ in range(10)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(result == {"category": "Acceso", "sentiment": "Neutral"} for result in results)
+    # Cada llamador recibe su propia copia
+    results[0]["category"] = "Cuenta"
+    assert results[1]["category"] == "Acceso"
+    assert flight.leaders == 1
+    assert flight.coalesced == 9
+    assert flight.stats()["inflight"] == 0
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+    calls = []
+
+    async def factory(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return {"key": key}
+
+    async def scenario():
+        return await asyncio.gather(*(flight.run(key, lambda key=key: factory(key)) for key in ("a", "b", "a")))
+
+    results = asyncio.run(scenario())
+    assert sorted(calls) == ["a", "b"]
+    assert [result["key"] for result in results] == ["a", "b", "a"]
+
+
+def test_sequential_calls_are_not_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    async def scenario():
+        first = await flight.run("k", factory)
+        second = await flight.run("k", factory)
+        return first, second
+
+    assert asyncio.run(scenario()) == ({"n": 1}, {"n": 2})
+
+
+def test_leader_error_reaches_every_caller():
+    flight = SingleFlight()
+
+    async def factory():
+        await asyncio.sleep(0.01)
+        raise ValueError("backend down")
+
+    async def scenario():
+        return await asyncio.gather(*(flight.run("k", factory) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.stats()["inflight"] == 0
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    flight = SingleFlight()
+
+    async def factory():
+        await asyncio.sleep(0.02)
+        return {"ok": True}
+
+    async def scenario():
+        leader = asyncio.ensure_future(flight.run("k", factory))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.run("k", factory))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(scenario()) == {"ok": True}
+    assert flight.leaders == 1
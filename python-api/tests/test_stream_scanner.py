@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import main
+from main import JsonObjectScanner, OpenAICompatibleAPI
+
+RESULT = '{"category": "Acceso", "sentiment": "Negativo"}'
+
+
+def test_object_split_across_chunks():
+    scanner = JsonObjectScanner()
+    assert scanner.feed('Claro: {"category": "Ac') == []
+    assert scanner.feed('ceso", "sentiment": "Negativo"} listo') == [RESULT]
+
+
+def test_braces_and_escaped_quotes_inside_strings():
+    text = '{"category": "UX/UI", "note": "usa {llaves} y \\"comillas\\" }"}'
+    assert JsonObjectScanner().feed(text) == [text]
+
+
+def test_escape_split_across_chunks():
+    scanner = JsonObjectScanner()
+    assert scanner.feed('{"a": "x\\') == []
+    assert scanner.feed('"}"}') == ['{"a": "x\\"}"}']
+
+
+def test_nested_and_multiple_objects():
+    text = 'a {"x": {"y": 1}} b {"z": 2}'
+    assert JsonObjectScanner().feed(text) == ['{"x": {"y": 1}}', '{"z": 2}']
+
+
+def test_fenced_block():
+    assert JsonObjectScanner().feed(f"```json\n{RESULT}\n```") == [RESULT]
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.lines = [f"data: {json.dumps(chunk)}" for chunk in chunks] + ["data: [DONE]"]
+        self.consumed = 0
+
+    async def aiter_lines(self):
+        for line in self.lines:
+            self.consumed += 1
+            yield line
+
+
+def content(piece):
+    return {"choices": [{"delta": {"content": piece}}]}
+
+
+def read(stream):
+    llm = OpenAICompatibleAPI(model="fake", base_url="http://llm.local/v1/chat/completions")
+
+    async def scenario():
+        token = main._active_prompt_template.set("test-stream")
+        try:
+            return await llm._read_stream(stream)
+        finally:
+            main._active_prompt_template.reset(token)
+
+    return asyncio.run(scenario())
+
+
+def test_stops_when_model_keeps_generating_after_the_object():
+    pieces = ['{"category": "Acceso", ', '"sentiment": "Negativo"}', " Además"] + [" x"] * 50
+    stream = FakeStream([content(piece) for piece in pieces])
+    before = main.LLM_STREAM_EARLY_STOPS.value(model="fake")
+    assert read(stream) == RESULT
+    assert stream.consumed == 3
+    assert main.LLM_STREAM_EARLY_STOPS.value(model="fake") == before + 1
+
+
+def test_reads_usage_chunk_after_the_object():
+    usage = {"usage": {"prompt_tokens": 120, "completion_tokens": 12}, "choices": []}
+    stream = FakeStream([content(RESULT), {"choices": [{"delta": {}, "finish_reason": "stop"}]}, usage])
+    assert read(stream) == RESULT
+    assert main.PROMPT_TOKENS.value(template="test-stream", kind="prompt") == 120
+
+
+def test_returns_full_text_without_a_complete_object():
+    stream = FakeStream([content("Categoría: "), content("Acceso")])
+    assert read(stream) == "Categoría: Acceso"
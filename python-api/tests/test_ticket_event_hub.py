@@ -0,0 +1,103 @@
+import asyncio
+import json
+
+from main import TicketEventHub
+
+
+def parse(frame: bytes):
+    lines = frame.decode("utf-8").strip().split("\n")
+    fields = dict(line.split(": ", 1) for line in lines)
+    return fields["id"], fields["event"], json.loads(fields["data"])
+
+
+def flushed(hub: TicketEventHub, *events):
+    async def scenario():
+        for op, ticket_id, fields in events:
+            hub.publish(op, ticket_id, fields)
+        hub._flush()
+
+    asyncio.run(scenario())
+
+
+def test_upserts_merge_and_delete_wins():
+    hub = TicketEventHub(window=60)
+    flushed(
+        hub,
+        ("upsert", "a", {"description": "x"}),
+        ("upsert", "a", {"category": "Acceso"}),
+        ("upsert", "b", {"description": "y"}),
+        ("delete", "b", None),
+    )
+    _, name, data = parse(hub._replay(f"{hub.epoch}-0"))
+    assert name == "tickets"
+    assert data == {
+        "seq": 4,
+        "events": [{"op": "upsert", "id": "a", "description": "x", "category": "Acceso"}, {"op": "delete", "id": "b"}],
+    }
+
+
+def test_resume_replays_only_missed_events():
+    hub = TicketEventHub(window=60)
+    flushed(hub, ("upsert", "a", {"sentiment": "Neutral"}))
+    last_id = f"{hub.epoch}-{hub.flushed_seq}"
+    flushed(hub, ("upsert", "b", {"sentiment": "Negativo"}))
+    event_id, name, data = parse(hub._replay(last_id))
+    assert event_id == f"{hub.epoch}-2"
+    assert name == "tickets"
+    assert data["events"] == [{"op": "upsert", "id": "b", "sentiment": "Negativo"}]
+    # Al día: solo ready
+    assert parse(hub._replay(event_id))[1] == "ready"
+
+
+def test_unflushed_events_are_not_replayed():
+    hub = TicketEventHub(window=60)
+    flushed(hub, ("upsert", "a", {}))
+
+    async def scenario():
+        hub.publish("upsert", "b", {})
+        return parse(hub._replay(f"{hub.epoch}-0"))
+
+    _, _, data = asyncio.run(scenario())
+    assert [event["id"] for event in data["events"]] == ["a"]
+
+
+def test_reset_when_gap_left_the_buffer_or_epoch_changed():
+    hub = TicketEventHub(buffer_size=2, window=60)
+    flushed(hub, *(("upsert", str(n), {}) for n in range(5)))
+    assert parse(hub._replay(f"{hub.epoch}-1"))[1] == "reset"
+    assert parse(hub._replay(f"{hub.epoch}-3"))[1] == "tickets"
+    assert parse(hub._replay(f"otra-{hub.flushed_seq}"))[1] == "reset"
+    assert parse(hub._replay(f"{hub.epoch}-99"))[1] == "reset"
+    assert parse(hub._replay(None))[1] == "ready"
+
+
+def test_subscribers_receive_frames_and_reset():
+    hub = TicketEventHub(window=0.001)
+
+    async def scenario():
+        stream = hub.subscribe()
+        frames = [await stream.__anext__()]
+        hub.publish("upsert", "a", {"processed": True})
+        frames.append(await stream.__anext__())
+        hub.reset()
+        frames.append(await stream.__anext__())
+        await stream.aclose()
+        return [parse(frame)[1] for frame in frames]
+
+    assert asyncio.run(scenario()) == ["ready", "tickets", "reset"]
+    assert hub.stats()["subscribers"] == 0
+
+
+def test_slow_subscriber_is_dropped():
+    hub = TicketEventHub(window=60, subscriber_queue=1)
+
+    async def scenario():
+        stream = hub.subscribe()
+        await stream.__anext__()
+        for n in range(3):
+            hub.publish("upsert", str(n), {})
+            hub._flush()
+        return [frame async for frame in stream]
+
+    assert asyncio.run(scenario()) == []
+    assert hub.dropped_subscribers == 1
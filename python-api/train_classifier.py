@@ -0,0 +1,290 @@
+"""
+Entrena el clasificador lineal local a partir de etiquetas del LLM.
+
+Fuentes de datos (combinables):
+
+- ``--input labels.jsonl``: el log que escribe la API con LOCAL_MODEL_LABEL_LOG
+  (``normalized_text``, ``category``, ``sentiment``) o cualquier JSONL con
+  ``description`` en lugar de ``normalized_text``. Es la fuente limpia: solo
+  contiene etiquetas que devolvió el LLM;
+- ``--supabase``: exporta los tickets con ``processed = true`` en orden keyset
+  ``(created_at, id)`` (requiere SUPABASE_URL y SUPABASE_SERVICE_ROLE_KEY).
+  ``--export`` guarda esas filas en JSONL para reentrenar sin volver a
+  consultar. Ojo: la tabla no guarda el origen de la etiqueta, así que incluye
+  también las que pusieron las reglas, el propio modelo local y los vecinos; el
+  modelo resultante destila en parte esos tiers en vez del LLM.
+
+Entrena una regresión logística multinomial por cabeza (categoría y
+sentimiento) con mini-batch Adam sobre los mismos n-gramas con hashing que usa
+la API, calibra cada cabeza con temperature scaling sobre un holdout y guarda un
+artefacto ``.npz`` versionado que la API carga con LOCAL_MODEL_PATH.
+
+Uso:
+    python train_classifier.py --input labels.jsonl --output models/ticket_classifier.npz
+    python train_classifier.py --supabase --export supabase_labels.jsonl --output models/ticket_classifier.npz
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+import main
+
+
+def load_jsonl(path: str) -> list:
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            text = item.get("normalized_text")
+            if text is None and item.get("description"):
+                text = main.normalize_text(item["description"])
+            if text:
+                rows.append((text, item.get("category"), item.get("sentiment")))
+    return rows
+
+
+async def _load_supabase(page_size: int, max_rows: int) -> list:
+    supabase = main.get_supabase()
+    if supabase is None:
+        raise SystemExit("Supabase not configured (SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY)")
+    repository = main.TicketRepository(supabase)
+    rows = []
+    cursor = None
+    while len(rows) < max_rows:
+        page = await repository.page(
+            "id, created_at, description, category, sentiment",
+            page_size,
+            cursor=cursor,
+            filters={"processed": True},
+            ascending=True,
+        )
+        for item in page:
+            if item.get("description"):
+                rows.append((main.normalize_text(item["description"]), item.get("category"), item.get("sentiment")))
+        if len(page) < page_size:
+            break
+        cursor = (page[-1]["created_at"], page[-1]["id"])
+    return rows
+
+
+def load_supabase(page_size: int = 1000, max_rows: int = 500000) -> list:
+    """Tickets procesados por páginas keyset ``(created_at, id)``, sin OFFSET."""
+    return asyncio.run(_load_supabase(page_size, max_rows))
+
+
+def prepare(rows: list) -> list:
+    """Valida etiquetas y deduplica por texto normalizado (gana la última etiqueta)."""
+    dataset = {}
+    for text, category, sentiment in rows:
+        classification = main.validate_classification({"category": category, "sentiment": sentiment})
+        if classification:
+            dataset[text] = (classification["category"], classification["sentiment"])
+    return [(text, category, sentiment) for text, (category, sentiment) in dataset.items()]
+
+
+def vectorize(texts: list, dim: int) -> tuple:
+    """Matriz dispersa por filas: (índices, valores) de cada texto."""
+    indices, values = [], []
+    for text in texts:
+        vector = main.hashed_ngram_vector(text, dim)
+        if vector is None:
+            vector = np.zeros(dim, dtype=np.float32)
+        nonzero = np.flatnonzero(vector)
+        indices.append(nonzero)
+        values.append(vector[nonzero])
+    return indices, values
+
+
+def densify(indices: list, values: list, rows, dim: int):
+    batch = np.zeros((len(rows), dim), dtype=np.float32)
+    for position, row in enumerate(rows):
+        batch[position, indices[row]] = values[row]
+    return batch
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def train_head(indices, values, targets, train_rows, n_classes, args, rng) -> tuple:
+    """Regresión logística multinomial con mini-batch Adam y regularización L2."""
+    dim, lr, l2, batch_size = args.dim, args.lr, args.l2, args.batch_size
+    weights = np.zeros((dim, n_classes), dtype=np.float32)
+    bias = np.zeros(n_classes, dtype=np.float32)
+    m_w, v_w = np.zeros_like(weights), np.zeros_like(weights)
+    m_b, v_b = np.zeros_like(bias), np.zeros_like(bias)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    step = 0
+    for _ in range(args.epochs):
+        order = rng.permutation(train_rows)
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            x = densify(indices, values, rows, dim)
+            probs = softmax(x @ weights + bias)
+            probs[np.arange(len(rows)), targets[rows]] -= 1.0
+            grad_w = x.T @ probs / len(rows) + l2 * weights
+            grad_b = probs.mean(axis=0)
+            step += 1
+            for param, grad, m, v in ((weights, grad_w, m_w, v_w), (bias, grad_b, m_b, v_b)):
+                m *= beta1
+                m += (1 - beta1) * grad
+                v *= beta2
+                v += (1 - beta2) * grad * grad
+                m_hat = m / (1 - beta1 ** step)
+                v_hat = v / (1 - beta2 ** step)
+                param -= lr * m_hat / (np.sqrt(v_hat) + eps)
+    return weights, bias
+
+
+def logits_for(indices, values, rows, dim, weights, bias, batch_size=2048):
+    chunks = []
+    for start in range(0, len(rows), batch_size):
+        x = densify(indices, values, rows[start:start + batch_size], dim)
+        chunks.append(x @ weights + bias)
+    return np.vstack(chunks) if chunks else np.zeros((0, len(bias)), dtype=np.float32)
+
+
+def expected_calibration_error(probs, targets, bins: int = 10) -> float:
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == targets
+    ece = 0.0
+    for low in np.linspace(0, 1, bins, endpoint=False):
+        mask = (confidence > low) & (confidence <= low + 1.0 / bins)
+        if mask.any():
+            ece += mask.mean() * abs(correct[mask].mean() - confidence[mask].mean())
+    return float(ece)
+
+
+MIN_TEMPERATURE = 0.25
+
+
+def fit_temperature(logits, targets) -> float:
+    """Temperatura que minimiza el NLL del holdout (búsqueda en rejilla).
+
+    Con un holdout separable el NLL baja sin límite al afilar; la rejilla tiene
+    piso en MIN_TEMPERATURE y, si el óptimo cae en el piso, no hay evidencia
+    para afilar y se deja 1.0. Así la calibración nunca lleva todas las
+    probabilidades a 1.0 y LOCAL_MODEL_THRESHOLD sigue filtrando.
+    """
+    if not len(targets):
+        return 1.0
+    grid = np.geomspace(MIN_TEMPERATURE, 10.0, 120)
+    best_temperature, best_nll = 1.0, float("inf")
+    for temperature in grid:
+        probs = softmax(logits / temperature)
+        nll = float(-np.log(probs[np.arange(len(targets)), targets] + 1e-12).mean())
+        if nll < best_nll:
+            best_temperature, best_nll = float(temperature), nll
+    if best_temperature <= grid[0]:
+        return 1.0
+    return best_temperature
+
+
+def train(dataset: list, args) -> main.LinearTicketClassifier:
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(dataset))
+    holdout_size = int(len(dataset) * args.holdout)
+    holdout_rows, train_rows = order[:holdout_size], order[holdout_size:]
+    texts = [text for text, _, _ in dataset]
+    indices, values = vectorize(texts, args.dim)
+
+    heads = {}
+    metrics = {"rows": len(dataset), "train_rows": len(train_rows), "holdout_rows": len(holdout_rows)}
+    for position, (name, labels) in enumerate((
+        ("category", sorted(main.ALLOWED_CATEGORIES)),
+        ("sentiment", sorted(main.ALLOWED_SENTIMENTS)),
+    ), start=1):
+        targets = np.array([labels.index(row[position]) for row in dataset], dtype=np.int64)
+        weights, bias = train_head(indices, values, targets, train_rows, len(labels), args, rng)
+        holdout_logits = logits_for(indices, values, holdout_rows, args.dim, weights, bias)
+        holdout_targets = targets[holdout_rows]
+        temperature = fit_temperature(holdout_logits, holdout_targets)
+        head_metrics = {"temperature": round(temperature, 4)}
+        if len(holdout_rows):
+            raw = softmax(holdout_logits)
+            calibrated = softmax(holdout_logits / temperature)
+            head_metrics.update(
+                accuracy=round(float((raw.argmax(axis=1) == holdout_targets).mean()), 4),
+                ece_raw=round(expected_calibration_error(raw, holdout_targets), 4),
+                ece_calibrated=round(expected_calibration_error(calibrated, holdout_targets), 4),
+            )
+        metrics[name] = head_metrics
+        heads[name] = {"labels": labels, "weights": weights, "bias": bias, "temperature": temperature}
+
+    digest = hashlib.sha256()
+    for head in heads.values():
+        digest.update(head["weights"].tobytes())
+    version = f"{datetime.now(timezone.utc):%Y%m%d%H%M%S}-{digest.hexdigest()[:8]}"
+    metrics["trained_at"] = datetime.now(timezone.utc).isoformat()
+    return main.LinearTicketClassifier(dim=args.dim, heads=heads, version=version, info=metrics)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Entrena el clasificador lineal local")
+    parser.add_argument(
+        "--input", action="append", default=[],
+        help="JSONL de etiquetas (repetible); el log LOCAL_MODEL_LABEL_LOG es la fuente limpia del LLM",
+    )
+    parser.add_argument(
+        "--supabase", action="store_true",
+        help="Exportar tickets procesados de Supabase; incluye etiquetas de reglas, modelo local y vecinos",
+    )
+    parser.add_argument("--export", help="Guardar las filas exportadas de Supabase en este JSONL")
+    parser.add_argument("--output", default="models/ticket_classifier.npz")
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--epochs", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=0.05)
+    parser.add_argument("--l2", type=float, default=1e-5)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--holdout", type=float, default=0.15)
+    parser.add_argument("--min-rows", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=13)
+    args = parser.parse_args(argv)
+
+    logging.getLogger("main").setLevel(logging.WARNING)
+    rows = []
+    for path in args.input:
+        rows.extend(load_jsonl(path))
+    if args.supabase:
+        print(
+            "Warning: --supabase labels also come from rules, the local model and neighbours; "
+            "--input with the LLM label log is the clean source",
+            file=sys.stderr,
+        )
+        exported = load_supabase()
+        if args.export:
+            with open(args.export, "w", encoding="utf-8") as f:
+                for text, category, sentiment in exported:
+                    f.write(json.dumps(
+                        {"normalized_text": text, "category": category, "sentiment": sentiment},
+                        ensure_ascii=False,
+                    ) + "\n")
+        rows.extend(exported)
+
+    dataset = prepare(rows)
+    if len(dataset) < args.min_rows:
+        print(f"Only {len(dataset)} labelled rows (< --min-rows {args.min_rows}), not training", file=sys.stderr)
+        return 1
+
+    model = train(dataset, args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    model.save(args.output)
+    print(json.dumps({"version": model.version, "output": args.output, "metrics": model.info}, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -10,6 +10,121 @@ create table if not exists public.tickets (
   processed boolean not null default false
 );
 
+-- Índice parcial para el sweeper de tickets sin procesar (recorrido keyset)
+create index if not exists tickets_unprocessed_idx
+on public.tickets (created_at, id)
+where processed = false;
+
+-- Listado del dashboard (GET /tickets): recorrido keyset (created_at, id) descendente
+create index if not exists tickets_created_id_idx
+on public.tickets (created_at desc, id desc);
+
+create index if not exists tickets_category_created_idx
+on public.tickets (category, created_at desc, id desc);
+
+create index if not exists tickets_sentiment_created_idx
+on public.tickets (sentiment, created_at desc, id desc);
+
+-- Agregado incremental para GET /tickets/stats: conteos por categoría × sentimiento
+create table if not exists public.ticket_stats (
+  category text not null default '',
+  sentiment text not null default '',
+  processed boolean not null,
+  total bigint not null default 0,
+  primary key (category, sentiment, processed)
+);
+
+-- Triggers por statement con tablas de transición: un upsert de 500 filas
+-- toca cada celda del agregado una sola vez
+create or replace function public.ticket_stats_apply()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if tg_op = 'INSERT' then
+    insert into public.ticket_stats as s (category, sentiment, processed, total)
+    select coalesce(category, ''), coalesce(sentiment, ''), processed, count(*)
+    from new_rows
+    group by 1, 2, 3
+    on conflict (category, sentiment, processed) do update set total = s.total + excluded.total;
+  elsif tg_op = 'UPDATE' then
+    insert into public.ticket_stats as s (category, sentiment, processed, total)
+    select category, sentiment, processed, sum(delta)
+    from (
+      select coalesce(category, '') as category, coalesce(sentiment, '') as sentiment, processed, 1 as delta
+      from new_rows
+      union all
+      select coalesce(category, ''), coalesce(sentiment, ''), processed, -1
+      from old_rows
+    ) changes
+    group by 1, 2, 3
+    having sum(delta) <> 0
+    on conflict (category, sentiment, processed) do update set total = s.total + excluded.total;
+  else
+    insert into public.ticket_stats as s (category, sentiment, processed, total)
+    select coalesce(category, ''), coalesce(sentiment, ''), processed, -count(*)
+    from old_rows
+    group by 1, 2, 3
+    on conflict (category, sentiment, processed) do update set total = s.total + excluded.total;
+  end if;
+  return null;
+end $$;
+
+drop trigger if exists tickets_stats_insert on public.tickets;
+create trigger tickets_stats_insert
+after insert on public.tickets
+referencing new table as new_rows
+for each statement execute function public.ticket_stats_apply();
+
+drop trigger if exists tickets_stats_update on public.tickets;
+create trigger tickets_stats_update
+after update on public.tickets
+referencing old table as old_rows new table as new_rows
+for each statement execute function public.ticket_stats_apply();
+
+drop trigger if exists tickets_stats_delete on public.tickets;
+create trigger tickets_stats_delete
+after delete on public.tickets
+referencing old table as old_rows
+for each statement execute function public.ticket_stats_apply();
+
+-- Carga inicial del agregado (solo si está vacío)
+insert into public.ticket_stats (category, sentiment, processed, total)
+select coalesce(category, ''), coalesce(sentiment, ''), processed, count(*)
+from public.tickets
+where not exists (select 1 from public.ticket_stats)
+group by 1, 2, 3;
+
+alter table public.ticket_stats enable row level security;
+
+drop policy if exists "ticket_stats_read_all" on public.ticket_stats;
+create policy "ticket_stats_read_all"
+on public.ticket_stats
+for select
+using (true);
+
+-- Escritura de etiquetas por lotes (sweeper, /bulk, reclassify.py): un único
+-- UPDATE acotado por id; nunca toca description ni crea filas, así que no
+-- revive tickets borrados ni pisa descripciones editadas entretanto.
+-- only_unprocessed: solo filas que siguen con processed = false
+create or replace function public.apply_ticket_labels(rows jsonb, only_unprocessed boolean default false)
+returns table (id uuid, created_at timestamptz, description text)
+language sql
+set search_path = public
+as $$
+  update public.tickets as t
+  set category = r.category, sentiment = r.sentiment, processed = true
+  from jsonb_to_recordset(rows) as r(id uuid, category text, sentiment text)
+  where t.id = r.id
+    and (not only_unprocessed or t.processed = false)
+  returning t.id, t.created_at, t.description;
+$$;
+
+-- Solo el backend (service role) escribe etiquetas
+revoke execute on function public.apply_ticket_labels(jsonb, boolean) from public, anon, authenticated;
+
 -- Realtime: asegurar payload completo en updates
 alter table public.tickets replica identity full;
 
@@ -30,7 +145,9 @@ with check (true);
 
 -- Actualizaciones se hacen con service role (RLS bypass)
 
--- Realtime: agregar tabla a la publicación si no existe
+-- Realtime: agregar tabla a la publicación si no existe. La necesita el feed
+-- upstream del API (TICKET_EVENTS_UPSTREAM=true, desactivado por defecto); con
+-- él activo, replica identity full (arriba) hace que los DELETE lleguen con la fila
 do $$
 begin
   if not exists (